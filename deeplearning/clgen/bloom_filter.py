@@ -0,0 +1,133 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""A Bloom filter of strings, which can be saved to a file."""
+import hashlib
+import math
+import os
+import pathlib
+import struct
+import typing
+
+import numpy as np
+
+from labm8.py import app
+
+FLAGS = app.FLAGS
+
+# The file header: <magic, number of bits, number of hashes, count>.
+_HEADER = struct.Struct("<8sQQQ")
+_MAGIC = b"CLGENBF1"
+
+
+class BloomFilter(object):
+  """A fixed-size set of strings with false positives but no false negatives.
+
+  The memory used by the filter is fixed when it is constructed, from the
+  expected number of strings and the desired false positive rate. The false
+  positive rate increases if more strings are added.
+  """
+
+  def __init__(self, capacity: int = 10000000, error_rate: float = 0.001):
+    """Constructor.
+
+    Args:
+      capacity: The expected number of strings to add.
+      error_rate: The false positive rate once capacity strings are added.
+    """
+    if capacity <= 0:
+      raise ValueError(f"capacity must be >= 1. Received: {capacity}")
+    if not 0 < error_rate < 1:
+      raise ValueError(f"error_rate must be in (0, 1). Received: {error_rate}")
+    num_bits = int(
+      math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    )
+    num_hashes = max(int(round(num_bits / capacity * math.log(2))), 1)
+    self._Init(num_bits, num_hashes, np.zeros((num_bits + 7) // 8, np.uint8))
+
+  def _Init(self, num_bits: int, num_hashes: int, bits: np.ndarray) -> None:
+    self.num_bits = num_bits
+    self.num_hashes = num_hashes
+    self.bits = bits
+    # The number of strings added to the filter.
+    self.count = 0
+
+  def _Locate(self, string: str) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """Return the <byte indices, bit masks> of a string's bits.
+
+    The bit positions are computed from the sha256 of the string, using
+    double hashing.
+    """
+    digest = hashlib.sha256(string.encode("utf-8")).digest()
+    h1, h2 = np.frombuffer(digest[:16], dtype="<u8")
+    # Overflow wraps around, which does not affect the distribution.
+    with np.errstate(over="ignore"):
+      positions = h1 + np.arange(self.num_hashes, dtype=np.uint64) * (
+        h2 | np.uint64(1)
+      )
+    positions %= np.uint64(self.num_bits)
+    masks = np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8))
+    return positions >> np.uint64(3), masks.astype(np.uint8)
+
+  def __contains__(self, string: str) -> bool:
+    indices, masks = self._Locate(string)
+    return bool(np.all(self.bits[indices] & masks))
+
+  def Add(self, string: str) -> bool:
+    """Add a string to the filter.
+
+    Returns:
+      True if the string was added, else False if the string is already in
+      the filter, or is a false positive.
+    """
+    indices, masks = self._Locate(string)
+    if np.all(self.bits[indices] & masks):
+      return False
+    np.bitwise_or.at(self.bits, indices, masks)
+    self.count += 1
+    return True
+
+  def ToFile(self, path: pathlib.Path) -> None:
+    """Save the filter to a file.
+
+    The file is replaced atomically, so that an interrupted save does not
+    lose the previous contents of the file.
+    """
+    path = pathlib.Path(path)
+    temp_path = path.parent / f"{path.name}.tmp"
+    with open(temp_path, "wb") as f:
+      f.write(_HEADER.pack(_MAGIC, self.num_bits, self.num_hashes, self.count))
+      f.write(self.bits.tobytes())
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+  @classmethod
+  def FromFile(cls, path: pathlib.Path) -> "BloomFilter":
+    """Load a filter from a file.
+
+    Raises:
+      ValueError: If the file is not a Bloom filter.
+    """
+    data = pathlib.Path(path).read_bytes()
+    if len(data) < _HEADER.size:
+      raise ValueError(f"Invalid Bloom filter file: '{path}'")
+    magic, num_bits, num_hashes, count = _HEADER.unpack_from(data)
+    bits = np.frombuffer(data, dtype=np.uint8, offset=_HEADER.size).copy()
+    if magic != _MAGIC or bits.size != (num_bits + 7) // 8:
+      raise ValueError(f"Invalid Bloom filter file: '{path}'")
+    bloom_filter = cls.__new__(cls)
+    bloom_filter._Init(num_bits, num_hashes, bits)
+    bloom_filter.count = count
+    return bloom_filter
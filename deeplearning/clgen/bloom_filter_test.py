@@ -0,0 +1,76 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""Unit tests for //deeplearning/clgen:bloom_filter."""
+import pathlib
+
+from deeplearning.clgen import bloom_filter
+from labm8.py import app
+from labm8.py import test
+
+FLAGS = app.FLAGS
+
+pytest_plugins = ["deeplearning.clgen.tests.fixtures"]
+
+
+def test_BloomFilter_Add():
+  """Test that a string is only added once."""
+  bf = bloom_filter.BloomFilter(capacity=100)
+  assert "abc" not in bf
+  assert bf.Add("abc")
+  assert "abc" in bf
+  assert not bf.Add("abc")
+  assert bf.count == 1
+
+
+def test_BloomFilter_error_rate():
+  """Test that there are no false negatives, and few false positives."""
+  bf = bloom_filter.BloomFilter(capacity=1000, error_rate=0.01)
+  for i in range(1000):
+    bf.Add(str(i))
+  assert all(str(i) in bf for i in range(1000))
+  false_positives = sum(str(i) in bf for i in range(1000, 11000))
+  assert false_positives < 200
+
+
+def test_BloomFilter_invalid_arguments():
+  """Test that an error is raised for an invalid capacity or error rate."""
+  with test.Raises(ValueError):
+    bloom_filter.BloomFilter(capacity=0)
+  with test.Raises(ValueError):
+    bloom_filter.BloomFilter(error_rate=1)
+
+
+def test_BloomFilter_ToFile_FromFile(tempdir: pathlib.Path):
+  """Test that a filter can be saved and loaded."""
+  bf = bloom_filter.BloomFilter(capacity=100)
+  bf.Add("abc")
+  bf.ToFile(tempdir / "filter")
+  loaded = bloom_filter.BloomFilter.FromFile(tempdir / "filter")
+  assert "abc" in loaded
+  assert "def" not in loaded
+  assert loaded.count == 1
+  assert loaded.num_bits == bf.num_bits
+  assert loaded.num_hashes == bf.num_hashes
+
+
+def test_BloomFilter_FromFile_invalid(tempdir: pathlib.Path):
+  """Test that an error is raised if the file is not a filter."""
+  (tempdir / "filter").write_text("Hello, world!")
+  with test.Raises(ValueError):
+    bloom_filter.BloomFilter.FromFile(tempdir / "filter")
+
+
+if __name__ == "__main__":
+  test.Main()
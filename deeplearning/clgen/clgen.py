@@ -71,6 +71,36 @@ app.DEFINE_boolean(
 app.DEFINE_string(
   "sample_text_dir", None, "A directory to write plain text samples to."
 )
+app.DEFINE_string(
+  "sample_archive_dir",
+  None,
+  "A directory to write a packed archive of sample protos to.",
+)
+app.DEFINE_boolean(
+  "deduplicate_samples",
+  False,
+  "If set, samples which have been produced before are not printed, cached, "
+  "or written.",
+)
+app.DEFINE_string(
+  "deduplicate_samples_filter",
+  None,
+  "The path of a file to save the filter of --deduplicate_samples to, so that "
+  "samples are deduplicated across runs.",
+)
+app.DEFINE_boolean(
+  "count_unique_samples",
+  False,
+  "If set with --deduplicate_samples, only unique samples count towards "
+  "--min_samples.",
+)
+app.DEFINE_boolean(
+  "async_sample_observers",
+  False,
+  "If set, samples are printed, cached, and written to --sample_text_dir and "
+  "--sample_archive_dir by a background thread, so that sampling does not "
+  "wait on I/O.",
+)
 app.DEFINE_string(
   "stop_after",
   None,
@@ -338,17 +368,44 @@ def SampleObserversFromFlags() -> typing.List[
     sample_observers.append(
       sample_observers_lib.MaxSampleCountObserver(FLAGS.min_samples)
     )
+  # Observers which may be run in a background thread.
+  io_observers = []
   if FLAGS.print_samples:
-    sample_observers.append(sample_observers_lib.PrintSampleObserver())
+    io_observers.append(sample_observers_lib.PrintSampleObserver())
   if FLAGS.cache_samples:
-    sample_observers.append(sample_observers_lib.LegacySampleCacheObserver())
+    io_observers.append(sample_observers_lib.LegacySampleCacheObserver())
   if FLAGS.sample_text_dir:
-    sample_observers.append(
+    io_observers.append(
       sample_observers_lib.SaveSampleTextObserver(
         pathlib.Path(FLAGS.sample_text_dir)
       )
     )
-  return sample_observers
+  if FLAGS.sample_archive_dir:
+    io_observers.append(
+      sample_observers_lib.SampleArchiveObserver(
+        pathlib.Path(FLAGS.sample_archive_dir)
+      )
+    )
+  if FLAGS.async_sample_observers and io_observers:
+    io_observers = [sample_observers_lib.AsyncSampleObserver(io_observers)]
+  if FLAGS.deduplicate_samples:
+    filter_path = (
+      pathlib.Path(FLAGS.deduplicate_samples_filter)
+      if FLAGS.deduplicate_samples_filter
+      else None
+    )
+    if FLAGS.count_unique_samples:
+      return [
+        sample_observers_lib.DeduplicateSampleObserver(
+          sample_observers + io_observers, path=filter_path
+        )
+      ]
+    io_observers = [
+      sample_observers_lib.DeduplicateSampleObserver(
+        io_observers, path=filter_path
+      )
+    ]
+  return sample_observers + io_observers
 
 
 def DoFlagsAction(
@@ -412,7 +469,10 @@ def main():
     ConfigFromFlags(), dashboard_opts={"debug": FLAGS.clgen_dashboard_only,}
   )
   sample_observers = SampleObserversFromFlags()
-  DoFlagsAction(instance, sample_observers)
+  try:
+    DoFlagsAction(instance, sample_observers)
+  finally:
+    [obs.Close() for obs in sample_observers]
 
 
 if __name__ == "__main__":
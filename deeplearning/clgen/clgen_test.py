@@ -19,6 +19,7 @@ import tempfile
 
 from deeplearning.clgen import clgen
 from deeplearning.clgen import errors
+from deeplearning.clgen import sample_observers
 from deeplearning.clgen.proto import clgen_pb2
 from labm8.py import app
 from labm8.py import pbutil
@@ -120,6 +121,37 @@ def test_RunWithErrorHandling_exception_debug(clgen_cache_dir):
     clgen.RunWithErrorHandling(lambda a, b: a // b, 1, 0)
 
 
+def test_SampleObserversFromFlags_async_sample_observers():
+  """Test that only the I/O observers are run in a background thread."""
+  FLAGS.unparse_flags()
+  FLAGS(["argv0"])
+  FLAGS.min_samples = 10
+  FLAGS.async_sample_observers = True
+  observers = clgen.SampleObserversFromFlags()
+  assert [type(obs) for obs in observers] == [
+    sample_observers.MaxSampleCountObserver,
+    sample_observers.AsyncSampleObserver,
+  ]
+  assert [type(obs) for obs in observers[1].observers] == [
+    sample_observers.PrintSampleObserver
+  ]
+
+
+def test_SampleObserversFromFlags_count_unique_samples():
+  """Test that the sample count is deduplicated."""
+  FLAGS.unparse_flags()
+  FLAGS(["argv0"])
+  FLAGS.min_samples = 10
+  FLAGS.deduplicate_samples = True
+  FLAGS.count_unique_samples = True
+  observers = clgen.SampleObserversFromFlags()
+  assert len(observers) == 1
+  assert [type(obs) for obs in observers[0].observers] == [
+    sample_observers.MaxSampleCountObserver,
+    sample_observers.PrintSampleObserver,
+  ]
+
+
 # main tests.
 
 
@@ -0,0 +1,212 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""This file reads content files from tar archives without unpacking them.
+
+Archives are read as a stream, so that the members of a compressed archive are
+decompressed once, in order, and never written to disk.
+"""
+import datetime
+import hashlib
+import os
+import pathlib
+import tarfile
+import time
+import typing
+
+import sqlalchemy as sql
+from sqlalchemy.ext import declarative
+
+from deeplearning.clgen import errors
+from labm8.py import app
+from labm8.py import humanize
+from labm8.py import sqlutil
+
+FLAGS = app.FLAGS
+
+Base = declarative.declarative_base()
+
+
+def _MemberRelpath(name: str) -> str:
+  """Return the relative path of an archive member once unpacked.
+
+  This matches the paths produced by running `find .` in the directory that
+  the archive is unpacked into.
+  """
+  return "./" + os.path.normpath(name).lstrip("/")
+
+
+def IterateArchiveFiles(
+  archive: pathlib.Path,
+) -> typing.Iterator[typing.Tuple[str, bytes]]:
+  """Iterate over the regular files in a tar archive.
+
+  Links and other special files are skipped.
+
+  Args:
+    archive: The path of the archive.
+
+  Returns:
+    An iterator of <relpath, contents> tuples, in the order that files appear
+    in the archive.
+
+  Raises:
+    UserError: If the archive cannot be read.
+  """
+  try:
+    # Stream mode reads the archive sequentially, without seeking.
+    with tarfile.open(str(archive), "r|*") as tar:
+      for member in tar:
+        if member.isfile():
+          yield _MemberRelpath(member.name), tar.extractfile(member).read()
+  except (tarfile.TarError, EOFError, OSError):
+    raise errors.UserError(f"Archive unpack failed: '{archive}'")
+
+
+def GetArchiveContentId(archive: pathlib.Path) -> str:
+  """Compute the checksum of the contents of an archive.
+
+  The checksum is the same as the checksumdir.dirhash() of the directory that
+  the archive would be unpacked into, so that a corpus has the same content ID
+  whether it is delivered as a directory or an archive.
+
+  Args:
+    archive: The path of the archive.
+
+  Returns:
+    The hex encoded sha1 checksum of the archive contents.
+
+  Raises:
+    UserError: If the archive cannot be read.
+  """
+  # Map from member path to the checksum of its contents. Links are resolved
+  # after reading the archive, since their targets may come later.
+  digests: typing.Dict[str, str] = {}
+  directories: typing.Set[str] = set()
+  symlinks: typing.List[str] = []
+  hardlinks: typing.List[typing.Tuple[str, str]] = []
+  try:
+    with tarfile.open(str(archive), "r|*") as tar:
+      for member in tar:
+        name = os.path.normpath(member.name).lstrip("/")
+        if member.isfile():
+          hasher = hashlib.sha1()
+          f = tar.extractfile(member)
+          for block in iter(lambda: f.read(64 * 1024), b""):
+            hasher.update(block)
+          digests[name] = hasher.hexdigest()
+        elif member.isdir():
+          directories.add(name)
+        elif member.issym():
+          symlinks.append(
+            os.path.normpath(
+              os.path.join(os.path.dirname(name), member.linkname)
+            )
+          )
+        elif member.islnk():
+          hardlinks.append((name, os.path.normpath(member.linkname)))
+  except (tarfile.TarError, EOFError, OSError):
+    raise errors.UserError(f"Archive unpack failed: '{archive}'")
+
+  empty_digest = hashlib.sha1().hexdigest()
+  file_digests = list(digests.values())
+  file_digests += [digests.get(target, empty_digest) for _, target in hardlinks]
+  # A symlink to a directory is not hashed. A symlink to a file is hashed as
+  # the file, and a symlink to a path outside of the archive as an empty file.
+  file_digests += [
+    digests.get(target, empty_digest)
+    for target in symlinks
+    if target not in directories
+  ]
+  hasher = hashlib.sha1()
+  for digest in sorted(file_digests):
+    hasher.update(digest.encode("utf-8"))
+  return hasher.hexdigest()
+
+
+class ArchiveContentId(Base):
+  """The content ID of an archive."""
+
+  __tablename__ = "archive_content_ids"
+
+  # The absolute path of the archive.
+  path: str = sql.Column(sql.String(4096), primary_key=True)
+  size: int = sql.Column(sql.BigInteger, nullable=False)
+  # The number of nanoseconds since the epoch that the archive was modified.
+  mtime_ns: int = sql.Column(sql.BigInteger, nullable=False)
+  content_id: str = sql.Column(sql.String(40), nullable=False)
+  date_added: datetime.datetime = sql.Column(
+    sql.DateTime, nullable=False, default=datetime.datetime.utcnow
+  )
+
+
+class ArchiveContentIdCache(sqlutil.Database):
+  """A cache of archive content IDs, keyed by archive path, size, and mtime."""
+
+  def __init__(self, url: str, must_exist: bool = False):
+    super(ArchiveContentIdCache, self).__init__(
+      url, Base, must_exist=must_exist
+    )
+
+  def GetContentId(self, archive: pathlib.Path) -> str:
+    """Get the content ID of an archive.
+
+    The archive is only read if it is not in the cache, or if its size or
+    mtime has changed since it was cached.
+
+    Args:
+      archive: The path of the archive.
+
+    Returns:
+      The content ID of the archive. See GetArchiveContentId().
+
+    Raises:
+      UserError: If the archive does not exist or cannot be read.
+    """
+    if not archive.is_file():
+      raise errors.UserError(f"Archive not found: '{archive}'")
+    path = str(archive.absolute())
+    stat = archive.stat()
+    with self.Session(commit=True) as session:
+      entry = session.query(ArchiveContentId).filter(
+        ArchiveContentId.path == path
+      ).first()
+      if (
+        entry
+        and entry.size == stat.st_size
+        and entry.mtime_ns == stat.st_mtime_ns
+      ):
+        app.Log(2, "Archive content ID cache hit: '%s'", archive)
+        return entry.content_id
+
+      start_time = time.time()
+      content_id = GetArchiveContentId(archive)
+      app.Log(
+        1,
+        "Hashed archive '%s' in %s ms",
+        archive.name,
+        humanize.Commas(int((time.time() - start_time) * 1000)),
+      )
+      if entry:
+        session.delete(entry)
+        session.flush()
+      session.add(
+        ArchiveContentId(
+          path=path,
+          size=stat.st_size,
+          mtime_ns=stat.st_mtime_ns,
+          content_id=content_id,
+        )
+      )
+      return content_id
@@ -0,0 +1,101 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""Unit tests for //deeplearning/clgen/corpuses:archives."""
+import os
+import pathlib
+import tarfile
+
+import checksumdir
+
+from deeplearning.clgen import errors
+from deeplearning.clgen.corpuses import archives
+from labm8.py import app
+from labm8.py import test
+
+FLAGS = app.FLAGS
+
+pytest_plugins = ["deeplearning.clgen.tests.fixtures"]
+
+
+@test.Fixture(scope="function")
+def archive(tempdir: pathlib.Path) -> pathlib.Path:
+  """An archive of a directory containing files and links."""
+  (tempdir / "corpus" / "sub").mkdir(parents=True)
+  (tempdir / "corpus" / "a").write_text("The cat sat on the mat.")
+  (tempdir / "corpus" / "sub" / "b").write_text("Hello, world!")
+  os.symlink("a", tempdir / "corpus" / "link_to_a")
+  os.symlink("sub", tempdir / "corpus" / "link_to_sub")
+  os.symlink("/does/not/exist", tempdir / "corpus" / "broken_link")
+  with tarfile.open(tempdir / "corpus.tar.bz2", "w:bz2") as tar:
+    tar.add(tempdir / "corpus", arcname="corpus")
+  return tempdir / "corpus.tar.bz2"
+
+
+def test_IterateArchiveFiles(archive: pathlib.Path):
+  """Test that regular files are returned with their unpacked paths."""
+  assert sorted(archives.IterateArchiveFiles(archive)) == [
+    ("./corpus/a", b"The cat sat on the mat."),
+    ("./corpus/sub/b", b"Hello, world!"),
+  ]
+
+
+def test_IterateArchiveFiles_invalid_archive(tempdir: pathlib.Path):
+  """Test that an error is raised if the archive cannot be read."""
+  (tempdir / "empty.tar.bz2").touch()
+  with test.Raises(errors.UserError) as e_ctx:
+    list(archives.IterateArchiveFiles(tempdir / "empty.tar.bz2"))
+  assert str(e_ctx.value) == f"Archive unpack failed: '{tempdir}/empty.tar.bz2'"
+
+
+def test_GetArchiveContentId_matches_unpacked_directory(
+  archive: pathlib.Path, tempdir2: pathlib.Path
+):
+  """Test that the content ID is the checksum of the unpacked archive."""
+  with tarfile.open(archive) as tar:
+    tar.extractall(tempdir2)
+  assert archives.GetArchiveContentId(archive) == checksumdir.dirhash(
+    str(tempdir2), "sha1"
+  )
+
+
+def test_ArchiveContentIdCache_GetContentId(
+  archive: pathlib.Path, tempdir2: pathlib.Path
+):
+  """Test that content IDs are cached until the archive is modified."""
+  db = archives.ArchiveContentIdCache(f"sqlite:///{tempdir2}/cache.db")
+  content_id = db.GetContentId(archive)
+  assert content_id == archives.GetArchiveContentId(archive)
+  with db.Session() as session:
+    session.query(archives.ArchiveContentId).update(
+      {"content_id": "cached"}
+    )
+    session.commit()
+  assert db.GetContentId(archive) == "cached"
+
+  # Modifying the archive invalidates the cache.
+  os.utime(archive, ns=(0, 0))
+  assert db.GetContentId(archive) == content_id
+
+
+def test_ArchiveContentIdCache_GetContentId_not_found(tempdir: pathlib.Path):
+  """Test that an error is raised if the archive does not exist."""
+  db = archives.ArchiveContentIdCache(f"sqlite:///{tempdir}/cache.db")
+  with test.Raises(errors.UserError) as e_ctx:
+    db.GetContentId(tempdir / "missing.tar.bz2")
+  assert str(e_ctx.value) == f"Archive not found: '{tempdir}/missing.tar.bz2'"
+
+
+if __name__ == "__main__":
+  test.Main()
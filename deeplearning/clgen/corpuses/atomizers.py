@@ -135,8 +135,58 @@ class AtomizerBase(object):
       return pickle.load(infile)
 
 
+class CharacterLookupTables(typing.NamedTuple):
+  """Arrays for translating between characters and vocabulary indices."""
+
+  # A mapping from unicode code point to vocabulary index, where characters
+  # that are not in the vocabulary map to -1.
+  encoder: np.ndarray
+  # A mapping from vocabulary index to character.
+  decoder: np.ndarray
+  # A mask of the vocabulary indices which are present in the decoder.
+  decodable: np.ndarray
+
+  @classmethod
+  def FromVocab(cls, vocab: typing.Dict[str, int]) -> "CharacterLookupTables":
+    """Construct lookup tables from a vocabulary of single characters.
+
+    Raises:
+      InvalidVocab: If any of the atoms is not a single character.
+    """
+    if any(len(atom) != 1 for atom in vocab):
+      raise errors.InvalidVocab("all atoms must be single characters")
+    encoder = np.full(
+      max((ord(c) for c in vocab), default=-1) + 1, -1, dtype=np.int32
+    )
+    decoder = np.zeros(max(vocab.values(), default=-1) + 1, dtype="<U1")
+    decodable = np.zeros(len(decoder), dtype=np.bool_)
+    for char, index in vocab.items():
+      encoder[ord(char)] = index
+      decoder[index] = char
+      decodable[index] = True
+    return cls(encoder=encoder, decoder=decoder, decodable=decodable)
+
+
 class AsciiCharacterAtomizer(AtomizerBase):
-  """An atomizer for character-level syntactic modelling."""
+  """An atomizer for character-level syntactic modelling.
+
+  Encoding and decoding are performed as bulk array operations using lookup
+  tables which are derived from the vocabulary.
+  """
+
+  def _UpdateVocabulary(self) -> None:
+    """Private method which must be called if vocab is modified."""
+    super(AsciiCharacterAtomizer, self)._UpdateVocabulary()
+    # Lazily constructed by _GetLookupTables().
+    self._lookup_tables = None
+
+  def _GetLookupTables(self) -> CharacterLookupTables:
+    """Return the lookup tables, constructing them if required."""
+    # Atomizers which were pickled before the introduction of lookup tables
+    # do not have the attribute.
+    if getattr(self, "_lookup_tables", None) is None:
+      self._lookup_tables = CharacterLookupTables.FromVocab(self.vocab)
+    return self._lookup_tables
 
   def AtomizeString(self, text: str) -> np.array:
     """Atomize a text into an array of vocabulary indices.
@@ -147,10 +197,47 @@ class AsciiCharacterAtomizer(AtomizerBase):
     Returns:
       An array of indices into vocabulary for all atoms in text.
     """
-    try:
-      return np.array(list(map(lambda x: self.vocab[x], text)), dtype=np.int32)
-    except KeyError:
+    encoder = self._GetLookupTables().encoder
+    codepoints = np.frombuffer(
+      text.encode("utf-32-le", errors="surrogatepass"), dtype=np.uint32
+    )
+    if codepoints.size and codepoints.max() >= encoder.size:
       raise errors.VocabError
+    indices = encoder[codepoints]
+    if (indices < 0).any():
+      raise errors.VocabError
+    return indices
+
+  def DeatomizeIndices(self, encoded: np.array) -> str:
+    """Translate atomized code back into a string.
+
+    Args:
+      encoded: An nparray of encoded vocabulary indices.
+
+    Returns:
+      The decoded text.
+    """
+    indices = np.asarray(encoded)
+    # Non-integer arrays, such as those produced by np.zeros(), can't be used
+    # to index the lookup tables.
+    if indices.dtype.kind not in "iu":
+      return super(AsciiCharacterAtomizer, self).DeatomizeIndices(encoded)
+    if not indices.size:
+      return ""
+
+    tables = self._GetLookupTables()
+    if (
+      indices.min() < 0
+      or indices.max() >= tables.decoder.size
+      or not tables.decodable[indices].all()
+    ):
+      raise errors.VocabError
+    # A '<U1' array stores each character as a little-endian UTF-32 code unit.
+    return (
+      tables.decoder[indices]
+      .tobytes()
+      .decode("utf-32-le", errors="surrogatepass")
+    )
 
   def __repr__(self) -> str:
     return f"AsciiCharacterAtomizer[{self.vocab_size} chars]"
@@ -194,14 +281,6 @@ class GreedyAtomizer(AtomizerBase):
     Returns:
       An array of indices into vocabulary for all atoms in text.
     """
-
-    def _AddToVocab(token: str) -> int:
-      """Add a token to the vocabulary and return its index."""
-      if self.determine_chars and token not in self.vocab:
-        max_index = max(self.vocab.values())
-        self.vocab[token] = max_index + 1
-      return self.vocab[token]
-
     indices = []
     i = 0
     j = 2
@@ -222,11 +301,11 @@ class GreedyAtomizer(AtomizerBase):
               else:
                 j -= 1
             else:
-              indices.append(_AddToVocab(text[i]))
+              indices.append(self._AddToVocab(text[i]))
               i += 1
               j += 2
         else:
-          indices.append(_AddToVocab(text[i]))
+          indices.append(self._AddToVocab(text[i]))
           i += 1
           j += 2
     except KeyError:
@@ -237,6 +316,13 @@ class GreedyAtomizer(AtomizerBase):
 
     return np.array(indices, dtype=np.int32)
 
+  def _AddToVocab(self, token: str) -> int:
+    """Add a token to the vocabulary and return its index."""
+    if self.determine_chars and token not in self.vocab:
+      max_index = max(self.vocab.values())
+      self.vocab[token] = max_index + 1
+    return self.vocab[token]
+
   def __repr__(self) -> str:
     return f"GreedyAtomizer[{self.vocab_size} tokens]"
 
@@ -256,10 +342,78 @@ class GreedyAtomizer(AtomizerBase):
 
     # Instantiate a greedy atomizer using the full vocabulary.
     full_vocab = dict(zip(atoms, range(len(atoms))))
-    c = GreedyAtomizer(full_vocab, determine_chars=True)
+    c = cls(full_vocab, determine_chars=True)
     # Derive the subset of the vocabulary required to encode the given text.
     tokens = sorted(list(set(c.TokenizeString(text))))
     vocab_subset = dict(zip(tokens, range(len(tokens))))
     end_time = labdate.MillisecondsTimestamp()
     # Return a new atomizer using the subset vocabulary.
-    return GreedyAtomizer(vocab_subset)
+    return cls(vocab_subset)
+
+
+class TrieGreedyAtomizer(GreedyAtomizer):
+  """A greedy atomizer which matches multi-character tokens using a prefix tree.
+
+  This produces identical encodings to GreedyAtomizer, but rather than testing
+  every candidate token which shares a first character at each position in the
+  text, the longest matching token is found by walking a trie of the
+  multi-character tokens. Each position is then matched in time proportional to
+  the length of the longest match, not the size of the vocabulary.
+  """
+
+  def __init__(self, vocab: typing.Dict[str, int], determine_chars=False):
+    super(TrieGreedyAtomizer, self).__init__(vocab, determine_chars)
+
+    # A nested dictionary of characters. A node which terminates a
+    # multi-character token contains the vocabulary index of that token under
+    # the key None.
+    self.trie = {}
+    for atom in self.atoms:
+      if len(atom) > 1:
+        node = self.trie
+        for char in atom:
+          node = node.setdefault(char, {})
+        node[None] = self.vocab[atom]
+
+  def AtomizeString(self, text: str) -> np.array:
+    """Atomize a text into an array of vocabulary indices.
+
+    Args:
+      text: Input text.
+
+    Returns:
+      An array of indices into vocabulary for all atoms in text.
+    """
+    indices = []
+    i = 0
+    text_length = len(text)
+    try:
+      while i < text_length:
+        # Walk the trie for as long as the text matches, recording the end of
+        # the longest multi-character token seen.
+        node = self.trie
+        match_index, match_end = None, i
+        j = i
+        while j < text_length:
+          node = node.get(text[j])
+          if node is None:
+            break
+          j += 1
+          if None in node:
+            match_index, match_end = node[None], j
+        if match_index is None:
+          indices.append(self._AddToVocab(text[i]))
+          i += 1
+        else:
+          indices.append(match_index)
+          i = match_end
+    except KeyError:
+      raise errors.VocabError
+
+    if self.determine_chars:
+      self._UpdateVocabulary()
+
+    return np.array(indices, dtype=np.int32)
+
+  def __repr__(self) -> str:
+    return f"TrieGreedyAtomizer[{self.vocab_size} tokens]"
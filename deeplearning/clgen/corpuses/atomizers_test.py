@@ -17,6 +17,8 @@ import json
 import pathlib
 import tempfile
 
+import numpy as np
+
 import deeplearning.clgen.errors
 from deeplearning.clgen.corpuses import atomizers
 from labm8.py import app
@@ -99,6 +101,29 @@ def test_AsciiCharacterAtomizer_DeatomizeIndices_error():
     c.DeatomizeIndices([1, 2, 5, 10, 0])
 
 
+def test_AsciiCharacterAtomizer_DeatomizeIndices_missing_index_error():
+  """Test that an index which is within range but not in vocab is an error."""
+  c = atomizers.AsciiCharacterAtomizer({"a": 1, "b": 3})
+  with test.Raises(deeplearning.clgen.errors.VocabError):
+    c.DeatomizeIndices(np.array([1, 2, 3], dtype=np.int32))
+
+
+def test_AsciiCharacterAtomizer_non_ascii_round_trip():
+  """Test encoding and decoding characters outside of the ASCII range."""
+  text = "ab\u00e9\u4e2d\U0001f600a"
+  c = atomizers.AsciiCharacterAtomizer.FromText(text)
+  encoded = c.AtomizeString(text)
+  assert encoded.dtype == np.int32
+  assert list(encoded) == [c.vocab[x] for x in text]
+  assert c.DeatomizeIndices(encoded) == text
+
+
+def test_AsciiCharacterAtomizer_empty_string():
+  c = atomizers.AsciiCharacterAtomizer({"a": 1, "b": 2, "c": 3})
+  assert list(c.AtomizeString("")) == []
+  assert c.DeatomizeIndices(np.array([], dtype=np.int32)) == ""
+
+
 # GreedyAtomizer
 
 
@@ -299,5 +324,49 @@ __kernel void A(__global float* a, __global float* b, const int c) {
   assert c.vocab_size == len(tokens)
 
 
+# TrieGreedyAtomizer
+
+
+def test_TrieGreedyAtomizer_TokenizeString_1():
+  """Test that tokenization matches the GreedyAtomizer."""
+  test_vocab = {"abc": 1, "a": 2, "b": 3, "ab": 4, "c": 5, "cab": 6, " ": 7}
+  test_in = "abcababbaabcabcaabccccabcabccabcccabcabc"
+  c1 = atomizers.GreedyAtomizer(test_vocab)
+  c2 = atomizers.TrieGreedyAtomizer(test_vocab)
+  assert c2.TokenizeString(test_in) == c1.TokenizeString(test_in)
+
+
+def test_TrieGreedyAtomizer_TokenizeString_2():
+  test_vocab = {"volatile": 0, "voletile": 1, "vo": 2, " ": 3, "l": 4}
+  test_in = "volatile voletile vol "
+  test_out = ["volatile", " ", "voletile", " ", "vo", "l", " "]
+  c = atomizers.TrieGreedyAtomizer(test_vocab)
+  assert c.TokenizeString(test_in) == test_out
+
+
+def test_TrieGreedyAtomizer_AtomizeString_vocab_error():
+  c = atomizers.TrieGreedyAtomizer({"ab": 0, "a": 1, "b": 2})
+  with test.Raises(deeplearning.clgen.errors.VocabError):
+    c.AtomizeString("abc")
+
+
+def test_TrieGreedyAtomizer_FromText_equivalence():
+  """Test that the derived vocabulary and encoding match GreedyAtomizer."""
+  test_in = """\
+__kernel void A(__global float* a, __global float* b, const int c) {
+  int d = get_global_id(0);
+  if (d < c) {
+    a[d] = b[d] * 10.0f;
+  }
+}\
+"""
+  c1 = atomizers.GreedyAtomizer.FromText(test_in, OPENCL_ATOMS)
+  c2 = atomizers.TrieGreedyAtomizer.FromText(test_in, OPENCL_ATOMS)
+  assert type(c2) == atomizers.TrieGreedyAtomizer
+  assert c2.vocab == c1.vocab
+  assert list(c2.AtomizeString(test_in)) == list(c1.AtomizeString(test_in))
+  assert c2.DeatomizeIndices(c2.AtomizeString(test_in)) == test_in
+
+
 if __name__ == "__main__":
   test.Main()
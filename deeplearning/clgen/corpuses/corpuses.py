@@ -20,20 +20,20 @@ is a file containing text to train over.
 import os
 import pathlib
 import random
-import subprocess
 import tempfile
 import time
 import typing
 
-import checksumdir
 import numpy as np
 from sqlalchemy.sql.expression import func
 
 from deeplearning.clgen import cache
 from deeplearning.clgen import errors
+from deeplearning.clgen.corpuses import archives
 from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.corpuses import encoded
 from deeplearning.clgen.corpuses import preprocessed
+from deeplearning.clgen.corpuses import preprocessing_cache
 from deeplearning.clgen.dashboard import dashboard_db
 from deeplearning.clgen.preprocessors import preprocessors
 from deeplearning.clgen.proto import corpus_pb2
@@ -79,6 +79,10 @@ def AssertConfigIsValid(config: corpus_pb2.Corpus) -> corpus_pb2.Corpus:
     # TODO(github.com/ChrisCummins/clgen/issues/130): Refactor after splitting
     # Corpus class.
     if config.HasField("pre_encoded_corpus_url"):
+      if config.HasField("parent_content_id"):
+        raise errors.UserError(
+          "Corpus.parent_content_id cannot be used with pre_encoded_corpus_url"
+        )
       return config
 
     pbutil.AssertFieldIsSet(config, "contentfiles")
@@ -137,9 +141,12 @@ class Corpus(object):
     self.dashboard_db = dashboard_db.GetDatabase()
     self._dashboard_db_id: typing.Optional[int] = None  # Set in Create()
 
-    # An in-memory cache of the encoded contentfiles indices arrays.
-    # Set and used in GetTrainingData().
-    self._indices_arrays: typing.Optional[typing.List[np.array]] = None
+    # The memory-mapped token file of the encoded corpus. Set and used in
+    # GetTrainingData().
+    self._token_file: typing.Optional[encoded.EncodedTokenFile] = None
+    # The scratch array which GetTrainingData() writes shuffled training data
+    # to. It is allocated once and reused by every shuffle.
+    self._shuffled_tokens: typing.Optional[np.ndarray] = None
 
     cache.cachepath("corpus").mkdir(parents=True, exist_ok=True)
     hc = hashcache.HashCache(cache.cachepath("hashcache.db"), "sha1")
@@ -200,6 +207,33 @@ class Corpus(object):
     self.atomizer_path = cache.cachepath(
       "corpus", "encoded", encoded_id, "atomizer.pkl"
     )
+    self.token_file_path = cache.cachepath(
+      "corpus", "encoded", encoded_id, "tokens"
+    )
+    # The databases of the parent corpus, if creating incrementally.
+    self._parent_preprocessed: typing.Optional[
+      preprocessed.PreprocessedContentFiles
+    ] = None
+    self._parent_encoded_dir: typing.Optional[pathlib.Path] = None
+    if self.config.HasField("parent_content_id"):
+      parent_preprocessed_db_path = cache.cachepath(
+        "corpus",
+        "preprocessed",
+        ResolvePreprocessedId(self.config.parent_content_id, self.config),
+        "preprocessed.db",
+      )
+      if not parent_preprocessed_db_path.is_file():
+        raise errors.UserError(
+          f"Parent content ID not found: '{self.config.parent_content_id}'"
+        )
+      self._parent_preprocessed = preprocessed.PreprocessedContentFiles(
+        f"sqlite:///{parent_preprocessed_db_path}", must_exist=True
+      )
+      self._parent_encoded_dir = cache.cachepath(
+        "corpus",
+        "encoded",
+        ResolveEncodedId(self.config.parent_content_id, self.config),
+      )
     # Create symlink to preprocessed files.
     # TODO(github.com/ChrisCummins/clgen/issues/130): Refactor this conditional
     # logic after splitting Corpus class.
@@ -265,7 +299,13 @@ class Corpus(object):
       pathlib.Path(self.preprocessed.url[len("sqlite:///") :]).parent / "LOCK"
     )
     with lockfile.LockFile(preprocessed_lock_path):
-      self.preprocessed.Create(self.config)
+      self.preprocessed.Create(
+        self.config,
+        cache=preprocessing_cache.PreprocessingCache(
+          f"sqlite:///{cache.cachepath('corpus', 'preprocessing_cache.db')}"
+        ),
+        parent=self._parent_preprocessed,
+      )
     if not self.preprocessed.size:
       raise errors.EmptyCorpusException(
         f"Pre-processed corpus contains no files: '{self.preprocessed.url}'"
@@ -284,7 +324,10 @@ class Corpus(object):
         humanize.Commas(int((time.time() - start_time) * 1000)),
       )
       self.encoded.Create(
-        self.preprocessed, atomizer, self.config.contentfile_separator
+        self.preprocessed,
+        atomizer,
+        self.config.contentfile_separator,
+        parent=self._GetParentEncoded(atomizer),
       )
 
     # Add entry to dashboard database
@@ -307,6 +350,37 @@ class Corpus(object):
       session.flush()
       self._dashboard_db_id = corpus.id
 
+  def _GetParentEncoded(
+    self, atomizer: atomizers.AtomizerBase
+  ) -> typing.Optional[encoded.ParentCorpus]:
+    """Return the parent corpus to copy encoded files from.
+
+    Args:
+      atomizer: The atomizer of this corpus.
+
+    Returns:
+      The parent corpus, or None if there is no parent to copy encoded files
+      from.
+    """
+    if not self._parent_encoded_dir:
+      return None
+    parent_atomizer_path = self._parent_encoded_dir / "atomizer.pkl"
+    parent_encoded_db_path = self._parent_encoded_dir / "encoded.db"
+    if not (
+      parent_atomizer_path.is_file() and parent_encoded_db_path.is_file()
+    ):
+      return None
+    return encoded.ParentCorpus(
+      encoded_db=encoded.EncodedContentFiles(
+        f"sqlite:///{parent_encoded_db_path}", must_exist=True
+      ),
+      preprocessed_db=self._parent_preprocessed,
+      index_map=encoded.GetVocabIndexMap(
+        atomizers.AtomizerBase.FromFile(parent_atomizer_path).vocab,
+        atomizer.vocab,
+      ),
+    )
+
   @property
   def dashboard_db_id(self) -> int:
     if not self._created:
@@ -348,30 +422,59 @@ class Corpus(object):
   def GetTrainingData(self, shuffle: bool) -> np.ndarray:
     """Concatenate the entire encoded corpus into an array.
 
+    The encoded corpus is read from a memory-mapped token file, so this does not
+    require the corpus to fit in system memory.
+
     Args:
       shuffle: If true, randomize order of encoded contentfiles.
 
     Returns:
-      The encoded corpus.
+      The encoded corpus. If not shuffled, this is a read-only memory-mapped
+      array. If shuffled, this is a writable memory-mapped scratch array which
+      is reused by the next call with shuffle=True, so the contents of an
+      array returned by a previous shuffle are overwritten.
     """
     with prof.Profile("GetTrainingData()"):
-      # Load all indices from the database into memory, and keep them there.
-      # This is to remove the latency from reading the contents from a
-      # database.
-      #
-      # TODO(https://github.com/ChrisCummins/clgen/issues/128): Storing the
-      # entire corpus in memory like this prevents training on corpuses larger
-      # than system memory. Replace this method with an interface for streaming
-      # data from the encoded database.
-      if not self._indices_arrays:
-        with self.encoded.Session() as session:
-          query = session.query(encoded.EncodedContentFile)
-          self._indices_arrays = [x.indices_array for x in query]
+      token_file = self.token_file
+      if not shuffle:
+        return token_file.tokens
+
+      # Shuffle the order of contentfiles by permuting their offsets, and write
+      # the shuffled corpus to a memory-mapped scratch file. The scratch file is
+      # unlinked immediately, so its disk space is reclaimed once this corpus
+      # is no longer referenced.
+      order = list(range(token_file.num_contentfiles))
+      random.shuffle(order)
+      if self._shuffled_tokens is None:
+        fd, scratch_path = tempfile.mkstemp(
+          prefix="shuffled_", suffix=".npy", dir=self.token_file_path
+        )
+        os.close(fd)
+        try:
+          self._shuffled_tokens = np.lib.format.open_memmap(
+            scratch_path,
+            mode="w+",
+            dtype=token_file.tokens.dtype,
+            shape=token_file.tokens.shape,
+          )
+        finally:
+          os.unlink(scratch_path)
+      return token_file.Gather(order, out=self._shuffled_tokens)
 
-      if shuffle:
-        random.shuffle(self._indices_arrays)
+  @property
+  def token_file(self) -> encoded.EncodedTokenFile:
+    """The memory-mapped token file of the encoded corpus.
 
-      return np.concatenate(self._indices_arrays)
+    The token file is built from the encoded database on first use. Must call
+    Create() first.
+    """
+    if self._token_file is None:
+      self.token_file_path.mkdir(parents=True, exist_ok=True)
+      with lockfile.LockFile(self.token_file_path / "LOCK"):
+        if not encoded.EncodedTokenFile.IsBuilt(self.token_file_path):
+          encoded.EncodedTokenFile.Build(self.encoded, self.token_file_path)
+      self._token_file = encoded.EncodedTokenFile(self.token_file_path)
+    return self._token_file
 
   def GetNumContentFiles(self) -> int:
     """Get the number of contentfiles which were pre-processed."""
@@ -397,6 +500,17 @@ class Corpus(object):
     if self._atomizer is None:
       if self.atomizer_path.is_file():
         self._atomizer = atomizers.AtomizerBase.FromFile(self.atomizer_path)
+        # The greedy atomizer engine is excluded from the corpus hash, so the
+        # cached atomizer may use a different engine than the one requested.
+        if isinstance(self._atomizer, atomizers.GreedyAtomizer):
+          atomizer_class = GetGreedyAtomizerClass(
+            self.config.greedy_multichar_atomizer
+          )
+          if type(self._atomizer) is not atomizer_class:
+            self._atomizer = atomizer_class(
+              self._atomizer.vocab,
+              determine_chars=self._atomizer.determine_chars,
+            )
       else:
         self._atomizer = self._CreateAtomizer()
     return self._atomizer
@@ -410,12 +524,16 @@ class Corpus(object):
       atomizer = atomizers.AsciiCharacterAtomizer.FromText(corpus_txt)
     elif self.config.HasField("greedy_multichar_atomizer"):
       atoms = set(self.config.greedy_multichar_atomizer.tokens)
-      atomizer = atomizers.GreedyAtomizer.FromText(corpus_txt, atoms)
+      atomizer = GetGreedyAtomizerClass(
+        self.config.greedy_multichar_atomizer
+      ).FromText(corpus_txt, atoms)
     elif self.config.HasField("pre_encoded_corpus_url"):
       encoded_db = encoded.EncodedContentFiles(
         self.config.pre_encoded_corpus_url
       )
-      atomizer = GreedyAtomizerFromEncodedDb(encoded_db)
+      atomizer = GreedyAtomizerFromEncodedDb(
+        encoded_db, self.config.greedy_multichar_atomizer
+      )
     else:
       raise NotImplementedError
 
@@ -456,14 +574,37 @@ def StoreVocabInMetaTable(
   return encoded.EncodedContentFiles.StoreVocabInMetaTable(session, vocabulary)
 
 
-def GreedyAtomizerFromEncodedDb(encoded_db: encoded.EncodedContentFiles):
-  """Create a greedy atomizer for the vocabulary of a given encoded_db."""
+def GreedyAtomizerFromEncodedDb(
+  encoded_db: encoded.EncodedContentFiles,
+  config: typing.Optional[corpus_pb2.GreedyMulticharAtomizer] = None,
+) -> atomizers.GreedyAtomizer:
+  """Create a greedy atomizer for the vocabulary of a given encoded_db.
+
+  Args:
+    encoded_db: The encoded database to read the vocabulary from.
+    config: The greedy atomizer config, which selects the matching engine. If
+      not set, the default engine is used.
+
+  Returns:
+    A greedy atomizer.
+  """
   # TODO(github.com/ChrisCummins/clgen/issues/130): This should be a method of
   # a concrete `DatabaseCorpus` class.
   with encoded_db.Session() as s:
     vocab = GetVocabFromMetaTable(s)
   app.Log(1, "Loaded vocabulary of %s tokens from meta table", len(vocab))
-  return atomizers.GreedyAtomizer(vocab)
+  return GetGreedyAtomizerClass(
+    config or corpus_pb2.GreedyMulticharAtomizer()
+  )(vocab)
+
+
+def GetGreedyAtomizerClass(
+  config: corpus_pb2.GreedyMulticharAtomizer,
+) -> typing.Type[atomizers.GreedyAtomizer]:
+  """Return the greedy atomizer class for the requested matching engine."""
+  if config.engine == corpus_pb2.GreedyMulticharAtomizer.PREFIX_TRIE:
+    return atomizers.TrieGreedyAtomizer
+  return atomizers.GreedyAtomizer
 
 
 def ExpandConfigPath(path: str, path_prefix: str = None) -> pathlib.Path:
@@ -522,34 +663,18 @@ def ResolveContentId(
       config.local_directory, path_prefix=FLAGS.clgen_local_path_prefix
     )
 
-    # After the first time we compute the hash of a directory, we write it into
-    # a file. This is a shortcut to work around the fact that computing the
-    # directory checksum is O(n) with respect to the number of files in the
-    # directory (even if the directory is already cached by the hash cache).
-    # This means that it is the responsibility of the user to delete this cached
-    # file if the directory is changed.
-    hash_file_path = pathlib.Path(str(local_directory) + ".sha1.txt")
-    if hash_file_path.is_file():
-      app.Log(1, "Reading directory hash: '%s'.", hash_file_path)
-      with open(hash_file_path) as f:
-        content_id = f.read().rstrip()
-    else:
-      # No hash file, so compute the directory hash and create it.
-      try:
-        content_id = hc.GetHash(local_directory)
-      except FileNotFoundError as e:
-        raise errors.UserError(e)
-      # Create the hash file in the directory so that next time we don't need
-      # to reference the hash cache.
-      with open(hash_file_path, "w") as f:
-        print(content_id, file=f)
-      app.Log(1, "Wrote directory hash: '%s'.", hash_file_path)
+    # The hash cache keeps a manifest of the files in the directory, so only
+    # files which have been modified since the last hash are read.
+    try:
+      content_id = hc.GetHash(local_directory)
+    except FileNotFoundError as e:
+      raise errors.UserError(e)
   elif config.HasField("local_tar_archive"):
-    # This if not an efficient means of getting the hash, as it requires always
-    # unpacking the archive and reading the entire contents. It would be nicer
-    # to maintain a cache which maps the mtime of tarballs to their content ID,
-    # similart to how local_directory is implemented.
-    content_id = GetHashOfArchiveContents(
+    # The archive is only read if its size or mtime has changed since the last
+    # time its content ID was resolved.
+    content_id = archives.ArchiveContentIdCache(
+      f"sqlite:///{cache.cachepath('corpus', 'archive_content_ids.db')}"
+    ).GetContentId(
       ExpandConfigPath(
         config.local_tar_archive, path_prefix=FLAGS.clgen_local_path_prefix
       )
@@ -591,30 +716,12 @@ def ResolveEncodedId(content_id: str, config: corpus_pb2.Corpus) -> str:
   # files delivered through different means (e.g. two separate but identical
   # directories) have the same hash.
   config_without_contentfiles.ClearField("contentfiles")
+  # The choice of greedy atomizer engine does not affect the encoded output, so
+  # it is excluded from the hash. Likewise, a corpus created incrementally from
+  # a parent is identical to one created from scratch.
+  if config_without_contentfiles.HasField("greedy_multichar_atomizer"):
+    config_without_contentfiles.greedy_multichar_atomizer.ClearField("engine")
+  config_without_contentfiles.ClearField("parent_content_id")
   return crypto.sha1_list(
     content_id, config_without_contentfiles.SerializeToString()
   )
-
-
-def GetHashOfArchiveContents(archive: pathlib.Path) -> str:
-  """Compute the checksum of the contents of a directory.
-
-  Args:
-    archive: Path of the archive.
-
-  Returns:
-    Checksum of the archive.
-
-  Raises:
-    UserError: If the requested archive does not exist, or cannot be unpacked.
-  """
-  if not archive.is_file():
-    raise errors.UserError(f"Archive not found: '{archive}'")
-
-  with tempfile.TemporaryDirectory(prefix="clgen_corpus_") as d:
-    cmd = ["tar", "-xf", str(archive), "-C", d]
-    try:
-      subprocess.check_call(cmd)
-    except subprocess.CalledProcessError:
-      raise errors.UserError(f"Archive unpack failed: '{archive}'")
-    return checksumdir.dirhash(d, "sha1")
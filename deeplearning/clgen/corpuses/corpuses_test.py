@@ -16,9 +16,14 @@
 import datetime
 import os
 import pathlib
+import shutil
 import tempfile
+import typing
+
+import numpy as np
 
 from deeplearning.clgen import errors
+from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.corpuses import corpuses
 from deeplearning.clgen.corpuses import encoded
 from deeplearning.clgen.corpuses import preprocessed
@@ -167,6 +172,39 @@ def test_Corpus_config_hash_different_options(
   assert c1.hash != c3.hash
 
 
+def test_Corpus_config_hash_greedy_atomizer_engine(
+  clgen_cache_dir, abc_corpus_config
+):
+  """Test that the corpus ID is not changed by the greedy atomizer engine."""
+  del clgen_cache_dir
+  abc_corpus_config.greedy_multichar_atomizer.tokens[:] = ["a", "ab"]
+  c1 = corpuses.Corpus(abc_corpus_config)
+  abc_corpus_config.greedy_multichar_atomizer.engine = (
+    corpus_pb2.GreedyMulticharAtomizer.PREFIX_TRIE
+  )
+  c2 = corpuses.Corpus(abc_corpus_config)
+  assert c1.hash == c2.hash
+
+
+def test_Corpus_atomizer_greedy_atomizer_engine(
+  clgen_cache_dir, abc_corpus_config
+):
+  """Test that changing the engine of an existing corpus takes effect."""
+  del clgen_cache_dir
+  abc_corpus_config.greedy_multichar_atomizer.tokens[:] = ["a", "ab"]
+  c1 = corpuses.Corpus(abc_corpus_config)
+  c1.Create()
+  assert type(c1.atomizer) is atomizers.GreedyAtomizer
+
+  abc_corpus_config.greedy_multichar_atomizer.engine = (
+    corpus_pb2.GreedyMulticharAtomizer.PREFIX_TRIE
+  )
+  c2 = corpuses.Corpus(abc_corpus_config)
+  c2.Create()
+  assert type(c2.atomizer) is atomizers.TrieGreedyAtomizer
+  assert c2.atomizer.vocab == c1.atomizer.vocab
+
+
 def test_Corpus_equality(clgen_cache_dir, abc_corpus_config):
   """Test that two corpuses with identical options are equivalent."""
   del clgen_cache_dir
@@ -251,38 +289,27 @@ def test_Corpus_content_id(clgen_cache_dir, abc_corpus_config):
   assert c1.hash == c2.hash
 
 
-def test_Corpus_hash_file(clgen_cache_dir, abc_corpus_config):
-  """Test that content id is written to a file."""
+def test_Corpus_no_hash_file(clgen_cache_dir, abc_corpus_config):
+  """Test that content id is not written to a file beside the directory."""
   del clgen_cache_dir
   hash_file_path = pathlib.Path(
     str(pathlib.Path(abc_corpus_config.local_directory)) + ".sha1.txt"
   )
+  corpuses.Corpus(abc_corpus_config)
   assert not hash_file_path.is_file()
-  c = corpuses.Corpus(abc_corpus_config)
-  assert hash_file_path.is_file()
-  with open(hash_file_path) as f:
-    content_id = f.read().strip()
-  assert c.content_id == content_id
-
 
-def test_Corpus_stale_hash_file(clgen_cache_dir, abc_corpus_config):
-  """Test that content_id does not change
 
-  This is to emphasize a limitation in the checksum caching methodology. An
-  ideal system would break this test, since the directory has been modified.
-  However, since we write the directory checksum to a file, the content id does
-  not change.
-  """
+def test_Corpus_modified_directory_content_id(
+  clgen_cache_dir, abc_corpus_config
+):
+  """Test that content_id changes when the directory is modified."""
   del clgen_cache_dir
   c1 = corpuses.Corpus(abc_corpus_config)
   c1.Create()
   with open(pathlib.Path(abc_corpus_config.local_directory) / "z", "w") as f:
     f.write("this directory has been modified\n")
   c2 = corpuses.Corpus(abc_corpus_config)
-  # Even though we have modified the content files directory, this change is not
-  # reflected in the content id, since we use the file created during the
-  # instantiation of c1.
-  assert c1.content_id == c2.content_id
+  assert c1.content_id != c2.content_id
 
 
 def test_Corpus_invalid_content_id(clgen_cache_dir, abc_corpus_config):
@@ -436,7 +463,8 @@ def abc_pre_encoded() -> str:
     with db.Session(commit=True) as s:
       s.add(
         encoded.EncodedContentFile(
-          data="0.1.2.0.1",
+          data=np.array([0, 1, 2, 0, 1], dtype=np.int16).tobytes(),
+          data_itemsize=2,
           tokencount=5,
           encoding_time_ms=10,
           wall_time_ms=10,
@@ -445,7 +473,8 @@ def abc_pre_encoded() -> str:
       )
       s.add(
         encoded.EncodedContentFile(
-          data="2.2.2",
+          data=np.array([2, 2, 2], dtype=np.int16).tobytes(),
+          data_itemsize=2,
           tokencount=3,
           encoding_time_ms=10,
           wall_time_ms=10,
@@ -455,6 +484,80 @@ def abc_pre_encoded() -> str:
     yield db.url
 
 
+def test_Corpus_parent_content_id_not_found(clgen_cache_dir, abc_corpus):
+  """Test that an unknown parent corpus raises an error."""
+  del clgen_cache_dir
+  with test.Raises(errors.UserError) as e_info:
+    corpuses.Corpus(
+      corpus_pb2.Corpus(
+        local_directory=abc_corpus,
+        ascii_character_atomizer=True,
+        contentfile_separator="\n\n",
+        parent_content_id="0" * 40,
+      )
+    )
+  assert "Parent content ID not found" in str(e_info.value)
+
+
+def test_Corpus_parent_content_id_copies_unchanged_files(
+  clgen_cache_dir, abc_corpus, tempdir: pathlib.Path
+):
+  """Test creating a corpus incrementally from a parent corpus."""
+  del clgen_cache_dir
+  config = corpus_pb2.Corpus(
+    local_directory=abc_corpus,
+    ascii_character_atomizer=True,
+    contentfile_separator="\n\n",
+  )
+  parent = corpuses.Corpus(config)
+  parent.Create()
+
+  shutil.copytree(abc_corpus, tempdir / "child")
+  # Removes the only 'd' character from the vocabulary.
+  (tempdir / "child" / "b").write_text("Hello, there!")
+  (tempdir / "child" / "d").write_text("A new file.")
+  config.local_directory = str(tempdir / "child")
+  config.parent_content_id = parent.content_id
+  child = corpuses.Corpus(config)
+  # The parent does not change the hash of the corpus.
+  config.ClearField("parent_content_id")
+  assert child.hash == corpuses.ResolveEncodedId(child.content_id, config)
+  child.Create()
+
+  decoded = child.atomizer.DeatomizeIndices(child.GetTrainingData(shuffle=False))
+  assert sorted(decoded.split("\n\n")[:-1]) == [
+    "\nSuch corpus.\nVery wow.",
+    "A new file.",
+    "Hello, there!",
+    "The cat sat on the mat.",
+  ]
+
+  # Copied rows retain the date that they were added to the parent.
+  def DatesAdded(
+    c: corpuses.Corpus, relpath: str
+  ) -> typing.Tuple[datetime.datetime, datetime.datetime]:
+    with c.preprocessed.Session() as session:
+      id, preprocessed_date = (
+        session.query(
+          preprocessed.PreprocessedContentFile.id,
+          preprocessed.PreprocessedContentFile.date_added,
+        )
+        .filter(preprocessed.PreprocessedContentFile.input_relpath == relpath)
+        .one()
+      )
+    with c.encoded.Session() as session:
+      encoded_date = (
+        session.query(encoded.EncodedContentFile.date_added)
+        .filter(encoded.EncodedContentFile.id == id)
+        .scalar()
+      )
+    return preprocessed_date, encoded_date
+
+  assert DatesAdded(child, "./a") == DatesAdded(parent, "./a")
+  assert DatesAdded(child, "./b")[0] != DatesAdded(parent, "./b")[0]
+  assert DatesAdded(child, "./b")[1] != DatesAdded(parent, "./b")[1]
+
+
 def test_Corpus_pre_encoded_corpus_url_GetTrainingData(abc_pre_encoded):
   """Test the training data accessor of a pre-encoded corpus."""
   c = corpuses.Corpus(corpus_pb2.Corpus(pre_encoded_corpus_url=abc_pre_encoded))
@@ -463,5 +566,27 @@ def test_Corpus_pre_encoded_corpus_url_GetTrainingData(abc_pre_encoded):
   assert len(c.GetTrainingData(shuffle=True)) == 8
 
 
+def test_Corpus_pre_encoded_corpus_url_GetTrainingData_shuffle(
+  abc_pre_encoded,
+):
+  """Test that shuffling the training data reorders whole contentfiles."""
+  c = corpuses.Corpus(corpus_pb2.Corpus(pre_encoded_corpus_url=abc_pre_encoded))
+  c.Create()
+  assert isinstance(c.GetTrainingData(shuffle=False), np.memmap)
+  assert c.GetTrainingData(shuffle=False).tolist() == [0, 1, 2, 0, 1, 2, 2, 2]
+  assert sorted(
+    tuple(c.GetTrainingData(shuffle=True).tolist()) for _ in range(20)
+  )[-1] == (2, 2, 2, 0, 1, 2, 0, 1)
+
+
+def test_Corpus_pre_encoded_corpus_url_GetTrainingData_shuffle_reuses_array(
+  abc_pre_encoded,
+):
+  """Test that every shuffle writes to the same scratch array."""
+  c = corpuses.Corpus(corpus_pb2.Corpus(pre_encoded_corpus_url=abc_pre_encoded))
+  c.Create()
+  assert c.GetTrainingData(shuffle=True) is c.GetTrainingData(shuffle=True)
+
+
 if __name__ == "__main__":
   test.Main()
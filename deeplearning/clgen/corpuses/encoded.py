@@ -15,7 +15,10 @@
 """This file defines a database for encoded content files."""
 import datetime
 import multiprocessing
+import os
+import pathlib
 import pickle
+import threading
 import time
 import typing
 
@@ -35,6 +38,18 @@ from labm8.py import sqlutil
 
 FLAGS = app.FLAGS
 
+app.DEFINE_integer(
+  "encoder_read_batch_size",
+  1000,
+  "The number of preprocessed files to read from the database at a time when "
+  "encoding a corpus.",
+)
+app.DEFINE_integer(
+  "encoder_chunk_size",
+  16,
+  "The number of preprocessed files to send to an encoder process at a time.",
+)
+
 Base = declarative.declarative_base()
 
 
@@ -54,12 +69,14 @@ class EncodedContentFile(Base):
 
   # The ID of the PreprocessedContentFile.
   id: int = sql.Column(sql.Integer, primary_key=True)
-  # We store the vocabulary indices array as a string of period-separated
-  # integers, e.g. '0.1.2.0.1'. To access the values as an array of integers,
-  # use EncodedContentFile.indices_array.
-  data: str = sql.Column(
-    sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable=False
-  )
+  # We store the vocabulary indices array as the raw bytes of an array of
+  # little-endian integers, where the width of each integer is data_itemsize.
+  # To access the values as an array of integers, use
+  # EncodedContentFile.indices_array.
+  data: bytes = sql.Column(sqlutil.ColumnTypes.LargeBinary(), nullable=False)
+  # The number of bytes used to store each vocabulary index in data. See
+  # GetDataDtype().
+  data_itemsize: int = sql.Column(sql.Integer, nullable=False)
   tokencount: int = sql.Column(sql.Integer, nullable=False)
   # The number of milliseconds encoding took.
   encoding_time_ms: int = sql.Column(sql.Integer, nullable=False)
@@ -72,20 +89,48 @@ class EncodedContentFile(Base):
   wall_time_ms: int = sql.Column(sql.Integer, nullable=False)
   date_added: datetime.datetime = sql.Column(sql.DateTime, nullable=False)
 
+  @staticmethod
+  def GetDataDtype(vocab_size: int) -> np.dtype:
+    """Return the type used to store the indices of a vocabulary.
+
+    Vocabularies of up to 2^15 tokens are stored using 16 bit integers, else 32
+    bit integers are used.
+    """
+    if vocab_size <= np.iinfo(np.int16).max + 1:
+      return np.dtype("<i2")
+    return np.dtype("<i4")
+
+  @staticmethod
+  def DataBytesToNumpyArray(data: bytes, itemsize: int) -> np.ndarray:
+    """Convert the 'data' bytes to a numpy array.
+
+    The returned array is a read-only view of the data, no copy is made.
+    """
+    return np.frombuffer(data, dtype=f"<i{itemsize}")
+
+  @staticmethod
+  def NumpyArrayToDataBytes(array: np.ndarray, dtype: np.dtype) -> bytes:
+    """Convert a numpy array to the 'data' bytes."""
+    return np.asarray(array).astype(dtype, copy=False).tobytes()
+
   @staticmethod
   def DataStringToNumpyArray(data: str) -> np.ndarray:
-    """Convert the 'data' string to a numpy array."""
+    """Convert a legacy 'data' string to a numpy array.
+
+    Before the introduction of binary storage, vocabulary indices were stored
+    as strings of period-separated integers, e.g. '0.1.2.0.1'.
+    """
     return np.array([int(x) for x in data.split(".")], dtype=np.int32)
 
   @staticmethod
   def NumpyArrayToDataString(array: np.ndarray) -> str:
-    """Convert the 'data' string to a numpy array."""
+    """Convert a numpy array to a legacy 'data' string."""
     return ".".join(str(x) for x in array)
 
   @property
   def indices_array(self) -> np.ndarray:
     """The numpy array of the encoded data."""
-    return self.DataStringToNumpyArray(self.data)
+    return self.DataBytesToNumpyArray(self.data, self.data_itemsize)
 
   @classmethod
   def FromPreprocessed(
@@ -107,15 +152,17 @@ class EncodedContentFile(Base):
     start_time = time.time()
     data = atomizer.AtomizeString(preprocessed_cf.text)
     encoding_time_ms = int((time.time() - start_time) * 1000)
+    dtype = cls.GetDataDtype(atomizer.vocab_size)
     return EncodedContentFile(
       id=preprocessed_cf.id,
       # Encode the end-of-file marker separately to ensure that it resolves to
       # the correct token. For example if the vocabulary contains 'a', 'b',
       # and 'ab', then a content file 'a' with EOF marker 'b' would be encoded
       # as 'ab', instead of 'a'+'b'.
-      data=cls.NumpyArrayToDataString(
-        np.concatenate((data, atomizer.AtomizeString(eof)))
+      data=cls.NumpyArrayToDataBytes(
+        np.concatenate((data, atomizer.AtomizeString(eof))), dtype
       ),
+      data_itemsize=dtype.itemsize,
       tokencount=len(data),
       encoding_time_ms=encoding_time_ms,
       wall_time_ms=encoding_time_ms,  # The outer-loop may change this.
@@ -123,10 +170,57 @@ class EncodedContentFile(Base):
     )
 
 
+def HasLegacyDataFormat(engine: sql.engine.Engine) -> bool:
+  """Return whether a database stores encoded data as period-separated text.
+
+  Args:
+    engine: The database engine.
+
+  Returns:
+    True if the encoded contentfiles table exists and predates binary storage.
+  """
+  inspector = sql.inspect(engine)
+  if EncodedContentFile.__tablename__ not in inspector.get_table_names():
+    return False
+  columns = inspector.get_columns(EncodedContentFile.__tablename__)
+  return "data_itemsize" not in {column["name"] for column in columns}
+
+
+# The atomizer and contentfile separator of an encoder pool process, set once
+# per process by InitEncoderWorker() rather than being sent with every job.
+_worker_atomizer: typing.Optional[atomizers.AtomizerBase] = None
+_worker_contentfile_separator: typing.Optional[str] = None
+
+
+def InitEncoderWorker(pickled_atomizer: bytes, contentfile_separator: str):
+  """Initialize an encoder pool process.
+
+  Args:
+    pickled_atomizer: The pickled atomizer to encode using.
+    contentfile_separator: The contentfile separator.
+  """
+  global _worker_atomizer
+  global _worker_contentfile_separator
+  _worker_atomizer = pickle.loads(pickled_atomizer)
+  _worker_contentfile_separator = contentfile_separator
+
+
 def EncoderWorker(
   job: internal_pb2.EncoderWorker,
 ) -> typing.Optional[EncodedContentFile]:
-  """Encode a single content file."""
+  """Encode a single content file.
+
+  The atomizer and contentfile separator are read from the job if set, else
+  from the values set by InitEncoderWorker().
+  """
+  if job.HasField("pickled_atomizer"):
+    atomizer = pickle.loads(job.pickled_atomizer)
+  else:
+    atomizer = _worker_atomizer
+  if job.HasField("contentfile_separator"):
+    contentfile_separator = job.contentfile_separator
+  else:
+    contentfile_separator = _worker_contentfile_separator
   # TODO(cec): There is a bug in the atomizer creation logic such that the
   # derived atomizer is not always capable of encoding the preprocessed files.
   # Once this has been fixed, there is no need to catch the VocabError here,
@@ -134,24 +228,120 @@ def EncoderWorker(
   try:
     return EncodedContentFile.FromPreprocessed(
       preprocessed.PreprocessedContentFile(id=job.id, text=job.text),
-      pickle.loads(job.pickled_atomizer),
-      job.contentfile_separator,
+      atomizer,
+      contentfile_separator,
     )
   except errors.VocabError:
     return None
 
 
+def _EncoderJobs(
+  preprocessed_db: preprocessed.PreprocessedContentFiles,
+  encoded_ids: typing.Set[int],
+  semaphore: threading.Semaphore,
+  stop: threading.Event,
+  batch_size: int,
+) -> typing.Iterator[internal_pb2.EncoderWorker]:
+  """Stream encoder jobs for the preprocessed files which are not encoded.
+
+  This is consumed by the task feeder thread of a multiprocessing pool, which
+  would otherwise read the entire iterator into its task queue. Acquiring the
+  semaphore before yielding each job bounds the number of jobs in flight.
+
+  Args:
+    preprocessed_db: The preprocessed database to read files from.
+    encoded_ids: The IDs of files which have already been encoded.
+    semaphore: A semaphore which is released once per completed job.
+    stop: An event which, when set, stops the iteration.
+    batch_size: The number of rows to read from the database at a time.
+
+  Returns:
+    An iterator of encoder jobs.
+  """
+  # The session is created here so that it is only used from the thread that
+  # iterates over the jobs.
+  with preprocessed_db.Session() as session:
+    query = (
+      session.query(
+        preprocessed.PreprocessedContentFile.id,
+        preprocessed.PreprocessedContentFile.text,
+      )
+      .filter(
+        preprocessed.PreprocessedContentFile.preprocessing_succeeded == True
+      )
+      .order_by(preprocessed.PreprocessedContentFile.id)
+    )
+    last_id = -1
+    while True:
+      batch = query.filter(
+        preprocessed.PreprocessedContentFile.id > last_id
+      ).limit(batch_size)
+      batch = batch.all()
+      if not batch:
+        break
+      last_id = batch[-1].id
+      for id, text in batch:
+        if id in encoded_ids:
+          continue
+        while not semaphore.acquire(timeout=1):
+          if stop.is_set():
+            return
+        yield internal_pb2.EncoderWorker(id=id, text=text)
+
+
+class ParentCorpus(typing.NamedTuple):
+  """A previously encoded corpus to copy unchanged encoded files from."""
+
+  encoded_db: "EncodedContentFiles"
+  preprocessed_db: preprocessed.PreprocessedContentFiles
+  # A map from the vocabulary indices of the parent to the indices of the same
+  # atoms in the vocabulary of the new corpus, or -1 for atoms which are not in
+  # the new vocabulary. See GetVocabIndexMap().
+  index_map: np.ndarray
+
+
+def GetVocabIndexMap(
+  parent_vocab: typing.Dict[str, int], vocab: typing.Dict[str, int]
+) -> np.ndarray:
+  """Map the indices of a parent vocabulary to those of a new vocabulary.
+
+  Atomizers tokenize each file independently of the rest of the corpus, so a
+  file encoded using the parent vocabulary can be translated to the new
+  vocabulary provided that the new vocabulary contains each of its atoms.
+
+  Args:
+    parent_vocab: The vocabulary of the parent corpus.
+    vocab: The vocabulary of the new corpus.
+
+  Returns:
+    An array of new vocabulary indices, indexed by parent vocabulary index.
+    Atoms which are not in the new vocabulary map to -1.
+  """
+  index_map = np.full(len(parent_vocab), -1, dtype=np.int32)
+  for atom, parent_index in parent_vocab.items():
+    if atom in vocab:
+      index_map[parent_index] = vocab[atom]
+  return index_map
+
+
 class EncodedContentFiles(sqlutil.Database):
   """A database of encoded pre-processed contentfiles."""
 
   def __init__(self, url: str, must_exist: bool = False):
     super(EncodedContentFiles, self).__init__(url, Base, must_exist=must_exist)
+    if HasLegacyDataFormat(self.engine):
+      raise errors.UserError(
+        f"Encoded database '{url}' stores its data in the legacy text format. "
+        "Convert it using "
+        "//deeplearning/clgen/corpuses/tools:migrate_encoded_db"
+      )
 
   def Create(
     self,
     p: preprocessed.PreprocessedContentFiles,
     atomizer: atomizers.AtomizerBase,
     contentfile_separator: str,
+    parent: typing.Optional["ParentCorpus"] = None,
   ) -> bool:
     """Populate the encoded contentfiles database.
 
@@ -159,6 +349,8 @@ class EncodedContentFiles(sqlutil.Database):
       p: A PreprocessedContentFiles database.
       atomizer: An AtomizerBase instance.
       contentfile_separator: The contentfile separator.
+      parent: An optional parent corpus. Files which are unchanged since the
+        parent are copied from it rather than encoded.
 
     Returns:
       True if work was done, else False.
@@ -169,6 +361,13 @@ class EncodedContentFiles(sqlutil.Database):
     """
     with self.Session() as session:
       if not self.IsDone(session):
+        if parent:
+          self.CopyUnchangedFromParent(
+            session,
+            p,
+            parent,
+            EncodedContentFile.GetDataDtype(atomizer.vocab_size),
+          )
         self.Import(session, p, atomizer, contentfile_separator)
         self.SetDone(session)
         session.commit()
@@ -225,44 +424,69 @@ class EncodedContentFiles(sqlutil.Database):
     atomizer: atomizers.AtomizerBase,
     contentfile_separator: str,
   ) -> None:
+    """Encode the preprocessed files which are not already encoded.
+
+    Preprocessed files are streamed from the database in batches, and the
+    number of files being encoded at any time is bounded, so the memory
+    required does not grow with the size of the corpus.
+
+    Args:
+      session: A session for this database.
+      preprocessed_db: The database of preprocessed files to encode.
+      atomizer: The atomizer to encode using.
+      contentfile_separator: The contentfile separator.
+
+    Raises:
+      EmptyCorpusException: If there are no successfully pre-processed files.
+    """
+    encoded_ids = {row.id for row in session.query(EncodedContentFile.id)}
     with preprocessed_db.Session() as p_session:
-      query = p_session.query(preprocessed.PreprocessedContentFile).filter(
-        preprocessed.PreprocessedContentFile.preprocessing_succeeded == True,
-        ~preprocessed.PreprocessedContentFile.id.in_(
-          session.query(EncodedContentFile.id).all()
-        ),
-      )
-      jobs = [
-        internal_pb2.EncoderWorker(
-          id=x.id,
-          text=x.text,
-          contentfile_separator=contentfile_separator,
-          pickled_atomizer=pickle.dumps(atomizer),
-        )
-        for x in query
-      ]
-      if not jobs:
-        raise errors.EmptyCorpusException(
-          "Pre-processed corpus contains no files: " f"'{preprocessed_db.url}'"
+      preprocessed_count = (
+        p_session.query(preprocessed.PreprocessedContentFile)
+        .filter(
+          preprocessed.PreprocessedContentFile.preprocessing_succeeded == True
         )
-
-      app.Log(
-        1,
-        "Encoding %s of %s preprocessed files",
-        humanize.Commas(query.count()),
-        humanize.Commas(
-          p_session.query(preprocessed.PreprocessedContentFile)
-          .filter(
-            preprocessed.PreprocessedContentFile.preprocessing_succeeded == True
-          )
-          .count()
-        ),
+        .count()
       )
-      pool = multiprocessing.Pool()
-      bar = progressbar.ProgressBar(max_value=len(jobs))
+    if not preprocessed_count:
+      raise errors.EmptyCorpusException(
+        "Pre-processed corpus contains no files: " f"'{preprocessed_db.url}'"
+      )
+    todo_count = preprocessed_count - len(encoded_ids)
+    if todo_count <= 0:
+      return
+
+    app.Log(
+      1,
+      "Encoding %s of %s preprocessed files",
+      humanize.Commas(todo_count),
+      humanize.Commas(preprocessed_count),
+    )
+    processes = multiprocessing.cpu_count()
+    chunksize = FLAGS.encoder_chunk_size
+    semaphore = threading.Semaphore(processes * chunksize * 4)
+    stop = threading.Event()
+    jobs = _EncoderJobs(
+      preprocessed_db,
+      encoded_ids,
+      semaphore,
+      stop,
+      batch_size=FLAGS.encoder_read_batch_size,
+    )
+    pool = multiprocessing.Pool(
+      processes,
+      initializer=InitEncoderWorker,
+      initargs=(pickle.dumps(atomizer), contentfile_separator),
+    )
+    try:
+      bar = progressbar.ProgressBar(max_value=todo_count)
       last_commit = time.time()
+      uncommitted_count = 0
       wall_time_start = time.time()
-      for encoded_cf in bar(pool.imap_unordered(EncoderWorker, jobs)):
+      for encoded_cf in bar(
+        pool.imap_unordered(EncoderWorker, jobs, chunksize=chunksize)
+      ):
+        semaphore.release()
         wall_time_end = time.time()
         # TODO(cec): Remove the if check once EncoderWorker no longer returns
         # None on atomizer encode error.
@@ -271,10 +495,123 @@ class EncodedContentFiles(sqlutil.Database):
             (wall_time_end - wall_time_start) * 1000
           )
           session.add(encoded_cf)
+          uncommitted_count += 1
         wall_time_start = wall_time_end
-        if wall_time_end - last_commit > 10:
+        if (
+          wall_time_end - last_commit > 10
+          or uncommitted_count >= FLAGS.encoder_read_batch_size
+        ):
           session.commit()
           last_commit = wall_time_end
+          uncommitted_count = 0
+    except:
+      # Stop the job iterator so that the pool's task feeder thread can exit.
+      stop.set()
+      pool.terminate()
+      raise
+    pool.close()
+    pool.join()
+
+  def CopyUnchangedFromParent(
+    self,
+    session: sqlutil.Session,
+    preprocessed_db: preprocessed.PreprocessedContentFiles,
+    parent: "ParentCorpus",
+    dtype: np.dtype,
+  ) -> int:
+    """Copy the encoded files which are unchanged from a parent corpus.
+
+    A file is unchanged if the parent corpus contains a successfully
+    pre-processed file with the same relative path and input checksum. The
+    indices of copied files are translated to this corpus's vocabulary.
+
+    Args:
+      session: A session for this database.
+      preprocessed_db: The pre-processed files of this corpus.
+      parent: The parent corpus.
+      dtype: The type to store vocabulary indices as.
+
+    Returns:
+      The number of encoded files copied.
+    """
+    start_time = time.time()
+
+    def _GetIds(db: preprocessed.PreprocessedContentFiles):
+      """Return a map from <relpath, input_sha256> to ID."""
+      with db.Session() as p_session:
+        return {
+          (relpath, sha256): id
+          for id, relpath, sha256 in p_session.query(
+            preprocessed.PreprocessedContentFile.id,
+            preprocessed.PreprocessedContentFile.input_relpath,
+            preprocessed.PreprocessedContentFile.input_sha256,
+          ).filter(
+            preprocessed.PreprocessedContentFile.preprocessing_succeeded
+            == True
+          )
+        }
+
+    ids = _GetIds(preprocessed_db)
+    encoded_ids = {row.id for row in session.query(EncodedContentFile.id)}
+    # A map from the ID of a file in the parent to the ID in this corpus.
+    parent_ids = {
+      parent_id: ids[key]
+      for key, parent_id in _GetIds(parent.preprocessed_db).items()
+      if key in ids and ids[key] not in encoded_ids
+    }
+    del ids
+
+    columns = [
+      column
+      for column in sqlutil.ColumnNames(EncodedContentFile)
+      if column != "id"
+    ]
+    copied_count = 0
+    with parent.encoded_db.Session() as parent_session:
+      query = parent_session.query(EncodedContentFile).order_by(
+        EncodedContentFile.id
+      )
+      last_id = -1
+      while True:
+        batch = (
+          query.filter(EncodedContentFile.id > last_id)
+          .limit(FLAGS.encoder_read_batch_size)
+          .all()
+        )
+        if not batch:
+          break
+        last_id = batch[-1].id
+        mappings = []
+        for row in batch:
+          if row.id not in parent_ids:
+            continue
+          indices = parent.index_map[row.indices_array]
+          # An unchanged file can only contain atoms which are in the new
+          # vocabulary, but if that is not the case then the file is left to be
+          # encoded from scratch.
+          if (indices < 0).any():
+            continue
+          mappings.append(
+            dict(
+              {column: getattr(row, column) for column in columns},
+              id=parent_ids[row.id],
+              data=EncodedContentFile.NumpyArrayToDataBytes(indices, dtype),
+              data_itemsize=dtype.itemsize,
+            )
+          )
+        session.bulk_insert_mappings(EncodedContentFile, mappings)
+        copied_count += len(mappings)
+        # Expunge the batch so that the parent session does not grow.
+        parent_session.expunge_all()
+    session.commit()
+
+    app.Log(
+      1,
+      "Copied %s encoded files from parent corpus in %s ms",
+      humanize.Commas(copied_count),
+      humanize.Commas(int((time.time() - start_time) * 1000)),
+    )
+    return copied_count
 
   @staticmethod
   def GetVocabFromMetaTable(session) -> typing.Dict[str, int]:
@@ -301,3 +638,141 @@ class EncodedContentFiles(sqlutil.Database):
     session.add_all(
       [encoded.Meta(key=f"vocab_{v}", value=k) for k, v in vocabulary.items()]
     )
+
+
+# The number of contentfiles copied at a time by EncodedTokenFile.Gather().
+_GATHER_CHUNK_SIZE = 4096
+
+
+class EncodedTokenFile(object):
+  """A memory-mapped, flattened copy of the indices of an encoded database.
+
+  The token file is a directory containing two arrays: 'tokens.npy', the
+  concatenated indices arrays of every encoded contentfile in order of their
+  ID, and 'offsets.npy', an array of num_contentfiles + 1 offsets into the
+  tokens array such that contentfile i spans tokens[offsets[i]:offsets[i+1]].
+
+  The tokens array is memory-mapped rather than read, so training data need not
+  fit in system memory.
+  """
+
+  def __init__(self, path: pathlib.Path):
+    """Open a token file.
+
+    Args:
+      path: The directory of the token file.
+
+    Raises:
+      FileNotFoundError: If the token file has not been built.
+    """
+    if not self.IsBuilt(path):
+      raise FileNotFoundError(f"Token file not found: '{path}'")
+    self.path = path
+    self.tokens = np.load(path / "tokens.npy", mmap_mode="r")
+    self.offsets = np.load(path / "offsets.npy")
+
+  @property
+  def num_contentfiles(self) -> int:
+    """Return the number of contentfiles in the token file."""
+    return len(self.offsets) - 1
+
+  def GetIndicesArray(self, i: int) -> np.ndarray:
+    """Return a read-only view of the indices array of the i-th contentfile."""
+    return self.tokens[self.offsets[i] : self.offsets[i + 1]]
+
+  def Gather(
+    self, order: np.ndarray, out: typing.Optional[np.ndarray] = None
+  ) -> np.ndarray:
+    """Concatenate the contentfiles in the given order.
+
+    Contentfiles are copied in chunks, using a single fancy-indexing read of
+    the tokens array per chunk.
+
+    Args:
+      order: A permutation of range(num_contentfiles).
+      out: An optional array of the same shape and type as the tokens array to
+        write the concatenated indices to, e.g. a memory-mapped file. If not
+        provided, an array is allocated.
+
+    Returns:
+      The concatenated indices.
+    """
+    if out is None:
+      out = np.empty_like(self.tokens)
+    order = np.asarray(order, dtype=np.int64)
+    starts = self.offsets[:-1][order]
+    lengths = self.offsets[1:][order] - starts
+    position = 0
+    for i in range(0, len(order), _GATHER_CHUNK_SIZE):
+      chunk_starts = starts[i : i + _GATHER_CHUNK_SIZE]
+      chunk_lengths = lengths[i : i + _GATHER_CHUNK_SIZE]
+      num_tokens = int(chunk_lengths.sum())
+      # The index of each token of the chunk in the tokens array is the start
+      # of its contentfile, plus its position within the contentfile.
+      chunk_positions = np.cumsum(chunk_lengths) - chunk_lengths
+      indices = np.repeat(
+        chunk_starts - chunk_positions, chunk_lengths
+      ) + np.arange(num_tokens)
+      out[position : position + num_tokens] = self.tokens[indices]
+      position += num_tokens
+    return out
+
+  @staticmethod
+  def IsBuilt(path: pathlib.Path) -> bool:
+    """Return whether a token file has been built at the given path."""
+    return (path / "tokens.npy").is_file() and (path / "offsets.npy").is_file()
+
+  @classmethod
+  def Build(cls, db: EncodedContentFiles, path: pathlib.Path) -> None:
+    """Build a token file from an encoded database.
+
+    The arrays are written to temporary files which are renamed once complete,
+    so an interrupted build leaves no token file behind.
+
+    Args:
+      db: The encoded database.
+      path: The directory to write the token file to.
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    start_time = time.time()
+    with db.Session() as session:
+      # Compute the offsets from the length of the data blobs, which does not
+      # require reading the blobs themselves.
+      lengths = session.query(
+        EncodedContentFile.id,
+        func.length(EncodedContentFile.data),
+        EncodedContentFile.data_itemsize,
+      ).order_by(EncodedContentFile.id)
+      lengths = np.array(
+        [(length, itemsize) for _, length, itemsize in lengths], dtype=np.int64
+      ).reshape(-1, 2)
+      offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+      np.cumsum(lengths[:, 0] // lengths[:, 1], out=offsets[1:])
+      dtype = np.dtype(f"<i{lengths[:, 1].max() if len(lengths) else 2}")
+
+      tokens_path = path / "tokens.npy.tmp"
+      tokens = np.lib.format.open_memmap(
+        str(tokens_path), mode="w+", dtype=dtype, shape=(offsets[-1],)
+      )
+      query = session.query(
+        EncodedContentFile.data, EncodedContentFile.data_itemsize
+      ).order_by(EncodedContentFile.id)
+      for i, (data, itemsize) in enumerate(query.yield_per(1000)):
+        tokens[offsets[i] : offsets[i + 1]] = (
+          EncodedContentFile.DataBytesToNumpyArray(data, itemsize)
+        )
+      tokens.flush()
+      del tokens
+      os.rename(tokens_path, path / "tokens.npy")
+
+    offsets_path = path / "offsets.npy.tmp"
+    with open(offsets_path, "wb") as f:
+      np.save(f, offsets)
+    os.rename(offsets_path, path / "offsets.npy")
+    app.Log(
+      1,
+      "Built token file of %s tokens, %s files in %s ms",
+      humanize.Commas(offsets[-1]),
+      humanize.Commas(len(offsets) - 1),
+      humanize.Commas(int((time.time() - start_time) * 1000)),
+    )
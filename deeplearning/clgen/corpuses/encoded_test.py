@@ -13,7 +13,9 @@
 # You should have received a copy of the GNU General Public License
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """Unit tests for //deeplearning/clgen/corpuses:encoded."""
+import datetime
 import pathlib
+import pickle
 import tempfile
 
 import numpy as np
@@ -22,7 +24,9 @@ from deeplearning.clgen import errors
 from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.corpuses import encoded
 from deeplearning.clgen.corpuses import preprocessed
+from deeplearning.clgen.proto import internal_pb2
 from labm8.py import app
+from labm8.py import sqlutil
 from labm8.py import test
 
 FLAGS = app.FLAGS
@@ -104,6 +108,57 @@ def test_EncodedContentFile_FromPreprocessed_date_added(
   assert enc.date_added
 
 
+def test_EncodedContentFile_FromPreprocessed_data_itemsize(
+  abc_atomizer, abc_preprocessed
+):
+  """Test that a small vocabulary is stored using 16 bit integers."""
+  enc = encoded.EncodedContentFile.FromPreprocessed(
+    abc_preprocessed, abc_atomizer, eof="a"
+  )
+  assert enc.data_itemsize == 2
+  assert len(enc.data) == 2 * 11
+
+
+# EncodedContentFile.GetDataDtype() tests.
+
+
+def test_EncodedContentFile_GetDataDtype():
+  """Test the storage type boundary between 16 and 32 bit integers."""
+  assert encoded.EncodedContentFile.GetDataDtype(100) == np.dtype("<i2")
+  assert encoded.EncodedContentFile.GetDataDtype(2 ** 15) == np.dtype("<i2")
+  assert encoded.EncodedContentFile.GetDataDtype(2 ** 15 + 1) == np.dtype("<i4")
+
+
+def test_EncodedContentFile_DataBytesToNumpyArray_round_trip():
+  """Test that indices survive conversion to and from bytes."""
+  array = np.array([0, 1, 70000, 5], dtype=np.int32)
+  data = encoded.EncodedContentFile.NumpyArrayToDataBytes(
+    array, np.dtype("<i4")
+  )
+  np.testing.assert_array_equal(
+    array, encoded.EncodedContentFile.DataBytesToNumpyArray(data, 4)
+  )
+
+
+# GetVocabIndexMap() tests.
+
+
+def test_GetVocabIndexMap_superset():
+  """Test mapping indices to a vocabulary with additional atoms."""
+  index_map = encoded.GetVocabIndexMap(
+    {"a": 0, "b": 1}, {"c": 0, "b": 1, "a": 2}
+  )
+  assert index_map.tolist() == [2, 1]
+
+
+def test_GetVocabIndexMap_missing_atom():
+  """Test that atoms missing from the new vocabulary map to -1."""
+  assert encoded.GetVocabIndexMap({"a": 0, "b": 1}, {"a": 0}).tolist() == [
+    0,
+    -1,
+  ]
+
+
 # EncodedContentFiles tests.
 
 
@@ -165,5 +220,151 @@ def test_EncodedContentFiles_empty_preprocessed_db(
       temp_db.Create(p, abc_atomizer, "\n\n")
 
 
+def test_EncodedContentFiles_Create_skips_failed_and_encoded_files(
+  tempdir: pathlib.Path,
+  temp_db: encoded.EncodedContentFiles,
+  abc_atomizer: atomizers.AsciiCharacterAtomizer,
+):
+  """Test that only new, successfully preprocessed files are encoded."""
+  p = preprocessed.PreprocessedContentFiles(
+    f"sqlite:///{tempdir}/preprocessed.db"
+  )
+  with p.Session(commit=True) as session:
+    session.add_all(
+      [
+        preprocessed.PreprocessedContentFile(
+          id=i,
+          input_relpath=f"{i}.txt",
+          input_sha256="0" * 64,
+          input_charcount=len(text),
+          input_linecount=1,
+          sha256="0" * 64,
+          charcount=len(text),
+          linecount=1,
+          text=text,
+          preprocessing_succeeded=succeeded,
+          preprocess_time_ms=1,
+          wall_time_ms=1,
+          date_added=datetime.datetime.utcnow(),
+        )
+        for i, text, succeeded in [
+          (1, "ab", True),
+          (2, "ERROR: failed", False),
+          (3, "cde", True),
+          (4, "ee", True),
+        ]
+      ]
+    )
+  with temp_db.Session(commit=True) as session:
+    session.add(
+      encoded.EncodedContentFile.FromPreprocessed(
+        preprocessed.PreprocessedContentFile(id=4, text="ee"),
+        abc_atomizer,
+        eof="a",
+      )
+    )
+
+  temp_db.Create(p, abc_atomizer, "a")
+
+  with temp_db.Session() as session:
+    cfs = session.query(encoded.EncodedContentFile).order_by(
+      encoded.EncodedContentFile.id
+    )
+    assert [(cf.id, cf.indices_array.tolist()) for cf in cfs] == [
+      (1, [0, 1, 0]),
+      (3, [2, 3, 4, 0]),
+      (4, [4, 4, 0]),
+    ]
+
+
+def test_EncoderWorker_InitEncoderWorker(
+  abc_atomizer: atomizers.AsciiCharacterAtomizer,
+):
+  """Test that the worker uses the atomizer set by the initializer."""
+  encoded.InitEncoderWorker(pickle.dumps(abc_atomizer), "b")
+  enc = encoded.EncoderWorker(internal_pb2.EncoderWorker(id=5, text="cc"))
+  assert enc.id == 5
+  assert enc.indices_array.tolist() == [2, 2, 1]
+
+
+def test_EncodedContentFiles_legacy_data_format(tempdir: pathlib.Path):
+  """Test that opening a database of text-encoded data raises an error."""
+  url = f"sqlite:///{tempdir}/encoded.db"
+  engine = sqlutil.CreateEngine(url)
+  engine.execute(
+    "CREATE TABLE encoded_contentfiles (id INTEGER PRIMARY KEY, data TEXT)"
+  )
+  assert encoded.HasLegacyDataFormat(engine)
+  with test.Raises(errors.UserError) as e_info:
+    encoded.EncodedContentFiles(url)
+  assert "legacy text format" in str(e_info.value)
+
+
+# EncodedTokenFile tests.
+
+
+@test.Fixture(scope="function")
+def abc_token_file(
+  tempdir: pathlib.Path, temp_db: encoded.EncodedContentFiles
+) -> encoded.EncodedTokenFile:
+  """A token file of three contentfiles."""
+  with temp_db.Session(commit=True) as session:
+    session.add_all(
+      [
+        encoded.EncodedContentFile(
+          id=i + 1,
+          data=np.array(indices, dtype=np.int16).tobytes(),
+          data_itemsize=2,
+          tokencount=len(indices),
+          encoding_time_ms=1,
+          wall_time_ms=1,
+          date_added=datetime.datetime.utcnow(),
+        )
+        for i, indices in enumerate([[0, 1, 2], [3], [4, 5]])
+      ]
+    )
+  encoded.EncodedTokenFile.Build(temp_db, tempdir / "tokens")
+  return encoded.EncodedTokenFile(tempdir / "tokens")
+
+
+def test_EncodedTokenFile_IsBuilt(tempdir: pathlib.Path):
+  """Test that an empty directory is not a token file."""
+  assert not encoded.EncodedTokenFile.IsBuilt(tempdir)
+  with test.Raises(FileNotFoundError):
+    encoded.EncodedTokenFile(tempdir)
+
+
+def test_EncodedTokenFile_tokens(abc_token_file: encoded.EncodedTokenFile):
+  """Test that the tokens array is the concatenated indices arrays."""
+  assert isinstance(abc_token_file.tokens, np.memmap)
+  assert abc_token_file.tokens.dtype == np.int16
+  assert abc_token_file.tokens.tolist() == [0, 1, 2, 3, 4, 5]
+  assert abc_token_file.num_contentfiles == 3
+
+
+def test_EncodedTokenFile_GetIndicesArray(
+  abc_token_file: encoded.EncodedTokenFile,
+):
+  """Test that contentfiles can be read from the tokens array."""
+  assert abc_token_file.GetIndicesArray(0).tolist() == [0, 1, 2]
+  assert abc_token_file.GetIndicesArray(1).tolist() == [3]
+  assert abc_token_file.GetIndicesArray(2).tolist() == [4, 5]
+
+
+def test_EncodedTokenFile_Gather(abc_token_file: encoded.EncodedTokenFile):
+  """Test concatenating contentfiles in a different order."""
+  assert abc_token_file.Gather([2, 0, 1]).tolist() == [4, 5, 0, 1, 2, 3]
+
+
+def test_EncodedTokenFile_Gather_chunks(
+  abc_token_file: encoded.EncodedTokenFile, monkeypatch
+):
+  """Test that contentfiles are concatenated across gather chunks."""
+  monkeypatch.setattr(encoded, "_GATHER_CHUNK_SIZE", 2)
+  out = np.zeros(6, dtype=abc_token_file.tokens.dtype)
+  assert abc_token_file.Gather([1, 2, 0], out=out) is out
+  assert out.tolist() == [3, 4, 5, 0, 1, 2]
+
+
 if __name__ == "__main__":
   test.Main()
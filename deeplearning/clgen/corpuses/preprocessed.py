@@ -16,11 +16,13 @@
 import contextlib
 import datetime
 import hashlib
+import io
 import multiprocessing
+import multiprocessing.pool
 import os
 import pathlib
+import queue
 import subprocess
-import tempfile
 import time
 import typing
 
@@ -30,6 +32,8 @@ from sqlalchemy.ext import declarative
 from sqlalchemy.sql import func
 
 from deeplearning.clgen import errors
+from deeplearning.clgen.corpuses import archives
+from deeplearning.clgen.corpuses import preprocessing_cache
 from deeplearning.clgen.preprocessors import preprocessors
 from deeplearning.clgen.proto import corpus_pb2
 from deeplearning.clgen.proto import internal_pb2
@@ -40,6 +44,13 @@ from labm8.py import sqlutil
 
 FLAGS = app.FLAGS
 
+app.DEFINE_integer(
+  "preprocessor_target_batch_time_ms",
+  1000,
+  "The target time to pre-process a batch of content files in. The number of "
+  "files in a batch is adjusted during pre-processing to meet this target.",
+)
+
 Base = declarative.declarative_base()
 
 
@@ -90,38 +101,101 @@ class PreprocessedContentFile(Base):
     preprocessors_: typing.List[str],
   ) -> "PreprocessedContentFile":
     """Instantiate a PreprocessedContentFile."""
-    start_time = time.time()
-    input_text = ""
-    preprocessing_succeeded = False
-    try:
+    return cls(
+      **PreprocessContentFile(
+        contentfile_root, relpath, preprocessors_
+      )._asdict()
+    )
+
+
+class PreprocessedContentFileTuple(typing.NamedTuple):
+  """The column values of a PreprocessedContentFile, excluding the ID.
+
+  This is cheaper to pickle than an ORM object, and can be inserted in bulk.
+  """
+
+  input_relpath: str
+  input_sha256: str
+  input_charcount: int
+  input_linecount: int
+  sha256: str
+  charcount: int
+  linecount: int
+  text: str
+  preprocessing_succeeded: bool
+  preprocess_time_ms: int
+  wall_time_ms: int
+  date_added: datetime.datetime
+
+
+def PreprocessContentFile(
+  contentfile_root: pathlib.Path,
+  relpath: str,
+  preprocessors_: typing.List[str],
+  input_sha256: typing.Optional[str] = None,
+  cached_result: typing.Optional[typing.Tuple[str, bool]] = None,
+  input_bytes: typing.Optional[bytes] = None,
+) -> PreprocessedContentFileTuple:
+  """Pre-process a single content file.
+
+  Args:
+    contentfile_root: The root of the content files directory.
+    relpath: The path of the content file, relative to the root.
+    preprocessors_: The list of preprocessors to run.
+    input_sha256: The checksum of the content file, if already computed.
+    cached_result: A <text, preprocessing_succeeded> tuple from a previous
+      pre-processing of the same input, in which case the preprocessors are
+      not run.
+    input_bytes: The contents of the content file, if already read. If set, the
+      file is not read from the content files root.
+
+  Returns:
+    The column values of the preprocessed content file.
+  """
+  start_time = time.time()
+  input_text = ""
+  preprocessing_succeeded = False
+  try:
+    if input_bytes is None:
       with open(contentfile_root / relpath) as f:
         input_text = f.read()
+    else:
+      # Decode the same way as open() in text mode.
+      input_text = io.TextIOWrapper(io.BytesIO(input_bytes)).read()
+    if cached_result:
+      text, preprocessing_succeeded = cached_result
+    else:
       text = preprocessors.Preprocess(input_text, preprocessors_)
       preprocessing_succeeded = True
-    except UnicodeDecodeError as e:
-      text = "Unicode error"
-    except ValueError as e:
-      # BadCodeException subclasses ValueError. Catch the more general
-      # ValueError so that custom preprocessors can raise ValueError and don't
-      # have to depend on CLgen sources.
-      text = str(e)
-    end_time = time.time()
-    preprocess_time_ms = int((end_time - start_time) * 1000)
-    input_text_stripped = input_text.strip()
-    return cls(
-      input_relpath=relpath,
-      input_sha256=GetFileSha256(contentfile_root / relpath),
-      input_charcount=len(input_text_stripped),
-      input_linecount=len(input_text_stripped.split("\n")),
-      sha256=hashlib.sha256(text.encode("utf-8")).hexdigest(),
-      charcount=len(text),
-      linecount=len(text.split("\n")),
-      text=text,
-      preprocessing_succeeded=preprocessing_succeeded,
-      preprocess_time_ms=preprocess_time_ms,
-      wall_time_ms=preprocess_time_ms,  # The outer-loop may change this.
-      date_added=datetime.datetime.utcnow(),
-    )
+  except UnicodeDecodeError as e:
+    text = "Unicode error"
+  except ValueError as e:
+    # BadCodeException subclasses ValueError. Catch the more general
+    # ValueError so that custom preprocessors can raise ValueError and don't
+    # have to depend on CLgen sources.
+    text = str(e)
+  end_time = time.time()
+  preprocess_time_ms = int((end_time - start_time) * 1000)
+  input_text_stripped = input_text.strip()
+  return PreprocessedContentFileTuple(
+    input_relpath=relpath,
+    input_sha256=input_sha256
+    or (
+      hashlib.sha256(input_bytes).hexdigest()
+      if input_bytes is not None
+      else GetFileSha256(contentfile_root / relpath)
+    ),
+    input_charcount=len(input_text_stripped),
+    input_linecount=len(input_text_stripped.split("\n")),
+    sha256=hashlib.sha256(text.encode("utf-8")).hexdigest(),
+    charcount=len(text),
+    linecount=len(text.split("\n")),
+    text=text,
+    preprocessing_succeeded=preprocessing_succeeded,
+    preprocess_time_ms=preprocess_time_ms,
+    wall_time_ms=preprocess_time_ms,  # The outer-loop may change this.
+    date_added=datetime.datetime.utcnow(),
+  )
 
 
 def PreprocessorWorker(
@@ -133,6 +207,133 @@ def PreprocessorWorker(
   )
 
 
+# The preprocessing cache of a pre-processor pool process, opened once per
+# process by InitPreprocessorWorker() rather than for every job.
+_worker_preprocessing_cache: typing.Optional[
+  preprocessing_cache.PreprocessingCache
+] = None
+
+
+def InitPreprocessorWorker(preprocessing_cache_url: typing.Optional[str]):
+  """Initialize a pre-processor pool process.
+
+  Args:
+    preprocessing_cache_url: The URL of the preprocessing cache of the jobs,
+      if any.
+  """
+  global _worker_preprocessing_cache
+  _worker_preprocessing_cache = (
+    preprocessing_cache.PreprocessingCache(preprocessing_cache_url)
+    if preprocessing_cache_url
+    else None
+  )
+
+
+def GetWorkerPreprocessingCache(
+  preprocessing_cache_url: str,
+) -> preprocessing_cache.PreprocessingCache:
+  """Return the preprocessing cache of this process, opening it if needed."""
+  if (
+    _worker_preprocessing_cache is None
+    or _worker_preprocessing_cache.url != preprocessing_cache_url
+  ):
+    InitPreprocessorWorker(preprocessing_cache_url)
+  return _worker_preprocessing_cache
+
+
+def PreprocessorBatchWorker(
+  job: internal_pb2.PreprocessorBatchWorker,
+) -> typing.List[PreprocessedContentFileTuple]:
+  """Pre-process a batch of content files.
+
+  Batching amortizes the inter-process communication of a job over multiple
+  content files, which otherwise dominates the cost of pre-processing small
+  files.
+
+  If the job has a preprocessing cache, files whose results are in the cache
+  are not pre-processed again.
+  """
+  contentfile_root = pathlib.Path(job.contentfile_root)
+  contents = list(job.contents) or [None] * len(job.relpath)
+  if not job.HasField("preprocessing_cache_url"):
+    return [
+      PreprocessContentFile(
+        contentfile_root, relpath, job.preprocessors, input_bytes=input_bytes
+      )
+      for relpath, input_bytes in zip(job.relpath, contents)
+    ]
+
+  input_sha256s = [
+    GetFileSha256(contentfile_root / relpath)
+    if input_bytes is None
+    else hashlib.sha256(input_bytes).hexdigest()
+    for relpath, input_bytes in zip(job.relpath, contents)
+  ]
+  cached_results = GetWorkerPreprocessingCache(
+    job.preprocessing_cache_url
+  ).GetMany(
+    input_sha256s,
+    preprocessing_cache.GetPreprocessorsSha256(job.preprocessors),
+  )
+  return [
+    PreprocessContentFile(
+      contentfile_root,
+      relpath,
+      job.preprocessors,
+      input_sha256=input_sha256,
+      cached_result=cached_results.get(input_sha256),
+      input_bytes=input_bytes,
+    )
+    for relpath, input_sha256, input_bytes in zip(
+      job.relpath, input_sha256s, contents
+    )
+  ]
+
+
+class AdaptiveBatchSize(object):
+  """Choose the number of content files per batch from their latency.
+
+  The batch size is chosen so that a batch takes roughly a target amount of
+  time to pre-process, using a moving average of the per-file latency.
+  """
+
+  def __init__(
+    self,
+    target_batch_time_ms: int,
+    initial_batch_size: int = 8,
+    max_batch_size: int = 1024,
+  ):
+    self.target_batch_time_ms = target_batch_time_ms
+    self.max_batch_size = max_batch_size
+    self.batch_size = initial_batch_size
+    self.per_file_ms: typing.Optional[float] = None
+
+  def Update(self, file_count: int, elapsed_ms: int) -> int:
+    """Record the time taken to pre-process a batch.
+
+    Args:
+      file_count: The number of files in the batch.
+      elapsed_ms: The time taken to pre-process the batch.
+
+    Returns:
+      The new batch size.
+    """
+    if not file_count:
+      return self.batch_size
+    per_file_ms = elapsed_ms / file_count
+    if self.per_file_ms is None:
+      self.per_file_ms = per_file_ms
+    else:
+      self.per_file_ms = 0.8 * self.per_file_ms + 0.2 * per_file_ms
+    self.batch_size = int(
+      min(
+        max(self.target_batch_time_ms / max(self.per_file_ms, 0.1), 1),
+        self.max_batch_size,
+      )
+    )
+    return self.batch_size
+
+
 class PreprocessedContentFiles(sqlutil.Database):
   """A database of pre-processed contentfiles."""
 
@@ -141,10 +342,15 @@ class PreprocessedContentFiles(sqlutil.Database):
       url, Base, must_exist=must_exist
     )
 
-  def Create(self, config: corpus_pb2.Corpus):
+  def Create(
+    self,
+    config: corpus_pb2.Corpus,
+    cache: typing.Optional[preprocessing_cache.PreprocessingCache] = None,
+    parent: typing.Optional["PreprocessedContentFiles"] = None,
+  ):
     with self.Session() as session:
       if not self.IsDone(session):
-        self.Import(session, config)
+        self.Import(session, config, cache=cache, parent=parent)
         self.SetDone(session)
         session.commit()
 
@@ -206,49 +412,330 @@ class PreprocessedContentFiles(sqlutil.Database):
   def SetDone(self, session: sqlutil.Session):
     session.add(Meta(key="done", value="yes"))
 
-  def Import(self, session: sqlutil.Session, config: corpus_pb2.Corpus) -> None:
+  def Import(
+    self,
+    session: sqlutil.Session,
+    config: corpus_pb2.Corpus,
+    cache: typing.Optional[preprocessing_cache.PreprocessingCache] = None,
+    parent: typing.Optional["PreprocessedContentFiles"] = None,
+  ) -> None:
+    """Pre-process the content files which are not already in the database.
+
+    Args:
+      session: A session for this database.
+      config: The corpus config proto.
+      cache: An optional cache of pre-processing results to read from and
+        add to.
+      parent: An optional database of a previous version of the content files,
+        pre-processed with the same preprocessors. Files which are unchanged
+        are copied from this database rather than pre-processed.
+    """
+    if config.HasField("local_tar_archive"):
+      self.ImportFromArchive(session, config, cache=cache, parent=parent)
+      return
+
     with self.GetContentFileRoot(config) as contentfile_root:
       relpaths = set(self.GetImportRelpaths(contentfile_root))
       done = set(
         [x[0] for x in session.query(PreprocessedContentFile.input_relpath)]
       )
       todo = relpaths - done
+      if parent:
+        todo = self.CopyUnchangedFromParent(
+          session, parent, contentfile_root, todo
+        )
       app.Log(
         1,
         "Preprocessing %s of %s content files",
         humanize.Commas(len(todo)),
         humanize.Commas(len(relpaths)),
       )
-      jobs = [
-        internal_pb2.PreprocessorWorker(
-          contentfile_root=str(contentfile_root),
-          relpath=t,
-          preprocessors=config.preprocessor,
-        )
-        for t in todo
-      ]
-      pool = multiprocessing.Pool()
-      bar = progressbar.ProgressBar(max_value=len(jobs))
-      last_commit = time.time()
-      wall_time_start = time.time()
-      for preprocessed_cf in bar(pool.imap_unordered(PreprocessorWorker, jobs)):
+      todo = list(todo)
+      batch_size = AdaptiveBatchSize(FLAGS.preprocessor_target_batch_time_ms)
+
+      def _Jobs():
+        """Generate jobs, each using the batch size at the time it is made."""
+        todo_index = 0
+        while todo_index < len(todo):
+          batch = todo[todo_index : todo_index + batch_size.batch_size]
+          todo_index += len(batch)
+          yield internal_pb2.PreprocessorBatchWorker(
+            contentfile_root=str(contentfile_root),
+            relpath=batch,
+            preprocessors=config.preprocessor,
+            preprocessing_cache_url=cache.url if cache else None,
+          )
+
+      self.RunPreprocessorJobs(
+        session, config, _Jobs(), batch_size, len(todo), cache=cache
+      )
+
+  def ImportFromArchive(
+    self,
+    session: sqlutil.Session,
+    config: corpus_pb2.Corpus,
+    cache: typing.Optional[preprocessing_cache.PreprocessingCache] = None,
+    parent: typing.Optional["PreprocessedContentFiles"] = None,
+  ) -> None:
+    """Pre-process the content files of a tar archive.
+
+    The archive is read as a stream and the contents of its files are sent
+    directly to the pre-processing workers, without unpacking the archive to
+    disk.
+
+    Args:
+      session: A session for this database.
+      config: The corpus config proto.
+      cache: An optional cache of pre-processing results to read from and
+        add to.
+      parent: An optional database of a previous version of the content files,
+        pre-processed with the same preprocessors.
+
+    Raises:
+      EmptyCorpusException: If the archive contains no files.
+    """
+    archive = ExpandConfigPath(config.local_tar_archive)
+    done = set(
+      [x[0] for x in session.query(PreprocessedContentFile.input_relpath)]
+    )
+    parent_sha256s = self.GetInputSha256s(parent) if parent else {}
+    unchanged: typing.List[str] = []
+    file_count = 0
+    batch_size = AdaptiveBatchSize(FLAGS.preprocessor_target_batch_time_ms)
+
+    def _Jobs():
+      """Generate jobs from the archive, as batches are needed."""
+      nonlocal file_count
+      job = internal_pb2.PreprocessorBatchWorker(
+        preprocessors=config.preprocessor,
+        preprocessing_cache_url=cache.url if cache else None,
+      )
+      for relpath, contents in archives.IterateArchiveFiles(archive):
+        file_count += 1
+        if relpath in done:
+          continue
+        if (
+          relpath in parent_sha256s
+          and hashlib.sha256(contents).hexdigest() == parent_sha256s[relpath]
+        ):
+          unchanged.append(relpath)
+          continue
+        job.relpath.append(relpath)
+        job.contents.append(contents)
+        if len(job.relpath) >= batch_size.batch_size:
+          yield job
+          job = internal_pb2.PreprocessorBatchWorker(
+            preprocessors=config.preprocessor,
+            preprocessing_cache_url=cache.url if cache else None,
+          )
+      if job.relpath:
+        yield job
+
+    app.Log(1, "Preprocessing content files of %s", archive.name)
+    self.RunPreprocessorJobs(
+      session, config, _Jobs(), batch_size, progressbar.UnknownLength, cache
+    )
+    if not file_count:
+      raise errors.EmptyCorpusException(
+        f"Empty content files archive: '{archive}'"
+      )
+    if parent:
+      self.CopyFromParent(session, parent, unchanged)
+      app.Log(
+        1,
+        "Copied %s of %s content files from parent corpus",
+        humanize.Commas(len(unchanged)),
+        humanize.Commas(file_count),
+      )
+
+  def RunPreprocessorJobs(
+    self,
+    session: sqlutil.Session,
+    config: corpus_pb2.Corpus,
+    jobs: typing.Iterator[internal_pb2.PreprocessorBatchWorker],
+    batch_size: AdaptiveBatchSize,
+    file_count: int,
+    cache: typing.Optional[preprocessing_cache.PreprocessingCache] = None,
+  ) -> None:
+    """Run pre-processing jobs on a process pool and import the results.
+
+    Args:
+      session: A session for this database.
+      config: The corpus config proto.
+      jobs: An iterator of jobs. Jobs are drawn from the iterator only as they
+        are submitted, so it may produce jobs lazily.
+      batch_size: The batch size to update with the latency of each job.
+      file_count: The number of files to pre-process, for the progress bar.
+      cache: An optional cache of pre-processing results to add to.
+    """
+    if cache:
+      preprocessors_sha256 = preprocessing_cache.GetPreprocessorsSha256(
+        config.preprocessor
+      )
+    processes = multiprocessing.cpu_count()
+    # Completed batches, or the exception raised by a failed batch.
+    results = queue.Queue()
+    pool = multiprocessing.Pool(
+      processes,
+      initializer=InitPreprocessorWorker,
+      initargs=(cache.url if cache else None,),
+    )
+    bar = progressbar.ProgressBar(max_value=file_count)
+    done_count = 0
+    in_flight = 0
+    jobs_exhausted = False
+    last_commit = time.time()
+    wall_time_start = time.time()
+    try:
+      while not jobs_exhausted or in_flight:
+        # Keep enough batches in flight to occupy every process.
+        while not jobs_exhausted and in_flight < processes * 2:
+          job = next(jobs, None)
+          if job is None:
+            jobs_exhausted = True
+            break
+          pool.apply_async(
+            PreprocessorBatchWorker,
+            (job,),
+            callback=results.put,
+            error_callback=results.put,
+          )
+          in_flight += 1
+        if not in_flight:
+          break
+
+        batch = results.get()
+        in_flight -= 1
+        if isinstance(batch, Exception):
+          raise batch
         wall_time_end = time.time()
-        preprocessed_cf.wall_time_ms = int(
-          (wall_time_end - wall_time_start) * 1000
+        batch_size.Update(
+          len(batch), sum(cf.preprocess_time_ms for cf in batch)
+        )
+        # Divide the wall time evenly between the files of the batch.
+        wall_time_ms = int(
+          (wall_time_end - wall_time_start) * 1000 / max(len(batch), 1)
         )
         wall_time_start = wall_time_end
-        session.add(preprocessed_cf)
+        session.bulk_insert_mappings(
+          PreprocessedContentFile,
+          [cf._replace(wall_time_ms=wall_time_ms)._asdict() for cf in batch],
+        )
+        if cache:
+          cache.AddMany(
+            [
+              (cf.input_sha256, cf.text, cf.preprocessing_succeeded)
+              for cf in batch
+            ],
+            preprocessors_sha256,
+          )
+        done_count += len(batch)
+        bar.update(done_count)
         if wall_time_end - last_commit > 10:
           session.commit()
           last_commit = wall_time_end
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def CopyUnchangedFromParent(
+    self,
+    session: sqlutil.Session,
+    parent: "PreprocessedContentFiles",
+    contentfile_root: pathlib.Path,
+    relpaths: typing.Set[str],
+  ) -> typing.Set[str]:
+    """Copy the pre-processed files which are unchanged from a parent database.
+
+    A file is unchanged if the parent database contains a file with the same
+    relative path and input checksum.
+
+    Args:
+      session: A session for this database.
+      parent: The parent database.
+      contentfile_root: The root of the content files directory.
+      relpaths: The relative paths of the content files to copy.
+
+    Returns:
+      The relative paths of the content files which were not copied.
+    """
+    start_time = time.time()
+    parent_sha256s = self.GetInputSha256s(parent)
+    candidates = [relpath for relpath in relpaths if relpath in parent_sha256s]
+    # Hashing is I/O bound and hashlib releases the GIL, so threads suffice.
+    with multiprocessing.pool.ThreadPool() as pool:
+      sha256s = pool.map(
+        lambda relpath: GetFileSha256(contentfile_root / relpath),
+        candidates,
+        chunksize=64,
+      )
+    unchanged = [
+      relpath
+      for relpath, sha256 in zip(candidates, sha256s)
+      if sha256 == parent_sha256s[relpath]
+    ]
+    self.CopyFromParent(session, parent, unchanged)
+
+    app.Log(
+      1,
+      "Copied %s of %s content files from parent corpus in %s ms",
+      humanize.Commas(len(unchanged)),
+      humanize.Commas(len(relpaths)),
+      humanize.Commas(int((time.time() - start_time) * 1000)),
+    )
+    return relpaths - set(unchanged)
+
+  @staticmethod
+  def GetInputSha256s(
+    db: "PreprocessedContentFiles",
+  ) -> typing.Dict[str, str]:
+    """Return a map from input relpath to input checksum for a database."""
+    with db.Session() as session:
+      return {
+        relpath: sha256
+        for relpath, sha256 in session.query(
+          PreprocessedContentFile.input_relpath,
+          PreprocessedContentFile.input_sha256,
+        )
+      }
+
+  def CopyFromParent(
+    self,
+    session: sqlutil.Session,
+    parent: "PreprocessedContentFiles",
+    relpaths: typing.List[str],
+  ) -> None:
+    """Copy pre-processed files from a parent database.
+
+    Args:
+      session: A session for this database.
+      parent: The parent database.
+      relpaths: The relative paths of the content files to copy.
+    """
+    columns = [
+      column
+      for column in sqlutil.ColumnNames(PreprocessedContentFile)
+      if column != "id"
+    ]
+    with parent.Session() as parent_session:
+      # Copy in batches small enough to stay within SQLite's limit on the
+      # number of query parameters.
+      for i in range(0, len(relpaths), 500):
+        rows = parent_session.query(PreprocessedContentFile).filter(
+          PreprocessedContentFile.input_relpath.in_(relpaths[i : i + 500])
+        )
+        session.bulk_insert_mappings(
+          PreprocessedContentFile,
+          [{column: getattr(row, column) for column in columns} for row in rows],
+        )
+    session.commit()
 
   @contextlib.contextmanager
   def GetContentFileRoot(self, config: corpus_pb2.Corpus) -> pathlib.Path:
     """Get the path of the directory containing content files.
 
-    If the corpus is a local directory, this simply returns the path. Otherwise,
-    this method creates a temporary copy of the files which can be used within
-    the scope of this context.
+    Tar archives are read directly by ImportFromArchive(), so only local
+    directories are supported.
 
     Args:
       config: The corpus config proto.
@@ -258,24 +745,6 @@ class PreprocessedContentFiles(sqlutil.Database):
     """
     if config.HasField("local_directory"):
       yield pathlib.Path(ExpandConfigPath(config.local_directory))
-    elif config.HasField("local_tar_archive"):
-      with tempfile.TemporaryDirectory(prefix="clgen_corpus_") as d:
-        start_time = time.time()
-        cmd = [
-          "tar",
-          "-xf",
-          str(ExpandConfigPath(config.local_tar_archive)),
-          "-C",
-          d,
-        ]
-        subprocess.check_call(cmd)
-        app.Log(
-          1,
-          "Unpacked %s in %s ms",
-          ExpandConfigPath(config.local_tar_archive).name,
-          humanize.Commas(int((time.time() - start_time) * 1000)),
-        )
-        yield pathlib.Path(d)
     else:
       raise NotImplementedError
 
@@ -0,0 +1,192 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""Unit tests for //deeplearning/clgen/corpuses:preprocessed."""
+import hashlib
+import pathlib
+import tarfile
+
+from deeplearning.clgen.corpuses import preprocessed
+from deeplearning.clgen.corpuses import preprocessing_cache
+from deeplearning.clgen.proto import corpus_pb2
+from deeplearning.clgen.proto import internal_pb2
+from labm8.py import app
+from labm8.py import test
+
+FLAGS = app.FLAGS
+
+pytest_plugins = ["deeplearning.clgen.tests.fixtures"]
+
+
+def test_PreprocessorBatchWorker(tempdir: pathlib.Path):
+  """Test that a batch worker returns a tuple for each file."""
+  (tempdir / "a.txt").write_text("Hello\n")
+  (tempdir / "b.txt").write_text("A\nB\nC")
+  outputs = preprocessed.PreprocessorBatchWorker(
+    internal_pb2.PreprocessorBatchWorker(
+      contentfile_root=str(tempdir),
+      relpath=["a.txt", "b.txt"],
+      preprocessors=[
+        "deeplearning.clgen.preprocessors.common:StripDuplicateEmptyLines"
+      ],
+    )
+  )
+  assert [(x.input_relpath, x.linecount) for x in outputs] == [
+    ("a.txt", 2),
+    ("b.txt", 3),
+  ]
+  assert all(x.preprocessing_succeeded for x in outputs)
+
+
+def test_AdaptiveBatchSize_Update():
+  """Test that the batch size tracks the target batch time."""
+  batch_size = preprocessed.AdaptiveBatchSize(
+    target_batch_time_ms=100, initial_batch_size=8, max_batch_size=50
+  )
+  assert batch_size.batch_size == 8
+  # 10 ms per file.
+  assert batch_size.Update(8, 80) == 10
+  # Fast files are capped at the maximum batch size.
+  for _ in range(20):
+    batch_size.Update(10, 0)
+  assert batch_size.batch_size == 50
+  # Slow files are never batched with less than one file.
+  for _ in range(20):
+    batch_size.Update(1, 1000)
+  assert batch_size.batch_size == 1
+
+
+def test_PreprocessedContentFiles_Create(tempdir: pathlib.Path):
+  """Test that every content file is inserted into the database and cache."""
+  (tempdir / "contentfiles").mkdir()
+  for i in range(50):
+    (tempdir / "contentfiles" / f"{i}.txt").write_text(f"File {i}\n")
+  db = preprocessed.PreprocessedContentFiles(
+    f"sqlite:///{tempdir}/preprocessed.db"
+  )
+  cache = preprocessing_cache.PreprocessingCache(
+    f"sqlite:///{tempdir}/cache.db"
+  )
+  db.Create(
+    corpus_pb2.Corpus(
+      local_directory=str(tempdir / "contentfiles"),
+      ascii_character_atomizer=True,
+      contentfile_separator="\n\n",
+      preprocessor=[
+        "deeplearning.clgen.preprocessors.common:StripDuplicateEmptyLines"
+      ],
+    ),
+    cache=cache,
+  )
+  assert db.size == 50
+  with db.Session() as session:
+    texts = {
+      cf.input_relpath: cf.text
+      for cf in session.query(preprocessed.PreprocessedContentFile)
+    }
+  assert texts["./7.txt"] == "File 7\n"
+  with cache.Session() as session:
+    assert (
+      session.query(preprocessing_cache.PreprocessingCacheEntry).count() == 50
+    )
+
+
+def test_PreprocessedContentFiles_Create_tar_archive(tempdir: pathlib.Path):
+  """Test that the files of an archive are pre-processed without unpacking."""
+  (tempdir / "contentfiles").mkdir()
+  for i in range(50):
+    (tempdir / "contentfiles" / f"{i}.txt").write_text(f"File {i}\n\n\n")
+  with tarfile.open(tempdir / "contentfiles.tar.bz2", "w:bz2") as tar:
+    tar.add(tempdir / "contentfiles", arcname="contentfiles")
+  db = preprocessed.PreprocessedContentFiles(
+    f"sqlite:///{tempdir}/preprocessed.db"
+  )
+  db.Create(
+    corpus_pb2.Corpus(
+      local_tar_archive=str(tempdir / "contentfiles.tar.bz2"),
+      ascii_character_atomizer=True,
+      contentfile_separator="\n\n",
+      preprocessor=[
+        "deeplearning.clgen.preprocessors.common:StripDuplicateEmptyLines"
+      ],
+    )
+  )
+  assert db.size == 50
+  with db.Session() as session:
+    texts = {
+      cf.input_relpath: cf.text
+      for cf in session.query(preprocessed.PreprocessedContentFile)
+    }
+  assert texts["./contentfiles/7.txt"] == "File 7\n"
+
+
+def test_PreprocessorBatchWorker_contents(tempdir: pathlib.Path):
+  """Test that a batch worker uses file contents from the job."""
+  outputs = preprocessed.PreprocessorBatchWorker(
+    internal_pb2.PreprocessorBatchWorker(
+      contentfile_root=str(tempdir),
+      relpath=["a.txt"],
+      contents=[b"Hello\r\nWorld"],
+      preprocessors=[],
+    )
+  )
+  assert outputs[0].text == "Hello\nWorld"
+  assert (
+    outputs[0].input_sha256 == hashlib.sha256(b"Hello\r\nWorld").hexdigest()
+  )
+
+
+def test_PreprocessorBatchWorker_preprocessing_cache(tempdir: pathlib.Path):
+  """Test that cached results are returned without pre-processing."""
+  (tempdir / "a.txt").write_text("Hello\n")
+  (tempdir / "b.txt").write_text("World\n")
+  preprocessors = [
+    "deeplearning.clgen.preprocessors.common:StripDuplicateEmptyLines"
+  ]
+  cache = preprocessing_cache.PreprocessingCache(
+    f"sqlite:///{tempdir}/cache.db"
+  )
+  cache.AddMany(
+    [(preprocessed.GetFileSha256(tempdir / "a.txt"), "Cached", False)],
+    preprocessing_cache.GetPreprocessorsSha256(preprocessors),
+  )
+  outputs = preprocessed.PreprocessorBatchWorker(
+    internal_pb2.PreprocessorBatchWorker(
+      contentfile_root=str(tempdir),
+      relpath=["a.txt", "b.txt"],
+      preprocessors=preprocessors,
+      preprocessing_cache_url=cache.url,
+    )
+  )
+  assert [(x.text, x.preprocessing_succeeded) for x in outputs] == [
+    ("Cached", False),
+    ("World\n", True),
+  ]
+  assert outputs[0].input_charcount == len("Hello")
+
+
+def test_GetWorkerPreprocessingCache_reused(tempdir: pathlib.Path):
+  """Test that a worker opens its preprocessing cache once."""
+  url = f"sqlite:///{tempdir}/cache.db"
+  preprocessed.InitPreprocessorWorker(url)
+  cache = preprocessed.GetWorkerPreprocessingCache(url)
+  assert preprocessed.GetWorkerPreprocessingCache(url) is cache
+  assert (
+    preprocessed.GetWorkerPreprocessingCache(f"sqlite:///{tempdir}/other.db")
+    is not cache
+  )
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -0,0 +1,144 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""This file defines a content-addressed cache of pre-processing results.
+
+The same input file is often pre-processed many times, for example vendored
+headers and forked repositories within a corpus, or overlapping content files
+across corpuses. The cache maps the sha256 of an input file and of the list of
+preprocessors run on it to the pre-processed text and success flag, so that
+the preprocessors need only be run once for each unique input.
+"""
+import datetime
+import hashlib
+import typing
+
+import sqlalchemy as sql
+from sqlalchemy.ext import declarative
+
+from labm8.py import sqlutil
+
+Base = declarative.declarative_base()
+
+# The maximum number of checksums in a single query, to stay within SQLite's
+# limit on the number of query parameters.
+_QUERY_BATCH_SIZE = 500
+
+# The insert prefix which ignores rows that are already in the table.
+_INSERT_IGNORE_PREFIXES = {"sqlite": "OR IGNORE", "mysql": "IGNORE"}
+
+
+class PreprocessingCacheEntry(Base):
+  """The result of pre-processing an input file."""
+
+  __tablename__ = "preprocessing_cache"
+
+  # Checksum of the input file.
+  input_sha256: str = sql.Column(sql.String(64), primary_key=True)
+  # Checksum of the list of preprocessors. See GetPreprocessorsSha256().
+  preprocessors_sha256: str = sql.Column(sql.String(64), primary_key=True)
+  text: str = sql.Column(
+    sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable=False
+  )
+  preprocessing_succeeded: bool = sql.Column(sql.Boolean, nullable=False)
+  date_added: datetime.datetime = sql.Column(
+    sql.DateTime, nullable=False, default=datetime.datetime.utcnow
+  )
+
+
+def GetPreprocessorsSha256(preprocessors_: typing.Iterable[str]) -> str:
+  """Return the checksum of a list of preprocessors.
+
+  The order of preprocessors is significant, so it is included in the checksum.
+  """
+  return hashlib.sha256("\n".join(preprocessors_).encode("utf-8")).hexdigest()
+
+
+class PreprocessingCache(sqlutil.Database):
+  """A database of pre-processing results, shared across corpuses."""
+
+  def __init__(self, url: str, must_exist: bool = False):
+    super(PreprocessingCache, self).__init__(url, Base, must_exist=must_exist)
+
+  def GetMany(
+    self, input_sha256s: typing.Iterable[str], preprocessors_sha256: str
+  ) -> typing.Dict[str, typing.Tuple[str, bool]]:
+    """Look up the results of pre-processing a set of input files.
+
+    Args:
+      input_sha256s: The checksums of the input files.
+      preprocessors_sha256: The checksum of the list of preprocessors.
+
+    Returns:
+      A map from input checksum to a <text, preprocessing_succeeded> tuple for
+      each input file in the cache.
+    """
+    input_sha256s = list(set(input_sha256s))
+    results = {}
+    with self.Session() as session:
+      for i in range(0, len(input_sha256s), _QUERY_BATCH_SIZE):
+        query = session.query(
+          PreprocessingCacheEntry.input_sha256,
+          PreprocessingCacheEntry.text,
+          PreprocessingCacheEntry.preprocessing_succeeded,
+        ).filter(
+          PreprocessingCacheEntry.preprocessors_sha256 == preprocessors_sha256,
+          PreprocessingCacheEntry.input_sha256.in_(
+            input_sha256s[i : i + _QUERY_BATCH_SIZE]
+          ),
+        )
+        results.update(
+          {sha256: (text, succeeded) for sha256, text, succeeded in query}
+        )
+    return results
+
+  def AddMany(
+    self,
+    results: typing.Iterable[typing.Tuple[str, str, bool]],
+    preprocessors_sha256: str,
+  ) -> int:
+    """Add the results of pre-processing to the cache.
+
+    Results for inputs which are already in the cache are ignored.
+
+    Args:
+      results: A sequence of <input_sha256, text, preprocessing_succeeded>
+        tuples.
+      preprocessors_sha256: The checksum of the list of preprocessors.
+
+    Returns:
+      The number of entries added.
+    """
+    results = {sha256: (text, ok) for sha256, text, ok in results}
+    if not results:
+      return 0
+    now = datetime.datetime.utcnow()
+    mappings = [
+      {
+        "input_sha256": sha256,
+        "preprocessors_sha256": preprocessors_sha256,
+        "text": text,
+        "preprocessing_succeeded": succeeded,
+        "date_added": now,
+      }
+      for sha256, (text, succeeded) in results.items()
+    ]
+    # The cache is shared by corpuses which may be created concurrently, so
+    # rows are inserted in a single statement which skips existing rows,
+    # rather than by checking for existing rows first.
+    insert = PreprocessingCacheEntry.__table__.insert().prefix_with(
+      _INSERT_IGNORE_PREFIXES[self.engine.dialect.name]
+    )
+    with self.Session(commit=True) as session:
+      return session.execute(insert, mappings).rowcount
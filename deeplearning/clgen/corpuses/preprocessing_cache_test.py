@@ -0,0 +1,87 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""Unit tests for //deeplearning/clgen/corpuses:preprocessing_cache."""
+import pathlib
+
+from deeplearning.clgen.corpuses import preprocessing_cache
+from labm8.py import app
+from labm8.py import test
+
+FLAGS = app.FLAGS
+
+pytest_plugins = ["deeplearning.clgen.tests.fixtures"]
+
+
+@test.Fixture(scope="function")
+def db(tempdir: pathlib.Path) -> preprocessing_cache.PreprocessingCache:
+  """An empty preprocessing cache."""
+  return preprocessing_cache.PreprocessingCache(f"sqlite:///{tempdir}/cache.db")
+
+
+def test_GetPreprocessorsSha256_order():
+  """Test that the order of preprocessors changes the checksum."""
+  assert preprocessing_cache.GetPreprocessorsSha256(
+    ["a", "b"]
+  ) != preprocessing_cache.GetPreprocessorsSha256(["b", "a"])
+
+
+def test_PreprocessingCache_GetMany_empty(
+  db: preprocessing_cache.PreprocessingCache,
+):
+  """Test that an empty cache has no results."""
+  assert db.GetMany(["0" * 64], "1" * 64) == {}
+
+
+def test_PreprocessingCache_AddMany_GetMany(
+  db: preprocessing_cache.PreprocessingCache,
+):
+  """Test that added results can be looked up."""
+  assert db.AddMany([("a", "A", True), ("b", "error", False)], "x") == 2
+  assert db.GetMany(["a", "b", "c"], "x") == {
+    "a": ("A", True),
+    "b": ("error", False),
+  }
+  # Results are specific to the list of preprocessors.
+  assert db.GetMany(["a", "b", "c"], "y") == {}
+
+
+def test_PreprocessingCache_AddMany_ignores_duplicates(
+  db: preprocessing_cache.PreprocessingCache,
+):
+  """Test that results which are already cached are not added again."""
+  assert db.AddMany([("a", "A", True), ("a", "A", True)], "x") == 1
+  assert db.AddMany([("a", "A", True), ("b", "B", True)], "x") == 1
+
+
+def test_PreprocessingCache_GetMany_many_inputs(
+  db: preprocessing_cache.PreprocessingCache,
+):
+  """Test a lookup of more inputs than SQLite allows query parameters."""
+  results = [(str(i), str(i), True) for i in range(1200)]
+  assert db.AddMany(results, "x") == 1200
+  assert len(db.GetMany([str(i) for i in range(1200)], "x")) == 1200
+
+
+def test_PreprocessingCache_AddMany_concurrent_writers(tempdir: pathlib.Path):
+  """Test that results added by another writer are skipped."""
+  db1 = preprocessing_cache.PreprocessingCache(f"sqlite:///{tempdir}/cache.db")
+  db2 = preprocessing_cache.PreprocessingCache(f"sqlite:///{tempdir}/cache.db")
+  assert db1.AddMany([("a", "A", True)], "x") == 1
+  assert db2.AddMany([("a", "A", True), ("b", "B", True)], "x") == 1
+  assert db1.GetMany(["a", "b"], "x") == {"a": ("A", True), "b": ("B", True)}
+
+
+if __name__ == "__main__":
+  test.Main()
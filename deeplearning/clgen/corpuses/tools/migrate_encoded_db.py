@@ -0,0 +1,156 @@
+"""Convert encoded databases from the legacy text format to binary arrays.
+
+Encoded databases created before the introduction of binary storage store the
+vocabulary indices of each contentfile as a string of period-separated
+integers. This tool rewrites the encoded contentfiles table of such a database
+in-place, storing each indices array as the raw bytes of a little-endian
+integer array.
+
+Usage:
+
+    bazel run //deeplearning/clgen/corpuses/tools:migrate_encoded_db -- \
+        --encoded_db='sqlite:////path/to/encoded.db'
+
+or, to migrate every encoded database in the CLgen cache:
+
+    bazel run //deeplearning/clgen/corpuses/tools:migrate_encoded_db -- \
+        --all_cached_corpuses
+"""
+import typing
+
+import sqlalchemy as sql
+
+from deeplearning.clgen import cache
+from deeplearning.clgen.corpuses import encoded
+from labm8.py import app
+from labm8.py import humanize
+from labm8.py import sqlutil
+
+FLAGS = app.FLAGS
+
+app.DEFINE_list(
+  "encoded_db", [], "The URLs of the encoded databases to migrate.",
+)
+app.DEFINE_boolean(
+  "all_cached_corpuses",
+  False,
+  "Migrate all of the encoded databases in the CLgen cache.",
+)
+app.DEFINE_integer(
+  "migrate_batch_size",
+  10000,
+  "The number of contentfiles to convert in a batch.",
+)
+
+# The name of the temporary table that migrated rows are written to.
+_MIGRATED_TABLE_NAME = "encoded_contentfiles_migrated"
+
+
+def _ConvertRow(row) -> typing.Dict[str, typing.Any]:
+  """Convert a row of the legacy table to a row of the migrated table."""
+  indices = encoded.EncodedContentFile.DataStringToNumpyArray(row.data)
+  # The vocabulary size is not recorded in the legacy table, so we pick the
+  # narrowest type that can hold the largest index in this contentfile.
+  dtype = encoded.EncodedContentFile.GetDataDtype(
+    int(indices.max()) + 1 if indices.size else 0
+  )
+  return {
+    "id": row.id,
+    "data": encoded.EncodedContentFile.NumpyArrayToDataBytes(indices, dtype),
+    "data_itemsize": dtype.itemsize,
+    "tokencount": row.tokencount,
+    "encoding_time_ms": row.encoding_time_ms,
+    "wall_time_ms": row.wall_time_ms,
+    "date_added": row.date_added,
+  }
+
+
+def MigrateEncodedDatabase(url: str, batch_size: int = 10000) -> bool:
+  """Convert the encoded contentfiles of a database to binary storage.
+
+  Args:
+    url: The URL of the encoded database.
+    batch_size: The number of contentfiles to convert in a batch.
+
+  Returns:
+    True if the database was migrated, False if it was already in the binary
+    format.
+  """
+  engine = sqlutil.CreateEngine(url, must_exist=True)
+  if not encoded.HasLegacyDataFormat(engine):
+    app.Log(1, "Encoded database '%s' does not need migrating", url)
+    return False
+
+  metadata = sql.MetaData()
+  legacy_table = sql.Table(
+    encoded.EncodedContentFile.__tablename__, metadata, autoload_with=engine
+  )
+  migrated_table = encoded.EncodedContentFile.__table__.tometadata(
+    metadata, name=_MIGRATED_TABLE_NAME
+  )
+  # Discard the results of a previous interrupted migration.
+  migrated_table.drop(engine, checkfirst=True)
+  migrated_table.create(engine)
+
+  row_count = engine.execute(
+    sql.select([sql.func.count()]).select_from(legacy_table)
+  ).scalar()
+  app.Log(1, "Migrating %s encoded contentfiles", humanize.Commas(row_count))
+
+  # Iterate over the legacy table in batches of ascending IDs, which unlike
+  # OFFSET does not slow down as we progress through the table.
+  last_id = -1
+  migrated_count = 0
+  while True:
+    rows = engine.execute(
+      sql.select([legacy_table])
+      .where(legacy_table.c.id > last_id)
+      .order_by(legacy_table.c.id)
+      .limit(batch_size)
+    ).fetchall()
+    if not rows:
+      break
+    engine.execute(migrated_table.insert(), [_ConvertRow(row) for row in rows])
+    last_id = rows[-1].id
+    migrated_count += len(rows)
+    app.Log(
+      1,
+      "Migrated %s of %s encoded contentfiles",
+      humanize.Commas(migrated_count),
+      humanize.Commas(row_count),
+    )
+
+  with engine.begin() as connection:
+    legacy_table.drop(connection)
+    connection.execute(
+      f"ALTER TABLE {_MIGRATED_TABLE_NAME} "
+      f"RENAME TO {encoded.EncodedContentFile.__tablename__}"
+    )
+
+  # Reclaim the space freed by dropping the legacy table.
+  if engine.dialect.name == "sqlite":
+    engine.execute("VACUUM")
+  return True
+
+
+def Main():
+  """Main entry point."""
+  urls = list(FLAGS.encoded_db)
+  if FLAGS.all_cached_corpuses:
+    urls += [
+      f"sqlite:///{path.absolute()}"
+      for path in sorted(
+        cache.cachepath("corpus", "encoded").glob("*/encoded.db")
+      )
+    ]
+  if not urls:
+    raise app.UsageError(
+      "Flag is required: --encoded_db or --all_cached_corpuses"
+    )
+
+  for url in urls:
+    MigrateEncodedDatabase(url, batch_size=FLAGS.migrate_batch_size)
+
+
+if __name__ == "__main__":
+  app.Run(Main)
@@ -0,0 +1,83 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""Unit tests for //deeplearning/clgen/corpuses/tools:migrate_encoded_db."""
+import pathlib
+
+from deeplearning.clgen.corpuses import encoded
+from deeplearning.clgen.corpuses.tools import migrate_encoded_db
+from labm8.py import sqlutil
+from labm8.py import test
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function")
+def legacy_db_url(tempdir: pathlib.Path) -> str:
+  """An encoded database which stores its data in the legacy text format."""
+  url = f"sqlite:///{tempdir}/encoded.db"
+  engine = sqlutil.CreateEngine(url)
+  engine.execute(
+    """\
+CREATE TABLE encoded_contentfiles (
+  id INTEGER NOT NULL PRIMARY KEY,
+  data TEXT NOT NULL,
+  tokencount INTEGER NOT NULL,
+  encoding_time_ms INTEGER NOT NULL,
+  wall_time_ms INTEGER NOT NULL,
+  date_added DATETIME NOT NULL
+)"""
+  )
+  engine.execute(
+    "INSERT INTO encoded_contentfiles VALUES "
+    "(1, '0.1.2.0.1', 4, 1, 1, '2020-01-01 00:00:00.000000'), "
+    "(2, '70000.3', 1, 1, 1, '2020-01-01 00:00:00.000000')"
+  )
+  return url
+
+
+def test_MigrateEncodedDatabase_indices_array(legacy_db_url: str):
+  """Test that migrated contentfiles have the same indices."""
+  assert migrate_encoded_db.MigrateEncodedDatabase(legacy_db_url, batch_size=1)
+
+  db = encoded.EncodedContentFiles(legacy_db_url)
+  with db.Session() as s:
+    cfs = s.query(encoded.EncodedContentFile).order_by(
+      encoded.EncodedContentFile.id
+    )
+    assert [cf.indices_array.tolist() for cf in cfs] == [
+      [0, 1, 2, 0, 1],
+      [70000, 3],
+    ]
+
+
+def test_MigrateEncodedDatabase_data_itemsize(legacy_db_url: str):
+  """Test that each contentfile uses the narrowest type for its indices."""
+  migrate_encoded_db.MigrateEncodedDatabase(legacy_db_url)
+
+  db = encoded.EncodedContentFiles(legacy_db_url)
+  with db.Session() as s:
+    assert s.query(encoded.EncodedContentFile.data_itemsize).order_by(
+      encoded.EncodedContentFile.id
+    ).all() == [(2,), (4,)]
+
+
+def test_MigrateEncodedDatabase_already_migrated(legacy_db_url: str):
+  """Test that migrating a database twice is a no-op."""
+  assert migrate_encoded_db.MigrateEncodedDatabase(legacy_db_url)
+  assert not migrate_encoded_db.MigrateEncodedDatabase(legacy_db_url)
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -32,6 +32,10 @@ class BackendBase(object):
   A language model backend encapsulates all of the neural network logic.
   """
 
+  # If True, the backend implements InitSampleRows(), so that new samples can
+  # begin in a sampling batch while others are still in progress.
+  supports_continuous_batching: bool = False
+
   def __init__(
     self,
     config: model_pb2.Model,
@@ -56,6 +60,18 @@ class BackendBase(object):
     """Begin a new sampling batch. Only called after InitSampling()."""
     raise NotImplementedError
 
+  def InitSampleRows(self, sampler: samplers.Sampler, rows: np.ndarray) -> None:
+    """Begin new samples in rows of the current sampling batch.
+
+    Only called after InitSampleBatch(), and only for backends which set
+    supports_continuous_batching.
+
+    Args:
+      sampler: The sampler.
+      rows: A 1D array of the batch rows to begin new samples in.
+    """
+    raise NotImplementedError
+
   def SampleNextIndices(
     self, sampler: samplers.Sampler, done: np.ndarray
   ) -> np.ndarray:
@@ -19,9 +19,12 @@ a reasonable size, the full training data may not fit in memory. This modules
 provides Python Generator classes for use by a sequential Keras model's
 fit_generator() method to stream batches of training data.
 """
+import queue
 import sys
+import threading
 import time
 import typing
+import weakref
 
 import numpy as np
 
@@ -32,6 +35,13 @@ from labm8.py import humanize
 
 FLAGS = app.FLAGS
 
+app.DEFINE_integer(
+  "clgen_tf_prefetch_batches",
+  16,
+  "The number of training batches which the TensorFlow backend prepares ahead "
+  "of the training loop.",
+)
+
 
 class DataBatch(typing.NamedTuple):
   """An <X,y> data tuple used for training one batch."""
@@ -41,7 +51,9 @@ class DataBatch(typing.NamedTuple):
 
 
 def AutoGenerator(
-  corpus: "corpuses.Corpus", training_opts: model_pb2.TrainingOptions
+  corpus: "corpuses.Corpus",
+  training_opts: model_pb2.TrainingOptions,
+  sparse_targets: bool = False,
 ) -> typing.Generator[DataBatch, typing.Any, None]:
   """Determine and construct what we believe to be the best data generator.
 
@@ -51,15 +63,19 @@ def AutoGenerator(
   Args:
     corpus: A Corpus instance.
     training_opts: A TrainingOptions proto.
+    sparse_targets: If true, the y vectors are vocabulary indices rather than
+      one-hot encoded.
 
   Returns:
     A generator suitable for use by a model's fit_generator() method.
   """
-  return BatchGenerator(corpus, training_opts)
+  return BatchGenerator(corpus, training_opts, sparse_targets=sparse_targets)
 
 
 def BatchGenerator(
-  corpus: "corpuses.Corpus", training_opts: model_pb2.TrainingOptions
+  corpus: "corpuses.Corpus",
+  training_opts: model_pb2.TrainingOptions,
+  sparse_targets: bool = False,
 ) -> typing.Generator[DataBatch, typing.Any, None]:
   """A batch generator which lazily one-hot encodes the y vectors.
 
@@ -68,9 +84,15 @@ def BatchGenerator(
   y corpus, but that requires more memory than is available on many systems for
   a reasonable corpus.
 
+  With sparse targets, the y vectors are not one-hot encoded at all. Instead,
+  each y is an int32 array of shape (batch_size, sequence_length, 1) of
+  vocabulary indices, for use with a sparse_categorical_crossentropy loss.
+
   Args:
     corpus: A Corpus instance.
     training_opts: A TrainingOptions proto.
+    sparse_targets: If true, the y vectors are vocabulary indices rather than
+      one-hot encoded.
 
   Returns:
     A generator suitable for use by a model's fit_generator() method.
@@ -89,11 +111,12 @@ def BatchGenerator(
     y_epoch = np.split(np.roll(y, -epoch_num, axis=0), steps_per_epoch, axis=1)
     # Per-batch inner loop.
     for batch_num in range(steps_per_epoch):
-      batch = DataBatch(
-        X=x_epoch[batch_num],
+      if sparse_targets:
+        y_batch = y_epoch[batch_num].astype(np.int32)[..., np.newaxis]
+      else:
         # Lazy one-hot encoding.
-        y=OneHotEncode(y_epoch[batch_num], corpus.vocab_size),
-      )
+        y_batch = OneHotEncode(y_epoch[batch_num], corpus.vocab_size)
+      batch = DataBatch(X=x_epoch[batch_num], y=y_batch)
       if not batch_num and not epoch_num:
         LogBatchTelemetry(batch, steps_per_epoch, training_opts.num_epochs)
       yield batch
@@ -101,39 +124,27 @@ def BatchGenerator(
 
 
 class TensorflowBatchGenerator(object):
+  """A batch generator for the TensorFlow backend.
+
+  Batches are strided views into the encoded corpus, rather than copies. A
+  background thread prepares up to --clgen_tf_prefetch_batches batches ahead of
+  the training loop, and when shuffling between epochs, the next epoch's corpus
+  is shuffled by the same thread while the current epoch is training.
+  """
+
   def __init__(
     self, corpus: "corpuses.Corpus", training_opts: model_pb2.TrainingOptions
   ):
     self.corpus = corpus
     self.training_opts = training_opts
 
-    # Lazily instantiated.
-    self.encoded_corpus = None
-    self.num_batches = 0
-    self.batches = None
-    self.CreateBatches()
-
-    LogBatchTelemetry(
-      self.batches[0], self.num_batches, self.training_opts.num_epochs
-    )
-
-  def CreateBatches(self) -> None:
     start_time = time.time()
-
-    # generate a kernel corpus
     self.i = 0
-    if (
-      self.encoded_corpus is None
-      or self.training_opts.shuffle_corpus_contentfiles_between_epochs
-    ):
-      self.encoded_corpus = self.corpus.GetTrainingData(
-        shuffle=self.training_opts.shuffle_corpus_contentfiles_between_epochs
-      )
-
+    self.encoded_corpus = self.corpus.GetTrainingData(
+      shuffle=self.training_opts.shuffle_corpus_contentfiles_between_epochs
+    )
     batch_size = self.training_opts.batch_size
     sequence_length = self.training_opts.sequence_length
-
-    # set corpus size and number of batches
     self.num_batches = int(
       len(self.encoded_corpus) / (batch_size * sequence_length)
     )
@@ -141,23 +152,7 @@ class TensorflowBatchGenerator(object):
       raise errors.UserError(
         "Not enough data. Use a smaller sequence_length and batch_size"
       )
-
-    # split into batches
     clipped_corpus_length = self.num_batches * batch_size * sequence_length
-    clipped_corpus = self.encoded_corpus[:clipped_corpus_length]
-    xdata = clipped_corpus
-    ydata = np.copy(clipped_corpus)
-
-    # Wrap-around.
-    ydata[:-1] = xdata[1:]
-    ydata[-1] = xdata[0]
-    self.batches = [
-      DataBatch(x, y)
-      for x, y in zip(
-        np.split(xdata.reshape(batch_size, -1), self.num_batches, 1),
-        np.split(ydata.reshape(batch_size, -1), self.num_batches, 1),
-      )
-    ]
     app.Log(
       1,
       "Encoded corpus of %s tokens (clipped last %s tokens) in %s ms.",
@@ -166,17 +161,256 @@ class TensorflowBatchGenerator(object):
       humanize.Commas(int((time.time() - start_time) * 1000)),
     )
 
+    # Lazily instantiated by CreateBatches().
+    self._batches: typing.Optional[queue.Queue] = None
+    self._thread: typing.Optional[threading.Thread] = None
+    self._stop = threading.Event()
+    # The prefetch thread does not reference this object, so the thread is
+    # stopped when this object is garbage collected.
+    weakref.finalize(self, self._stop.set)
+
+    LogBatchTelemetry(
+      GetTensorflowBatch(
+        self.encoded_corpus, 0, self.num_batches, batch_size, sequence_length
+      ),
+      self.num_batches,
+      self.training_opts.num_epochs,
+    )
+
+  def CreateBatches(self) -> None:
+    """Begin a new epoch of batches.
+
+    The first call starts the prefetch thread, which produces batches for this
+    and every subsequent epoch.
+    """
+    self.i = 0
+    if self._batches is None:
+      self._batches = queue.Queue(
+        maxsize=max(FLAGS.clgen_tf_prefetch_batches, 1)
+      )
+      self._thread = threading.Thread(
+        target=_PrefetchTensorflowBatches,
+        args=(
+          self.corpus,
+          self.training_opts,
+          self.encoded_corpus,
+          self.num_batches,
+          self._batches,
+          self._stop,
+        ),
+        daemon=True,
+      )
+      self._thread.start()
+      # The prefetch thread owns the corpus from now on.
+      self.encoded_corpus = None
+
   def NextBatch(self) -> DataBatch:
     """Fetch next batch.
 
     Returns:
       X, Y DataBatch.
+
+    Raises:
+      Exception: If the prefetch thread failed to produce the batch.
     """
-    batch = self.batches[self.i]
+    batch = self._batches.get()
+    if isinstance(batch, Exception):
+      raise batch
     self.i += 1
     assert 0 <= self.i <= self.num_batches
     return batch
 
+  def Close(self) -> None:
+    """Stop the prefetch thread and wait for it to release the corpus."""
+    self._stop.set()
+    if self._thread:
+      # Drain the queue, so that a thread which is blocked on a full queue
+      # returns promptly.
+      while True:
+        try:
+          self._batches.get_nowait()
+        except queue.Empty:
+          break
+      self._thread.join()
+      self._thread = None
+
+
+class TensorflowDatasetGenerator(object):
+  """A tf.data input pipeline for the TensorFlow backend.
+
+  The pipeline produces the same batches as TensorflowBatchGenerator, in the
+  same order, so that the recurrent state carries over between batches. Batches
+  are read from the encoded corpus by parallel map calls, and prefetched by the
+  TensorFlow runtime, so the training loop does not feed batches from Python.
+  """
+
+  def __init__(
+    self, corpus: "corpuses.Corpus", training_opts: model_pb2.TrainingOptions
+  ):
+    self.corpus = corpus
+    self.training_opts = training_opts
+    self.encoded_corpus = self.corpus.GetTrainingData(
+      shuffle=self.training_opts.shuffle_corpus_contentfiles_between_epochs
+    )
+    self.num_batches = int(
+      len(self.encoded_corpus)
+      / (self.training_opts.batch_size * self.training_opts.sequence_length)
+    )
+    if self.num_batches == 0:
+      raise errors.UserError(
+        "Not enough data. Use a smaller sequence_length and batch_size"
+      )
+    self.epoch_num = 0
+
+    # Lazily instantiated by GetNext().
+    self.iterator = None
+
+  def GetNext(self, tf) -> typing.Tuple["tf.Tensor", "tf.Tensor"]:
+    """Build the input pipeline in the current TensorFlow graph.
+
+    Args:
+      tf: The imported TensorFlow module.
+
+    Returns:
+      A pair of X and y tensors of shape (batch_size, sequence_length).
+    """
+    batch_size = self.training_opts.batch_size
+    sequence_length = self.training_opts.sequence_length
+
+    def _ReadBatch(batch_num: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+      batch = GetTensorflowBatch(
+        self.encoded_corpus,
+        int(batch_num),
+        self.num_batches,
+        batch_size,
+        sequence_length,
+      )
+      return batch.X.astype(np.int32), batch.y.astype(np.int32)
+
+    def _MapBatch(batch_num):
+      x, y = tf.compat.v1.py_func(
+        _ReadBatch, [batch_num], [tf.int32, tf.int32], stateful=False
+      )
+      x.set_shape([batch_size, sequence_length])
+      y.set_shape([batch_size, sequence_length])
+      return x, y
+
+    # Dataset.map() preserves the order of elements, even when parallel.
+    dataset = (
+      tf.data.Dataset.range(self.num_batches)
+      .map(_MapBatch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+      .prefetch(max(FLAGS.clgen_tf_prefetch_batches, 1))
+    )
+    self.iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+    return self.iterator.get_next()
+
+  def CreateBatches(self, sess) -> None:
+    """Begin a new epoch of batches.
+
+    Args:
+      sess: The session to initialize the input pipeline in.
+    """
+    if (
+      self.epoch_num
+      and self.training_opts.shuffle_corpus_contentfiles_between_epochs
+    ):
+      self.encoded_corpus = None
+      self.encoded_corpus = self.corpus.GetTrainingData(shuffle=True)
+    self.epoch_num += 1
+    sess.run(self.iterator.initializer)
+
+  def Close(self) -> None:
+    """Release the encoded corpus."""
+    self.encoded_corpus = None
+
+
+def GetTensorflowBatch(
+  encoded_corpus: np.ndarray,
+  batch_num: int,
+  num_batches: int,
+  batch_size: int,
+  sequence_length: int,
+) -> DataBatch:
+  """Get a batch of the TensorFlow backend's training data.
+
+  The corpus is clipped to a multiple of batch_size * sequence_length and split
+  into batch_size rows. Batch i is columns [i * sequence_length, (i + 1) *
+  sequence_length) of the rows, and its targets are the inputs shifted by one
+  token, with the last token of the corpus wrapping around to the first.
+
+  Args:
+    encoded_corpus: The encoded corpus.
+    batch_num: The batch number, in the range [0, num_batches).
+    num_batches: The number of batches in an epoch.
+    batch_size: The number of rows in a batch.
+    sequence_length: The number of columns in a batch.
+
+  Returns:
+    A DataBatch. The X array, and the y array of every batch except the last,
+    are views into encoded_corpus.
+  """
+  x = encoded_corpus[: num_batches * batch_size * sequence_length].reshape(
+    batch_size, -1
+  )
+  start = batch_num * sequence_length
+  end = start + sequence_length
+  if batch_num < num_batches - 1:
+    return DataBatch(X=x[:, start:end], y=x[:, start + 1 : end + 1])
+
+  # The last column of each row's targets is the first token of the next row.
+  y = np.empty((batch_size, sequence_length), dtype=x.dtype)
+  y[:, :-1] = x[:, start + 1 :]
+  y[:, -1] = np.roll(x[:, 0], -1)
+  return DataBatch(X=x[:, start:end], y=y)
+
+
+def _PrefetchTensorflowBatches(
+  corpus: "corpuses.Corpus",
+  training_opts: model_pb2.TrainingOptions,
+  encoded_corpus: np.ndarray,
+  num_batches: int,
+  batches: queue.Queue,
+  stop: threading.Event,
+) -> None:
+  """Produce training batches for successive epochs until stopped.
+
+  Batches are copied into contiguous arrays, so that reading the corpus from
+  disk is done on this thread rather than during the training step. If the
+  thread fails, the exception is put on the queue in place of a batch.
+  """
+
+  def _Put(item) -> bool:
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  try:
+    while True:
+      for batch_num in range(num_batches):
+        batch = GetTensorflowBatch(
+          encoded_corpus,
+          batch_num,
+          num_batches,
+          training_opts.batch_size,
+          training_opts.sequence_length,
+        )
+        if not _Put(
+          DataBatch(
+            X=np.ascontiguousarray(batch.X), y=np.ascontiguousarray(batch.y)
+          )
+        ):
+          return
+      if training_opts.shuffle_corpus_contentfiles_between_epochs:
+        # Release the previous epoch's corpus before creating the next.
+        encoded_corpus = None
+        encoded_corpus = corpus.GetTrainingData(shuffle=True)
+  except Exception as e:
+    _Put(e)
+
 
 def GetTrainingCorpus(
   corpus: "corpuses.Corpus", training_opts: model_pb2.TrainingOptions
@@ -13,10 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """Unit tests for //deeplearning/clgen/models/data_generators.py."""
+import time
+
 import numpy as np
 
 from deeplearning.clgen import errors
 from deeplearning.clgen.models import data_generators
+from deeplearning.clgen.proto import model_pb2
 from labm8.py import app
 from labm8.py import test
 
@@ -62,6 +65,153 @@ def test_BatchGenerator_batch_size_too_large(abc_model_config):
   assert ("") == str(e_info.value)
 
 
+@test.Parametrize("sparse_targets", [False, True])
+def test_BatchGenerator_targets(abc_model_config, sparse_targets: bool):
+  """Test the shape and type of y vectors."""
+  opt = abc_model_config.training
+  opt.batch_size = 2
+  opt.sequence_length = 5
+  opt.shuffle_corpus_contentfiles_between_epochs = False
+  batch = next(
+    data_generators.BatchGenerator(
+      CorpusMock(corpus_length=100, vocabulary_size=10),
+      opt,
+      sparse_targets=sparse_targets,
+    )
+  )
+  assert batch.X.shape == (2, 5)
+  if sparse_targets:
+    assert batch.y.shape == (2, 5, 1)
+    assert batch.y.dtype == np.int32
+    np.testing.assert_array_equal(batch.y[..., 0], np.ones((2, 5)))
+  else:
+    assert batch.y.shape == (2, 5, 10)
+    np.testing.assert_array_equal(batch.y.argmax(axis=2), np.ones((2, 5)))
+
+
+# TensorflowBatchGenerator() tests.
+
+
+class RangeCorpusMock(object):
+  def __init__(self, corpus_length: int):
+    self.corpus_length = corpus_length
+    self.shuffle_count = 0
+
+  def GetTrainingData(self, shuffle: bool):
+    """Mock to return a corpus of ascending integers, reversed if shuffled."""
+    if shuffle:
+      self.shuffle_count += 1
+      return np.arange(self.corpus_length, dtype=np.int32)[::-1]
+    return np.arange(self.corpus_length, dtype=np.int32)
+
+
+def _EagerTensorflowBatches(encoded_corpus, batch_size, sequence_length):
+  """Split a corpus into batches by copying it, for comparison."""
+  num_batches = len(encoded_corpus) // (batch_size * sequence_length)
+  xdata = encoded_corpus[: num_batches * batch_size * sequence_length]
+  ydata = np.copy(xdata)
+  ydata[:-1] = xdata[1:]
+  ydata[-1] = xdata[0]
+  return list(
+    zip(
+      np.split(xdata.reshape(batch_size, -1), num_batches, 1),
+      np.split(ydata.reshape(batch_size, -1), num_batches, 1),
+    )
+  )
+
+
+@test.Parametrize("corpus_length", [60, 67])
+def test_GetTensorflowBatch_values(corpus_length: int):
+  """Test that batches are equal to splitting a copy of the corpus."""
+  encoded_corpus = np.arange(corpus_length, dtype=np.int32)
+  expected = _EagerTensorflowBatches(encoded_corpus, 3, 4)
+  for batch_num, (x, y) in enumerate(expected):
+    batch = data_generators.GetTensorflowBatch(
+      encoded_corpus, batch_num, len(expected), 3, 4
+    )
+    np.testing.assert_array_equal(batch.X, x)
+    np.testing.assert_array_equal(batch.y, y)
+
+
+def test_GetTensorflowBatch_views():
+  """Test that batches are views into the corpus, except the last targets."""
+  encoded_corpus = np.arange(60, dtype=np.int32)
+  first = data_generators.GetTensorflowBatch(encoded_corpus, 0, 5, 3, 4)
+  last = data_generators.GetTensorflowBatch(encoded_corpus, 4, 5, 3, 4)
+  assert np.shares_memory(first.X, encoded_corpus)
+  assert np.shares_memory(first.y, encoded_corpus)
+  assert np.shares_memory(last.X, encoded_corpus)
+  assert not np.shares_memory(last.y, encoded_corpus)
+
+
+def test_TensorflowBatchGenerator_epochs():
+  """Test that the generator produces the same batches every epoch."""
+  opts = model_pb2.TrainingOptions(
+    batch_size=3, sequence_length=4, num_epochs=2
+  )
+  generator = data_generators.TensorflowBatchGenerator(
+    RangeCorpusMock(67), opts
+  )
+  assert generator.num_batches == 5
+  expected = _EagerTensorflowBatches(np.arange(67, dtype=np.int32), 3, 4)
+  for _ in range(3):
+    generator.CreateBatches()
+    for x, y in expected:
+      batch = generator.NextBatch()
+      np.testing.assert_array_equal(batch.X, x)
+      np.testing.assert_array_equal(batch.y, y)
+  generator.Close()
+
+
+def test_TensorflowBatchGenerator_shuffle_between_epochs():
+  """Test that the next epoch uses a newly shuffled corpus."""
+  corpus = RangeCorpusMock(60)
+  opts = model_pb2.TrainingOptions(
+    batch_size=3,
+    sequence_length=4,
+    num_epochs=2,
+    shuffle_corpus_contentfiles_between_epochs=True,
+  )
+  generator = data_generators.TensorflowBatchGenerator(corpus, opts)
+  expected = _EagerTensorflowBatches(np.arange(60)[::-1], 3, 4)
+  for _ in range(2):
+    generator.CreateBatches()
+    for x, y in expected:
+      batch = generator.NextBatch()
+      np.testing.assert_array_equal(batch.X, x)
+      np.testing.assert_array_equal(batch.y, y)
+  generator.Close()
+  assert corpus.shuffle_count >= 2
+
+
+def test_TensorflowBatchGenerator_Close():
+  """Test that the prefetch thread exits once the generator is closed."""
+  opts = model_pb2.TrainingOptions(
+    batch_size=3,
+    sequence_length=4,
+    num_epochs=2,
+    shuffle_corpus_contentfiles_between_epochs=True,
+  )
+  generator = data_generators.TensorflowBatchGenerator(
+    RangeCorpusMock(60), opts
+  )
+  generator.CreateBatches()
+  generator.NextBatch()
+  thread = generator._thread
+  # Wait for the prefetch thread to block on the full queue.
+  while not generator._batches.full():
+    time.sleep(0.01)
+  generator.Close()
+  assert not thread.is_alive()
+
+
+def test_TensorflowBatchGenerator_not_enough_data():
+  """Test that an error is raised if the corpus is smaller than a batch."""
+  opts = model_pb2.TrainingOptions(batch_size=3, sequence_length=4)
+  with test.Raises(errors.UserError):
+    data_generators.TensorflowBatchGenerator(RangeCorpusMock(11), opts)
+
+
 # OneHotEncode() tests.
 
 
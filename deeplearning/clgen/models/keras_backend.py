@@ -30,6 +30,15 @@ from labm8.py import logutil
 
 FLAGS = app.FLAGS
 
+app.DEFINE_boolean(
+  "clgen_keras_sparse_targets",
+  True,
+  "If set, train Keras models on vocabulary indices using a sparse "
+  "categorical crossentropy loss, rather than one-hot encoded targets. The "
+  "loss is the same, but the memory required per batch is reduced by a factor "
+  "of the vocabulary size.",
+)
+
 
 class KerasBackend(backends.BackendBase):
   """A model with an embedding layer, using a keras backend."""
@@ -81,7 +90,11 @@ class KerasBackend(backends.BackendBase):
     with open(self.cache.keypath("model.yaml"), "w") as f:
       f.write(model.to_yaml())
     model.compile(
-      loss="categorical_crossentropy",
+      loss=(
+        "sparse_categorical_crossentropy"
+        if FLAGS.clgen_keras_sparse_targets
+        else "categorical_crossentropy"
+      ),
       optimizer=builders.BuildOptimizer(self.config),
     )
 
@@ -154,7 +167,11 @@ class KerasBackend(backends.BackendBase):
         telemetry.TrainingLogger(self.cache.path / "logs").KerasCallback(keras),
       ]
 
-      generator = data_generators.AutoGenerator(corpus, self.config.training)
+      generator = data_generators.AutoGenerator(
+        corpus,
+        self.config.training,
+        sparse_targets=FLAGS.clgen_keras_sparse_targets,
+      )
       steps_per_epoch = (corpus.encoded.token_count - 1) // (
         self.config.training.batch_size * self.config.training.sequence_length
       )
@@ -174,9 +191,18 @@ class KerasBackend(backends.BackendBase):
       )
     return model
 
-  def GetInferenceModel(self) -> "keras.models.Sequential":
-    """Like training model, but with different batch size."""
-    if self._inference_model:
+  def GetInferenceModel(
+    self, sampler: samplers.Sampler
+  ) -> "keras.models.Sequential":
+    """Like training model, but with different batch size.
+
+    The inference model accepts input sequences of any length, so that the
+    sampler start text can be fed in a single pass.
+    """
+    if (
+      self._inference_model
+      and self._inference_batch_size == sampler.batch_size
+    ):
       return self._inference_model
 
     # Deferred importing of Keras so that we don't have to activate the
@@ -187,7 +213,7 @@ class KerasBackend(backends.BackendBase):
     model = self.GetTrainingModel()
     config = model.get_config()
     app.Log(1, "Sampling with batch size %d", sampler.batch_size)
-    config[0]["config"]["batch_input_shape"] = (sampler.batch_size, 1)
+    config[0]["config"]["batch_input_shape"] = (sampler.batch_size, None)
     inference_model = keras.models.Sequential.from_config(config)
     inference_model.trainable = False
     inference_model.set_weights(model.get_weights())
@@ -198,34 +224,36 @@ class KerasBackend(backends.BackendBase):
   def InitSampling(
     self, sampler: samplers.Sampler, seed: typing.Optional[int] = None
   ) -> None:
-    self.inference_model = self.GetInferenceModel()
+    self.inference_model = self.GetInferenceModel(sampler)
     if seed is not None:
       np.random.seed(seed)
 
   def InitSampleBatch(self, sampler: samplers.Sampler) -> None:
     self.inference_model.reset_states()
-    # Set internal states from seed text.
-    for index in sampler.encoded_start_text[:-1]:
-      x = np.array([[index]] * sampler.batch_size)
-      # input shape: (batch_size, 1)
-      self.inference_model.predict(x)
-
-    self.inference_indices = [
-      sampler.encoded_start_text[-1]
-    ] * sampler.batch_size
+    # Set internal states from seed text, in a single pass.
+    if len(sampler.encoded_start_text) > 1:
+      x = np.tile(sampler.encoded_start_text[:-1], [sampler.batch_size, 1])
+      # Input shape: (batch_size, len(start_text) - 1).
+      self.inference_model.predict_on_batch(x)
+
+    self.inference_indices = np.full(
+      [sampler.batch_size], sampler.encoded_start_text[-1], dtype=np.int64
+    )
 
   def SampleNextIndices(self, sampler: samplers.Sampler, done: np.ndarray):
     del done
-    result = np.zeros((sampler.batch_size, 1024))
+    result = np.zeros((sampler.batch_size, 1024), dtype=np.int64)
     for idx in range(1024):
-      # Predict the next index for the entire batch.
+      # Predict the next index for the entire batch. predict_on_batch() runs
+      # the model's compiled predict function on the inputs directly, without
+      # the per-call overhead of predict().
       x = np.reshape(self.inference_indices, [sampler.batch_size, 1])
       # Input shape: (batch_size, 1).
-      probabilities = self.inference_model.predict(x)
+      probabilities = self.inference_model.predict_on_batch(x)
       # Output shape: (batch_size, 1, vocab_size).
-      self.inference_indices = [
-        WeightedPick(p.squeeze(), sampler.temperature) for p in probabilities
-      ]
+      self.inference_indices = WeightedPicks(
+        probabilities[:, -1, :], sampler.temperature
+      )
       result[:, idx] = self.inference_indices
     return result
 
@@ -268,3 +296,23 @@ def WeightedPick(predictions: np.ndarray, temperature: float) -> int:
   predictions = predictions_exp / np.sum(predictions_exp)
   predictions = np.random.multinomial(1, predictions, 1)
   return np.argmax(predictions)
+
+
+def WeightedPicks(predictions: np.ndarray, temperature: float) -> np.ndarray:
+  """Make a weighted choice from each row of a predictions array.
+
+  This is equivalent to calling WeightedPick() on each row, but the choices
+  are made for all rows at once using the Gumbel-max trick: the argmax of the
+  temperature-scaled log probabilities plus Gumbel noise is a sample from the
+  temperature-scaled distribution.
+
+  Args:
+    predictions: An array of probabilities of shape (n, vocab_size).
+    temperature: The softmax temperature.
+
+  Returns:
+    An array of n indices.
+  """
+  with np.errstate(divide="ignore"):
+    logits = np.log(np.asarray(predictions).astype("float64")) / temperature
+  return np.argmax(logits + np.random.gumbel(size=logits.shape), axis=1)
@@ -15,11 +15,14 @@
 """Unit tests for //deeplearning/clgen/models/keras_backend.py."""
 import checksumdir
 import numpy as np
+import pytest
 
 from deeplearning.clgen import sample_observers
+from deeplearning.clgen import samplers
 from deeplearning.clgen.models import keras_backend
 from deeplearning.clgen.models import models
 from deeplearning.clgen.proto import model_pb2
+from deeplearning.clgen.proto import sampler_pb2
 from deeplearning.clgen.proto import telemetry_pb2
 from labm8.py import app
 from labm8.py import crypto
@@ -57,6 +60,15 @@ class MockSampler(object):
     """Crude 'maxlen' mock."""
     return len(sample_in_progress) >= 10
 
+  # Batched termination uses the same 'maxlen' of 10 tokens.
+  terminators = [
+    samplers.MaxlenTerminationCriterion(
+      sampler_pb2.MaxTokenLength(maximum_tokens_in_sample=10)
+    )
+  ]
+  InitBatch = samplers.Sampler.InitBatch
+  GetCompletionPositions = samplers.Sampler.GetCompletionPositions
+
 
 @test.Fixture(scope="function")
 def abc_keras_model_config(abc_model_config: model_pb2.Model):
@@ -229,9 +241,9 @@ def test_KerasBackend_GetInferenceModel_predict_output_shape(
   """Test that predict() on inference model is one-hot encoded."""
   del clgen_cache_dir
   m = models.Model(abc_keras_model_config)
-  im, batch_size = m.backend.GetInferenceModel()
-  probabilities = im.predict(np.array([[0]]) * batch_size)
-  assert (batch_size, 1, m.corpus.vocab_size) == probabilities.shape
+  im = m.backend.GetInferenceModel(MockSampler(batch_size=2))
+  probabilities = im.predict_on_batch(np.array([[0]] * 2))
+  assert (2, 1, m.corpus.vocab_size) == probabilities.shape
 
 
 # WeightedPick() tests.
@@ -243,6 +255,35 @@ def test_WeightedPick_output_range():
   assert 0 <= keras_backend.WeightedPick(np.array(a), 1.0) <= len(a)
 
 
+# WeightedPicks() tests.
+
+
+def test_WeightedPicks_output_shape():
+  """Test that WeightedPicks() returns an index for each row."""
+  predictions = np.array([[0.1, 0.2, 0.3, 0.4]] * 5)
+  picks = keras_backend.WeightedPicks(predictions, 1.0)
+  assert picks.shape == (5,)
+  assert ((0 <= picks) & (picks < 4)).all()
+
+
+def test_WeightedPicks_zero_probability():
+  """Test that indices with zero probability are never picked."""
+  predictions = np.array([[0, 1, 0], [0, 0, 1]] * 50)
+  picks = keras_backend.WeightedPicks(predictions, 0.5)
+  assert picks.tolist() == [1, 2] * 50
+
+
+def test_WeightedPicks_distribution():
+  """Test that picks are distributed by the temperature-scaled probabilities."""
+  np.random.seed(0)
+  predictions = np.array([[0.1, 0.2, 0.7]] * 10000)
+  picks = keras_backend.WeightedPicks(predictions, 0.5)
+  expected = predictions[0] ** 2 / np.sum(predictions[0] ** 2)
+  assert np.bincount(picks, minlength=3) / 10000 == pytest.approx(
+    expected, abs=0.02
+  )
+
+
 # Benchmarks.
 
 
@@ -13,8 +13,11 @@
 # You should have received a copy of the GNU General Public License
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """The CLgen language model."""
+import multiprocessing
 import os
 import pathlib
+import queue as queue_lib
+import traceback
 import typing
 
 import numpy as np
@@ -32,6 +35,7 @@ from deeplearning.clgen.models import keras_backend
 from deeplearning.clgen.models import tensorflow_backend
 from deeplearning.clgen.proto import internal_pb2
 from deeplearning.clgen.proto import model_pb2
+from deeplearning.clgen.proto import sampler_pb2
 from deeplearning.clgen.proto import telemetry_pb2
 from labm8.py import app
 from labm8.py import crypto
@@ -44,6 +48,22 @@ from labm8.py import system
 
 FLAGS = app.FLAGS
 
+app.DEFINE_integer(
+  "clgen_sample_workers",
+  1,
+  "The number of processes to sample a model with. If greater than 1, each "
+  "worker process loads the model and produces a share of the samples, which "
+  "are passed to the sample observers by the calling process.",
+)
+
+# The maximum number of messages which each sample worker process may have
+# queued for the parent process. Once the queue is full, workers block until
+# the parent catches up.
+_SAMPLE_QUEUE_SIZE_PER_WORKER = 256
+# The number of seconds to wait for a message from the sample workers before
+# checking whether any of them have died.
+_SAMPLE_QUEUE_POLL_SECONDS = 10
+
 
 class Model(object):
   """A CLgen language model.
@@ -146,7 +166,9 @@ class Model(object):
     trained for does not affect the hash, since we can share checkpoints
     between different models if the only variable is the epoch count. E.g.
     we have a model trained for 10 epochs, we can use the checkpoint as the
-    starting point for a training a model for 20 epochs.
+    starting point for a training a model for 20 epochs. Likewise, the choice
+    of input pipeline does not change the training data, so does not affect
+    the hash.
 
     Args:
       corpus: A corpus instance.
@@ -159,6 +181,7 @@ class Model(object):
     config_to_hash.CopyFrom(config)
     config_to_hash.ClearField("corpus")
     config_to_hash.training.ClearField("num_epochs")
+    config_to_hash.training.ClearField("use_tf_data_input_pipeline")
     return crypto.sha1_list(corpus_.hash, config_to_hash.SerializeToString())
 
   def Create(self) -> bool:
@@ -237,6 +260,9 @@ class Model(object):
     model. Thus a call to Sample() is equivalent to calling Train() then
     Sample().
 
+    If --clgen_sample_workers is greater than 1, the samples are produced by
+    multiple worker processes. See _SampleInParallel().
+
     Args:
       sampler: The sampler to sample using.
       sample_observers: A list of SampleObserver objects that are notified of
@@ -266,12 +292,19 @@ class Model(object):
 
       atomizer = self.corpus.atomizer
       sampler.Specialize(atomizer)
-      self.backend.InitSampling(sampler, seed)
-      [obs.Specialize(self, sampler) for obs in sample_observers]
-
-      batch_count = 1
-      while self._SampleBatch(sampler, atomizer, sample_observers):
-        batch_count += 1
+      if FLAGS.clgen_sample_workers > 1:
+        [obs.Specialize(self, sampler) for obs in sample_observers]
+        batch_count = self._SampleInParallel(
+          sampler, sample_observers, seed, FLAGS.clgen_sample_workers
+        )
+      else:
+        self.backend.InitSampling(sampler, seed)
+        [obs.Specialize(self, sampler) for obs in sample_observers]
+
+        batch_count = 1
+        while self._SampleBatch(sampler, atomizer, sample_observers):
+          batch_count += 1
+      [obs.Flush() for obs in sample_observers]
 
       time_now = labdate.MillisecondsTimestamp()
       app.Log(
@@ -283,21 +316,147 @@ class Model(object):
         ),
       )
 
+  def _SampleInParallel(
+    self,
+    sampler: samplers.Sampler,
+    sample_observers: typing.List[sample_observers_lib.SampleObserver],
+    seed: typing.Optional[int],
+    num_workers: int,
+  ) -> int:
+    """Sample the model using multiple worker processes.
+
+    The sample budget is the smallest number of samples remaining for any of
+    the MaxSampleCountObserver sample observers, and is split evenly between
+    the workers. Without a budget, the workers sample until stopped. Each
+    worker loads the model with its own seed, and a share of the CPU threads.
+
+    Samples are passed to the sample observers in this process, in the order
+    that they are received. Once any sample observer returns False, all of the
+    workers are stopped, and samples which have not yet been received are
+    discarded.
+
+    Returns:
+      The total number of sample batches produced by the workers.
+
+    Raises:
+      InternalError: If sampling fails in a worker process.
+    """
+    budgets = [
+      obs.num_samples_remaining
+      for obs in sample_observers
+      if isinstance(obs, sample_observers_lib.MaxSampleCountObserver)
+    ]
+    shards = ShardSampleBudget(min(budgets) if budgets else None, num_workers)
+    if not shards:
+      return 0
+    seeds = DeriveWorkerSeeds(seed, len(shards))
+    num_threads = FLAGS.clgen_tf_backend_intra_op_threads or max(
+      multiprocessing.cpu_count() // len(shards), 1
+    )
+    app.Log(
+      1,
+      "Sampling with %d worker processes, %d threads per worker",
+      len(shards),
+      num_threads,
+    )
+
+    # TensorFlow is not fork-safe, so workers are started in new interpreters,
+    # and are passed the flags of this process.
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue(maxsize=_SAMPLE_QUEUE_SIZE_PER_WORKER * len(shards))
+    stop = ctx.Event()
+    workers = [
+      ctx.Process(
+        target=_SampleWorker,
+        args=(
+          ["clgen"] + app.FlagsToString().splitlines(),
+          self.config,
+          sampler.config,
+          worker_seed,
+          num_samples,
+          num_threads,
+          queue,
+          stop,
+        ),
+      )
+      for worker_seed, num_samples in zip(seeds, shards)
+    ]
+    for worker in workers:
+      worker.start()
+
+    batch_count = 0
+    num_running = len(workers)
+    error = None
+    try:
+      # Messages are <kind, payload> tuples. Each worker ends with a "done" or
+      # "error" message.
+      while num_running:
+        try:
+          kind, payload = queue.get(timeout=_SAMPLE_QUEUE_POLL_SECONDS)
+        except queue_lib.Empty:
+          # A worker which is killed, e.g. by the OOM killer, exits without
+          # sending a message.
+          dead_worker_error = _GetDeadSampleWorkerError(
+            workers, len(workers) - num_running
+          )
+          if dead_worker_error:
+            error = error or dead_worker_error
+            break
+          continue
+        if kind == "sample":
+          if stop.is_set():
+            continue
+          sample = model_pb2.Sample.FromString(payload)
+          if not all([obs.OnSample(sample) for obs in sample_observers]):
+            stop.set()
+        elif kind == "done":
+          num_running -= 1
+          batch_count += payload
+        else:
+          num_running -= 1
+          stop.set()
+          error = error or payload
+    finally:
+      stop.set()
+      for worker in workers:
+        if num_running:
+          worker.terminate()
+        worker.join()
+
+    if error:
+      raise errors.InternalError(f"Sample worker failed:\n{error}")
+    return batch_count
+
   def _SampleBatch(
     self,
     sampler: samplers.Sampler,
     atomizer: atomizers.AtomizerBase,
     sample_observers: typing.List[sample_observers_lib.SampleObserver],
   ) -> bool:
-    """Run a single iteration of the batched sample inner-loop."""
-    samples_in_progress = [
-      sampler.tokenized_start_text.copy() for _ in range(sampler.batch_size)
-    ]
+    """Run a single iteration of the batched sample inner-loop.
+
+    Completion is determined from the generated indices of every sample in the
+    batch at once, using per-sample state kept by the sampler. A sample's text
+    is decoded only once it is complete.
+
+    If the backend supports continuous batching, a row of the batch which
+    completes a sample begins a new sample straight away, so the batch stays
+    full until one of the sample observers returns False. Else the batch ends
+    once every sample in it is complete.
+    """
+    continuous = self.backend.supports_continuous_batching
+    start_text = "".join(sampler.tokenized_start_text)
+    start_token_count = len(sampler.tokenized_start_text)
+    # The arrays of indices generated for each sample in the batch.
+    generated = [[] for _ in range(sampler.batch_size)]
     done = np.zeros(sampler.batch_size, dtype=np.bool)
-    start_time = labdate.MillisecondsTimestamp()
-    wall_time_start = start_time
+    start_times = np.full(
+      sampler.batch_size, labdate.MillisecondsTimestamp(), dtype=np.int64
+    )
+    wall_time_start = start_times[0]
 
     self.backend.InitSampleBatch(sampler)
+    sampler.InitBatch(atomizer)
 
     # The return value of this method. If any of the sample_observers return
     # False, this value is set to False.
@@ -305,35 +464,50 @@ class Model(object):
 
     # Sampling loop. Continues until all samples in the batch are done.
     while not done.all():
-      indices = self.backend.SampleNextIndices(sampler, done)
-
-      # Iterate over all samples in batch to determine whether they're
-      # done.
-      for i in range(sampler.batch_size):
-        if done[i]:
+      indices = np.asarray(self.backend.SampleNextIndices(sampler, done))
+      rows = np.flatnonzero(~done)
+      indices = indices[rows].astype(np.int64)
+      positions = sampler.GetCompletionPositions(rows, indices)
+
+      for row, row_indices, position in zip(rows, indices, positions):
+        if position < 0:
+          generated[row].append(row_indices)
           continue
 
-        for index in indices[i]:
-          samples_in_progress[i].append(atomizer.decoder[index])
-          if sampler.SampleIsComplete(samples_in_progress[i]):
-            end_time = labdate.MillisecondsTimestamp()
-            done[i] = 1
-            sample = model_pb2.Sample(
-              text="".join(samples_in_progress[i]),
-              sample_start_epoch_ms_utc=start_time,
-              sample_time_ms=end_time - start_time,
-              wall_time_ms=end_time - wall_time_start,
-              num_tokens=len(samples_in_progress[i]),
-            )
-            # Notify sample observers.
-            continue_sampling &= all(
-              [obs.OnSample(sample) for obs in sample_observers]
-            )
-
-            # Wall sample time is the difference between the end of the previous
-            # sample and the end of the current sample.
-            wall_time_start = labdate.MillisecondsTimestamp()
-            break
+        generated[row].append(row_indices[: position + 1])
+        sample_indices = np.concatenate(generated[row])
+        end_time = labdate.MillisecondsTimestamp()
+        done[row] = 1
+        sample = model_pb2.Sample(
+          text=start_text + atomizer.DeatomizeIndices(sample_indices),
+          sample_start_epoch_ms_utc=int(start_times[row]),
+          sample_time_ms=int(end_time - start_times[row]),
+          wall_time_ms=int(end_time - wall_time_start),
+          num_tokens=start_token_count + len(sample_indices),
+        )
+        generated[row] = []
+        # Notify sample observers.
+        continue_sampling &= all(
+          [obs.OnSample(sample) for obs in sample_observers]
+        )
+
+        # Wall sample time is the difference between the end of the previous
+        # sample and the end of the current sample.
+        wall_time_start = labdate.MillisecondsTimestamp()
+
+      if not continuous:
+        continue
+      if not continue_sampling:
+        # Samples which are still in progress are discarded.
+        break
+      # Begin new samples in the rows which have completed.
+      finished_rows = rows[positions >= 0]
+      if finished_rows.size:
+        self.backend.InitSampleRows(sampler, finished_rows)
+        for row in finished_rows:
+          sampler.ResetRow(row)
+        done[finished_rows] = 0
+        start_times[finished_rows] = labdate.MillisecondsTimestamp()
 
     return continue_sampling
 
@@ -391,3 +565,121 @@ class Model(object):
 
   def __ne__(self, rhs) -> bool:
     return not self.__eq__(rhs)
+
+
+def ShardSampleBudget(
+  num_samples: typing.Optional[int], num_workers: int
+) -> typing.List[typing.Optional[int]]:
+  """Split a sample budget between worker processes.
+
+  Args:
+    num_samples: The total number of samples to produce, or None if unbounded.
+    num_workers: The maximum number of workers.
+
+  Returns:
+    A list of sample counts, one per worker. Workers which would produce no
+    samples are omitted.
+  """
+  if num_samples is None:
+    return [None] * num_workers
+  shards = [
+    num_samples // num_workers + (i < num_samples % num_workers)
+    for i in range(num_workers)
+  ]
+  return [shard for shard in shards if shard]
+
+
+def DeriveWorkerSeeds(
+  seed: typing.Optional[int], num_workers: int
+) -> typing.List[typing.Optional[int]]:
+  """Derive distinct RNG seeds for worker processes from a single seed.
+
+  Args:
+    seed: The seed of the parent process, or None if unseeded.
+    num_workers: The number of workers.
+
+  Returns:
+    A list of seeds, one per worker. If seed is None, the workers are seeded
+    randomly.
+  """
+  if seed is None:
+    return [None] * num_workers
+  return [
+    int(x)
+    for x in np.random.RandomState(seed).randint(0, 2 ** 31 - 1, num_workers)
+  ]
+
+
+def _GetDeadSampleWorkerError(
+  workers: typing.List[multiprocessing.Process], num_finished: int
+) -> typing.Optional[str]:
+  """Return an error message if a sample worker has died, else None.
+
+  A worker has died if it exited without sending a "done" or "error" message.
+  This must only be called once the message queue is empty, since a worker
+  which has exited may still have unread messages.
+
+  Args:
+    workers: The worker processes.
+    num_finished: The number of "done" or "error" messages received.
+  """
+  exit_codes = [worker.exitcode for worker in workers]
+  if sum(exit_code is not None for exit_code in exit_codes) <= num_finished:
+    return None
+  return f"Worker exited without finishing. Exit codes: {exit_codes}"
+
+
+class _WorkerSampleObserver(sample_observers_lib.SampleObserver):
+  """A sample observer which passes the samples of a worker to its parent."""
+
+  def __init__(
+    self,
+    queue: multiprocessing.Queue,
+    stop: multiprocessing.Event,
+    num_samples: typing.Optional[int],
+  ):
+    self.queue = queue
+    self.stop = stop
+    # The number of samples left to produce, or None if unbounded.
+    self.num_samples = num_samples
+
+  def OnSample(self, sample: model_pb2.Sample) -> bool:
+    """Sample receive callback. Returns True if sampling should continue."""
+    if self.stop.is_set() or self.num_samples == 0:
+      return False
+    self.queue.put(("sample", sample.SerializeToString()))
+    if self.num_samples is not None:
+      self.num_samples -= 1
+    return self.num_samples != 0
+
+
+def _SampleWorker(
+  argv: typing.List[str],
+  config: model_pb2.Model,
+  sampler_config: sampler_pb2.Sampler,
+  seed: typing.Optional[int],
+  num_samples: typing.Optional[int],
+  num_threads: int,
+  queue: multiprocessing.Queue,
+  stop: multiprocessing.Event,
+) -> None:
+  """Sample a model in a worker process. See Model._SampleInParallel()."""
+  try:
+    FLAGS(argv, known_only=True)
+    FLAGS.clgen_tf_backend_intra_op_threads = num_threads
+    model = Model(config)
+    # The model has been trained by the parent process. Train() is not called,
+    # since the workers would contend for the training lock.
+    model.Create()
+    atomizer = model.corpus.atomizer
+    sampler = samplers.Sampler(sampler_config)
+    sampler.Specialize(atomizer)
+    model.backend.InitSampling(sampler, seed)
+    observers = [_WorkerSampleObserver(queue, stop, num_samples)]
+
+    batch_count = 1
+    while model._SampleBatch(sampler, atomizer, observers):
+      batch_count += 1
+    queue.put(("done", batch_count))
+  except Exception:
+    queue.put(("error", traceback.format_exc()))
@@ -13,6 +13,8 @@
 # You should have received a copy of the GNU General Public License
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """Unit tests for //deeplearning/clgen/models/models.py."""
+import multiprocessing
+import os
 import pathlib
 
 from deeplearning.clgen import errors
@@ -67,6 +69,18 @@ def test_Model_config_hash_different_num_epochs(
   assert m1.hash == m2.hash
 
 
+def test_Model_config_hash_different_input_pipeline(
+  clgen_cache_dir, abc_model_config
+):
+  """Test that the input pipeline does not affect model hash."""
+  del clgen_cache_dir
+  abc_model_config.training.use_tf_data_input_pipeline = False
+  m1 = models.Model(abc_model_config)
+  abc_model_config.training.use_tf_data_input_pipeline = True
+  m2 = models.Model(abc_model_config)
+  assert m1.hash == m2.hash
+
+
 def test_Model_config_hash_different_corpus(clgen_cache_dir, abc_model_config):
   """Test that different corpuses produce different model hashes."""
   del clgen_cache_dir
@@ -148,6 +162,43 @@ def test_Model_atomizer_symlink(clgen_cache_dir, abc_model_config):
   assert path.endswith(str(m.corpus.atomizer_path))
 
 
+@test.Parametrize(
+  "num_samples,num_workers,shards",
+  [
+    (None, 2, [None, None]),
+    (10, 3, [4, 3, 3]),
+    (2, 4, [1, 1]),
+    (0, 2, []),
+  ],
+)
+def test_ShardSampleBudget(num_samples, num_workers, shards):
+  """Test that the sample budget is split evenly between workers."""
+  assert models.ShardSampleBudget(num_samples, num_workers) == shards
+
+
+def test_DeriveWorkerSeeds():
+  """Test that worker seeds are distinct and reproducible."""
+  seeds = models.DeriveWorkerSeeds(204, 4)
+  assert len(set(seeds)) == 4
+  assert seeds == models.DeriveWorkerSeeds(204, 4)
+  assert models.DeriveWorkerSeeds(None, 2) == [None, None]
+
+
+def test_GetDeadSampleWorkerError():
+  """Test that a worker which exits without finishing is detected."""
+  workers = [
+    multiprocessing.Process(target=os._exit, args=(exit_code,))
+    for exit_code in (0, 1)
+  ]
+  for worker in workers:
+    worker.start()
+    worker.join()
+  assert models._GetDeadSampleWorkerError(workers, 2) is None
+  assert models._GetDeadSampleWorkerError(workers, 1) == (
+    "Worker exited without finishing. Exit codes: [0, 1]"
+  )
+
+
 # TODO(cec): Add tests on ModelMeta contents.
 
 # TODO(cec): Add tests on log files and stderr logging.
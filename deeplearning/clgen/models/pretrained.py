@@ -78,6 +78,7 @@ class PreTrainedModel(object):
     wall_time_start = start_time
 
     self.backend.InitSampleBatch(sampler)
+    sampler.InitBatch(atomizer)
 
     # The return value of this method. If any of the sample_observers return
     # False, this value is set to False.
@@ -95,7 +96,7 @@ class PreTrainedModel(object):
 
         for index in indices[i]:
           samples_in_progress[i].append(atomizer.decoder[index])
-          if sampler.SampleIsComplete(samples_in_progress[i]):
+          if sampler.AppendIndex(i, index):
             end_time = labdate.MillisecondsTimestamp()
             done[i] = 1
             sample = model_pb2.Sample(
@@ -107,7 +108,7 @@ class PreTrainedModel(object):
             )
             # Notify sample observers.
             continue_sampling &= all(
-              [not obs.OnSample(sample) for obs in sample_observers]
+              [obs.OnSample(sample) for obs in sample_observers]
             )
 
             # Wall sample time is the difference between the end of the previous
@@ -163,6 +164,7 @@ class PreTrainedModel(object):
     batch_count = 0
     while self._SampleBatch(sampler, atomizer, sample_observers):
       batch_count += 1
+    [obs.Flush() for obs in sample_observers]
 
     time_now = labdate.MillisecondsTimestamp()
     app.Log(
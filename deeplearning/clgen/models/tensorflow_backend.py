@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU General Public License
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """CLgen models using a Keras backend."""
+import collections
 import copy
 import os
 import pathlib
@@ -50,11 +51,72 @@ app.DEFINE_integer(
   12,
   "The number of samples to make at the end of each training epoch.",
 )
+app.DEFINE_integer(
+  "clgen_tf_backend_inference_cache_size",
+  4,
+  "The maximum number of inference graphs and sessions to keep in memory for "
+  "re-use by later calls to sample a model. Once the limit is reached, the "
+  "least recently used inference session is closed.",
+)
+app.DEFINE_integer(
+  "clgen_tf_backend_intra_op_threads",
+  0,
+  "The number of threads used by each op of an inference session. If 0, "
+  "TensorFlow picks the number of threads.",
+)
+
+# The attributes of a TensorFlowBackend which are set by InitTfGraph().
+_GRAPH_ATTRIBUTES = (
+  "cell",
+  "input_data",
+  "targets",
+  "lengths",
+  "seed_length",
+  "temperature",
+  "initial_state",
+  "logits",
+  "generated",
+  "loss",
+  "final_state",
+  "learning_rate",
+  "epoch",
+  "train_op",
+)
+
+
+class InferenceGraph(object):
+  """A TensorFlow graph and session for sampling a model.
+
+  Building an inference graph and restoring weights into it is expensive, so
+  graphs are cached by TensorFlowBackend.InitSampling() and re-used by later
+  calls with the same model, batch size, and sequence length.
+  """
+
+  def __init__(
+    self, tf, session, saver, attributes: typing.Dict[str, typing.Any]
+  ):
+    self.tf = tf
+    self.session = session
+    self.saver = saver
+    # The values of _GRAPH_ATTRIBUTES for this graph.
+    self.attributes = attributes
+    # The <path, mtime> of the checkpoint which was last restored into the
+    # session.
+    self.checkpoint: typing.Optional[typing.Tuple[str, int]] = None
+
+
+# A map from <checkpoints directory, batch size, sequence length> tuples to
+# inference graphs, in least recently used order.
+_inference_graphs: typing.Dict[
+  typing.Tuple[str, int, int], InferenceGraph
+] = collections.OrderedDict()
 
 
 class TensorFlowBackend(backends.BackendBase):
   """A model with an embedding layer, using a keras backend."""
 
+  supports_continuous_batching = True
+
   def __init__(self, *args, **kwargs):
     """Instantiate a model.
 
@@ -100,7 +162,9 @@ class TensorFlowBackend(backends.BackendBase):
     )
 
   def InitTfGraph(
-    self, sampler: typing.Optional[samplers.Sampler] = None
+    self,
+    sampler: typing.Optional[samplers.Sampler] = None,
+    dataset: typing.Optional[data_generators.TensorflowDatasetGenerator] = None,
   ) -> "tf":
     """Instantiate a TensorFlow graph for training or inference.
 
@@ -110,6 +174,8 @@ class TensorFlowBackend(backends.BackendBase):
     Args:
       sampler: If set, initialize the model for inference using the given
         sampler. If not set, initialize model for training.
+      dataset: If set, read training data from the dataset's input pipeline,
+        rather than from placeholders.
 
     Returns:
       The imported TensorFlow module.
@@ -135,8 +201,10 @@ class TensorFlowBackend(backends.BackendBase):
     if cell_type is None:
       raise NotImplementedError
 
-    # Reset the graph when switching between training and inference.
-    tf.compat.v1.reset_default_graph()
+    # Reset the graph when switching to training. Inference graphs are built
+    # in a graph of their own by InitSampling(), so that they can be cached.
+    if not sampler:
+      tf.compat.v1.reset_default_graph()
 
     if sampler:
       sequence_length = sampler.sequence_length
@@ -153,12 +221,15 @@ class TensorFlowBackend(backends.BackendBase):
       cells_lst, state_is_tuple=True
     )
 
-    self.input_data = tf.compat.v1.placeholder(
-      tf.int32, [batch_size, sequence_length]
-    )
-    self.targets = tf.compat.v1.placeholder(
-      tf.int32, [batch_size, sequence_length]
-    )
+    if dataset:
+      self.input_data, self.targets = dataset.GetNext(tf)
+    else:
+      self.input_data = tf.compat.v1.placeholder(
+        tf.int32, [batch_size, sequence_length]
+      )
+      self.targets = tf.compat.v1.placeholder(
+        tf.int32, [batch_size, sequence_length]
+      )
     self.initial_state = self.cell.zero_state(batch_size, tf.float32)
     self.temperature = tf.Variable(1.0, trainable=False)
     self.seed_length = tf.Variable(32, trainable=False)
@@ -336,10 +407,17 @@ class TensorFlowBackend(backends.BackendBase):
     if self.is_trained:
       return
 
-    data_generator = data_generators.TensorflowBatchGenerator(
-      corpus, self.config.training
-    )
-    tf = self.InitTfGraph()
+    use_dataset = self.config.training.use_tf_data_input_pipeline
+    if use_dataset:
+      data_generator = data_generators.TensorflowDatasetGenerator(
+        corpus, self.config.training
+      )
+      tf = self.InitTfGraph(dataset=data_generator)
+    else:
+      data_generator = data_generators.TensorflowBatchGenerator(
+        corpus, self.config.training
+      )
+      tf = self.InitTfGraph()
 
     logger = telemetry.TrainingLogger(self.cache.path / "logs")
 
@@ -366,114 +444,127 @@ class TensorFlowBackend(backends.BackendBase):
       assert checkpoint_state.model_checkpoint_path
       ckpt_path, ckpt_paths = self.GetParamsPath(checkpoint_state)
 
-    with tf.compat.v1.Session() as sess, self.dashboard_db.Session() as dbs:
-      dbs.query(dashboard_db.TrainingTelemetry).filter(
-        dashboard_db.TrainingTelemetry.model_id == self.dashboard_model_id
-      ).filter(dashboard_db.TrainingTelemetry.pending == True).delete()
+    # The data generator is closed before recursing into Train() for the next
+    # epoch, so that the prefetch thread and its corpus are released.
+    try:
+      with tf.compat.v1.Session() as sess, self.dashboard_db.Session() as dbs:
+        dbs.query(dashboard_db.TrainingTelemetry).filter(
+          dashboard_db.TrainingTelemetry.model_id == self.dashboard_model_id
+        ).filter(dashboard_db.TrainingTelemetry.pending == True).delete()
 
-      tf.compat.v1.global_variables_initializer().run()
+        tf.compat.v1.global_variables_initializer().run()
 
-      # Keep all checkpoints.
-      saver = tf.compat.v1.train.Saver(
-        tf.global_variables(), max_to_keep=100, save_relative_paths=True
-      )
+        # Keep all checkpoints.
+        saver = tf.compat.v1.train.Saver(
+          tf.global_variables(), max_to_keep=100, save_relative_paths=True
+        )
 
-      # restore model from closest checkpoint.
-      if ckpt_path:
-        app.Log(1, "Restoring checkpoint {}".format(ckpt_path))
-        saver.restore(sess, ckpt_path)
+        # restore model from closest checkpoint.
+        if ckpt_path:
+          app.Log(1, "Restoring checkpoint {}".format(ckpt_path))
+          saver.restore(sess, ckpt_path)
 
-      # make sure we don't lose track of other checkpoints
-      if ckpt_paths:
-        saver.recover_last_checkpoints(ckpt_paths)
+        # make sure we don't lose track of other checkpoints
+        if ckpt_paths:
+          saver.recover_last_checkpoints(ckpt_paths)
 
-      # Offset epoch counts by 1 so that they are in the range [1..n]
-      current_epoch = sess.run(self.epoch) + 1
-      max_epoch = self.config.training.num_epochs + 1
+        # Offset epoch counts by 1 so that they are in the range [1..n]
+        current_epoch = sess.run(self.epoch) + 1
+        max_epoch = self.config.training.num_epochs + 1
 
-      # Per-epoch training loop.
-      for epoch_num in range(current_epoch, max_epoch):
-        logger.EpochBeginCallback()
+        # Per-epoch training loop.
+        for epoch_num in range(current_epoch, max_epoch):
+          logger.EpochBeginCallback()
 
-        # decay and set learning rate
-        new_learning_rate = initial_learning_rate * (
-          (float(100 - decay_rate) / 100.0) ** (epoch_num - 1)
-        )
-        sess.run(tf.compat.v1.assign(self.learning_rate, new_learning_rate))
-        sess.run(tf.compat.v1.assign(self.epoch, epoch_num))
-
-        # TODO(cec): refactor data generator to a Python generator.
-        data_generator.CreateBatches()
-
-        app.Log(1, "Epoch %d/%d:", epoch_num, self.config.training.num_epochs)
-        state = sess.run(self.initial_state)
-        # Per-batch inner loop.
-        bar = progressbar.ProgressBar(max_value=data_generator.num_batches)
-        last_log_time = time.time()
-        for i in bar(range(data_generator.num_batches)):
-          x, y = data_generator.NextBatch()
-          feed = {self.input_data: x, self.targets: y}
-          for j, (c, h) in enumerate(self.initial_state):
-            feed[c], feed[h] = state[j].c, state[j].h
-          summary, loss, state, _ = sess.run(
-            [merged, self.loss, self.final_state, self.train_op], feed
+          # decay and set learning rate
+          new_learning_rate = initial_learning_rate * (
+            (float(100 - decay_rate) / 100.0) ** (epoch_num - 1)
           )
+          sess.run(tf.compat.v1.assign(self.learning_rate, new_learning_rate))
+          sess.run(tf.compat.v1.assign(self.epoch, epoch_num))
+
+          # TODO(cec): refactor data generator to a Python generator.
+          if use_dataset:
+            data_generator.CreateBatches(sess)
+          else:
+            data_generator.CreateBatches()
+
+          app.Log(1, "Epoch %d/%d:", epoch_num, self.config.training.num_epochs)
+          state = sess.run(self.initial_state)
+          # Per-batch inner loop.
+          bar = progressbar.ProgressBar(max_value=data_generator.num_batches)
+          last_log_time = time.time()
+          for i in bar(range(data_generator.num_batches)):
+            if use_dataset:
+              feed = {}
+            else:
+              x, y = data_generator.NextBatch()
+              feed = {self.input_data: x, self.targets: y}
+            for j, (c, h) in enumerate(self.initial_state):
+              feed[c], feed[h] = state[j].c, state[j].h
+            summary, loss, state, _ = sess.run(
+              [merged, self.loss, self.final_state, self.train_op], feed
+            )
 
-          # Periodically write progress to tensorboard.
-          if i % FLAGS.clgen_tf_backend_tensorboard_summary_step_count == 0:
-            step = (epoch_num - 1) * data_generator.num_batches + i
-            self.summary_writer.add_summary(summary, step)
-            # Add telemetry database entry. This isn't committed until the end
-            # of the epoch, when the checkpoint is created.
-            now = time.time()
-            duration_ns = int((now - last_log_time) * 1e6)
-            dbs.add(
-              dashboard_db.TrainingTelemetry(
-                model_id=self.dashboard_model_id,
-                epoch=epoch_num,
-                step=step,
-                training_loss=loss,
-                learning_rate=new_learning_rate,
-                ns_per_batch=int(duration_ns)
-                / FLAGS.clgen_tf_backend_tensorboard_summary_step_count,
+            # Periodically write progress to tensorboard.
+            if i % FLAGS.clgen_tf_backend_tensorboard_summary_step_count == 0:
+              step = (epoch_num - 1) * data_generator.num_batches + i
+              self.summary_writer.add_summary(summary, step)
+              # Add telemetry database entry. This isn't committed until the end
+              # of the epoch, when the checkpoint is created.
+              now = time.time()
+              duration_ns = int((now - last_log_time) * 1e6)
+              dbs.add(
+                dashboard_db.TrainingTelemetry(
+                  model_id=self.dashboard_model_id,
+                  epoch=epoch_num,
+                  step=step,
+                  training_loss=loss,
+                  learning_rate=new_learning_rate,
+                  ns_per_batch=int(duration_ns)
+                  / FLAGS.clgen_tf_backend_tensorboard_summary_step_count,
+                )
               )
-            )
-            last_log_time = now
-            dbs.commit()
-
-        # Log the loss and delta.
-        app.Log(1, "Loss: %.6f.", loss)
-
-        # Save after every epoch.
-        start_time = time.time()
-        global_step = epoch_num
-        checkpoint_prefix = self.cache.path / "checkpoints" / "checkpoint"
-        checkpoint_path = saver.save(
-          sess, checkpoint_prefix, global_step=global_step
-        )
-        app.Log(
-          1,
-          "Saved checkpoint %s in %s ms.",
-          checkpoint_path,
-          humanize.Commas(int((time.time() - start_time) * 1000)),
-        )
-        dbs.query(dashboard_db.TrainingTelemetry).filter(
-          dashboard_db.TrainingTelemetry.pending == True
-        ).update({"pending": False})
-        dbs.commit()
-        assert pathlib.Path(
-          f"{checkpoint_prefix}-{global_step}.index"
-        ).is_file()
-        assert pathlib.Path(f"{checkpoint_prefix}-{global_step}.meta").is_file()
-
-        logger.EpochEndCallback(epoch_num, loss)
-        # If we have a sampler that we can use at the end of epochs, then
-        # break now to run the test sampler.
-        # This is confusing logic! Consider a refactor to simplify things.
-        if test_sampler:
-          break
-      else:
-        return
+              last_log_time = now
+              dbs.commit()
+
+          # Log the loss and delta.
+          app.Log(1, "Loss: %.6f.", loss)
+
+          # Save after every epoch.
+          start_time = time.time()
+          global_step = epoch_num
+          checkpoint_prefix = self.cache.path / "checkpoints" / "checkpoint"
+          checkpoint_path = saver.save(
+            sess, checkpoint_prefix, global_step=global_step
+          )
+          app.Log(
+            1,
+            "Saved checkpoint %s in %s ms.",
+            checkpoint_path,
+            humanize.Commas(int((time.time() - start_time) * 1000)),
+          )
+          dbs.query(dashboard_db.TrainingTelemetry).filter(
+            dashboard_db.TrainingTelemetry.pending == True
+          ).update({"pending": False})
+          dbs.commit()
+          assert pathlib.Path(
+            f"{checkpoint_prefix}-{global_step}.index"
+          ).is_file()
+          assert pathlib.Path(
+            f"{checkpoint_prefix}-{global_step}.meta"
+          ).is_file()
+
+          logger.EpochEndCallback(epoch_num, loss)
+          # If we have a sampler that we can use at the end of epochs, then
+          # break now to run the test sampler.
+          # This is confusing logic! Consider a refactor to simplify things.
+          if test_sampler:
+            break
+        else:
+          return
+    finally:
+      data_generator.Close()
 
     if test_sampler and FLAGS.clgen_per_epoch_test_samples > 0:
       self._EndOfEpochTestSample(corpus, test_sampler, step, epoch_num)
@@ -492,12 +583,16 @@ class TensorFlowBackend(backends.BackendBase):
 
     self.InitSampling(sampler, seed)
     self.InitSampleBatch(sampler)
+    sampler.InitBatch(atomizer)
 
     samples, stats = [], []
     for i in range(FLAGS.clgen_per_epoch_test_samples):
       done = np.zeros(1, dtype=np.bool)
       start_time = time.time()
       sample_in_progress = sampler.tokenized_start_text.copy()
+      if i:
+        self.InitSampleRows(sampler, np.array([0]))
+        sampler.ResetRow(0)
 
       while not done[0]:
         indices = self.SampleNextIndices(sampler, done)
@@ -505,7 +600,7 @@ class TensorFlowBackend(backends.BackendBase):
         # done.
         for index in indices[0]:
           sample_in_progress.append(atomizer.decoder[index])
-          if sampler.SampleIsComplete(sample_in_progress):
+          if sampler.AppendIndex(0, index):
             stats.append(
               (len(sample_in_progress), int((time.time() - start_time) * 1000))
             )
@@ -532,9 +627,20 @@ class TensorFlowBackend(backends.BackendBase):
     samples_as_markdown = [
       self.FormatCodeAsMarkdown(sample) for sample in samples
     ]
-    samples_tensor = tf.convert_to_tensor(samples_as_markdown, dtype=tf.string)
-    summary_op = tf.summary.text("samples", samples_tensor)
-    summary = self.inference_sess.run(summary_op)
+    # Build the text summary proto directly, rather than adding summary ops
+    # to the inference graph at the end of every epoch.
+    summary = tf.compat.v1.Summary()
+    summary.value.add(
+      tag="samples",
+      metadata=tf.compat.v1.SummaryMetadata(
+        plugin_data=tf.compat.v1.SummaryMetadata.PluginData(
+          plugin_name="text"
+        )
+      ),
+      tensor=tf.compat.v1.make_tensor_proto(
+        samples_as_markdown, dtype=tf.string
+      ),
+    )
     self.summary_writer.add_summary(summary, step)
 
   @staticmethod
@@ -544,40 +650,43 @@ class TensorFlowBackend(backends.BackendBase):
   def InitSampling(
     self, sampler: samplers.Sampler, seed: typing.Optional[int] = None
   ) -> None:
-    """Initialize model for sampling."""
-    from third_party.py.tensorflow import tf
+    """Initialize model for sampling.
 
-    # Delete any previous sampling session.
-    if self.inference_tf:
-      del self.inference_tf
-    if self.inference_sess:
-      del self.inference_sess
+    The inference graph and session are re-used from a previous call with the
+    same batch size and sequence length, if there is one. The weights of the
+    most recent checkpoint are restored only if they have changed since the
+    session was last used, and the temperature is updated in place.
+    """
+    checkpoint_dir = self.cache.path / "checkpoints"
+    key = (str(checkpoint_dir), sampler.batch_size, sampler.sequence_length)
+    inference_graph = _inference_graphs.get(key)
+    if inference_graph:
+      _inference_graphs.move_to_end(key)
+      for name, value in inference_graph.attributes.items():
+        setattr(self, name, value)
+    else:
+      inference_graph = self._BuildInferenceGraph(sampler)
+      _inference_graphs[key] = inference_graph
+      cache_size = FLAGS.clgen_tf_backend_inference_cache_size
+      while len(_inference_graphs) > max(cache_size, 1):
+        _, evicted = _inference_graphs.popitem(last=False)
+        evicted.session.close()
 
-    self.inference_tf = self.InitTfGraph(sampler=sampler)
-    self.inference_sess = self.inference_tf.compat.v1.Session()
+    self.inference_tf = tf = inference_graph.tf
+    self.inference_sess = inference_graph.session
 
     # Seed the RNG.
     if seed is not None:
       np.random.seed(seed)
-      self.inference_tf.compat.v1.set_random_seed(seed)
+      with self.inference_sess.graph.as_default():
+        tf.compat.v1.set_random_seed(seed)
 
     # If --clgen_tf_backend_reset_inference_state_between_batches, the state
     # is reset at the beginning of every sample batch. Else, this is the only
     # place it is initialized.
-    self.inference_state = self.inference_sess.run(
-      self.cell.zero_state(sampler.batch_size, self.inference_tf.float32)
-    )
+    self.inference_state = self.inference_sess.run(self.initial_state)
 
-    self.inference_tf.compat.v1.global_variables_initializer().run(
-      session=self.inference_sess
-    )
-    # Restore trained model weights.
-    saver = self.inference_tf.compat.v1.train.Saver(
-      self.inference_tf.global_variables()
-    )
-    checkpoint_state = self.inference_tf.train.get_checkpoint_state(
-      self.cache.path / "checkpoints"
-    )
+    checkpoint_state = tf.train.get_checkpoint_state(checkpoint_dir)
 
     # These assertions will fail if the model has no checkpoints. Since this
     # should only ever be called after Train(), there is no good reason for
@@ -585,19 +694,81 @@ class TensorFlowBackend(backends.BackendBase):
     assert checkpoint_state
     assert checkpoint_state.model_checkpoint_path
 
-    saver.restore(self.inference_sess, checkpoint_state.model_checkpoint_path)
-    self.inference_sess.run(
-      tf.compat.v1.assign(self.temperature, sampler.temperature)
+    # Restore trained model weights. The modified time of the checkpoint state
+    # file distinguishes a checkpoint from one of the same name which was
+    # written after the model cache was cleared.
+    checkpoint = (
+      checkpoint_state.model_checkpoint_path,
+      (checkpoint_dir / "checkpoint").stat().st_mtime_ns,
+    )
+    if inference_graph.checkpoint != checkpoint:
+      inference_graph.saver.restore(self.inference_sess, checkpoint[0])
+      inference_graph.checkpoint = checkpoint
+    self.temperature.load(sampler.temperature, self.inference_sess)
+
+  def _BuildInferenceGraph(self, sampler: samplers.Sampler) -> InferenceGraph:
+    """Build a new inference graph and session for a sampler."""
+    from third_party.py.tensorflow import tf
+
+    graph = tf.Graph()
+    with graph.as_default():
+      self.InitTfGraph(sampler=sampler)
+      session = tf.compat.v1.Session(
+        graph=graph,
+        config=tf.compat.v1.ConfigProto(
+          intra_op_parallelism_threads=FLAGS.clgen_tf_backend_intra_op_threads
+        ),
+      )
+      tf.compat.v1.global_variables_initializer().run(session=session)
+      saver = tf.compat.v1.train.Saver(tf.compat.v1.global_variables())
+    return InferenceGraph(
+      tf,
+      session,
+      saver,
+      {name: getattr(self, name) for name in _GRAPH_ATTRIBUTES},
     )
 
   def InitSampleBatch(self, sampler: samplers.Sampler) -> None:
     if FLAGS.clgen_tf_backend_reset_inference_state_between_batches:
-      self.inference_state = self.inference_sess.run(
-        self.cell.zero_state(sampler.batch_size, self.inference_tf.float32)
-      )
+      self.inference_state = self.inference_sess.run(self.initial_state)
     self.inference_indices = np.tile(
-      sampler.encoded_start_text, [sampler.batch_size, 1]
+      sampler.encoded_start_text[-1:], [sampler.batch_size, 1]
     )
+    self._FeedStartText(sampler, np.arange(sampler.batch_size))
+
+  def InitSampleRows(self, sampler: samplers.Sampler, rows: np.ndarray) -> None:
+    if FLAGS.clgen_tf_backend_reset_inference_state_between_batches:
+      reset = np.zeros([sampler.batch_size, 1], dtype=np.bool)
+      reset[rows] = True
+      self.inference_state = self.inference_tf.nest.map_structure(
+        lambda state: np.where(reset, 0, state), self.inference_state
+      )
+    self.inference_indices[rows] = sampler.encoded_start_text[-1]
+    self._FeedStartText(sampler, rows)
+
+  def _FeedStartText(self, sampler: samplers.Sampler, rows: np.ndarray) -> None:
+    """Update the state of rows of the batch with the start text.
+
+    All but the last token of the start text are fed to the network. The last
+    token is the input of the next call to SampleNextIndices(). The state of
+    the other rows is unchanged, so that samples in those rows may continue.
+    """
+    length = len(sampler.encoded_start_text) - 1
+    if not length:
+      return
+    assert length < sampler.sequence_length
+    expanded_indices = np.zeros((sampler.batch_size, sampler.sequence_length))
+    expanded_indices[:, :length] = sampler.encoded_start_text[:-1]
+    # A length of zero leaves the state of a row unchanged.
+    synthesized_lengths = np.zeros([sampler.batch_size], dtype=np.int32)
+    synthesized_lengths[rows] = length
+    feed = {
+      self.initial_state: self.inference_state,
+      self.input_data: expanded_indices,
+      self.lengths: synthesized_lengths,
+      self.seed_length: length,
+    }
+    self.inference_state = self.inference_sess.run(self.final_state, feed)
 
   def SampleNextIndices(self, sampler: samplers.Sampler, done: np.ndarray):
     length = self.inference_indices.shape[1]
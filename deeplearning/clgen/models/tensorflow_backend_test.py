@@ -15,10 +15,13 @@
 """Unit tests for //deeplearning/clgen/models/tensorflow_backend.py."""
 import checksumdir
 import numpy as np
+import pytest
 
 from deeplearning.clgen import sample_observers
+from deeplearning.clgen import samplers
 from deeplearning.clgen.models import models
 from deeplearning.clgen.proto import model_pb2
+from deeplearning.clgen.proto import sampler_pb2
 from deeplearning.clgen.proto import telemetry_pb2
 from labm8.py import app
 from labm8.py import crypto
@@ -55,6 +58,16 @@ class MockSampler(object):
     """Crude 'maxlen' mock."""
     return len(sample_in_progress) >= 10
 
+  # Batched termination uses the same 'maxlen' of 10 tokens.
+  terminators = [
+    samplers.MaxlenTerminationCriterion(
+      sampler_pb2.MaxTokenLength(maximum_tokens_in_sample=10)
+    )
+  ]
+  InitBatch = samplers.Sampler.InitBatch
+  ResetRow = samplers.Sampler.ResetRow
+  GetCompletionPositions = samplers.Sampler.GetCompletionPositions
+
 
 @test.Fixture(scope="function")
 def abc_tensorflow_model_config(abc_model_config: model_pb2.Model):
@@ -274,6 +287,45 @@ def test_TensorFlowBackend_Sample_inexact_multiple_of_batch_size(
   assert len(saver.samples) == 6
 
 
+def test_TensorFlowBackend_Sample_continuous_batching(
+  clgen_cache_dir, abc_tensorflow_model_config
+):
+  """Test that rows of a batch begin new samples once complete."""
+  del clgen_cache_dir
+  m = models.Model(abc_tensorflow_model_config)
+  sampler = MockSampler()
+  sampler.batch_size = 2
+  saver = sample_observers.InMemorySampleSaver()
+  m.Sample(sampler, [sample_observers.MaxSampleCountObserver(5), saver])
+  # Samples complete in pairs, and sampling stops within the first batch.
+  assert len(saver.samples) == 6
+  for sample in saver.samples:
+    assert sample.text.startswith("abc")
+    assert sample.num_tokens == 10
+
+
+def test_TensorFlowBackend_InitSampling_reuses_inference_session(
+  clgen_cache_dir, abc_tensorflow_model_config
+):
+  """Test that inference sessions are cached between calls to Sample()."""
+  del clgen_cache_dir
+  m = models.Model(abc_tensorflow_model_config)
+  sampler = MockSampler()
+  m.Sample(sampler, [sample_observers.MaxSampleCountObserver(1)])
+  session = m.backend.inference_sess
+
+  # Sampling again with a different temperature re-uses the session.
+  sampler.temperature = 0.5
+  m.Sample(sampler, [sample_observers.MaxSampleCountObserver(1)])
+  assert m.backend.inference_sess is session
+  assert session.run(m.backend.temperature) == pytest.approx(0.5)
+
+  # A different batch size requires a new session.
+  sampler.batch_size = 2
+  m.Sample(sampler, [sample_observers.MaxSampleCountObserver(1)])
+  assert m.backend.inference_sess is not session
+
+
 # Benchmarks.
 
 
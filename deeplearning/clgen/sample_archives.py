@@ -0,0 +1,348 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""This file packs samples into segmented record files.
+
+A sample archive is a directory of numbered segments. Each segment is a pair of
+files:
+
+  NNNNNN.samples  A sequence of records. Each record is a serialized Sample
+                  proto, prefixed by its length as a 4-byte little-endian
+                  integer.
+  NNNNNN.index    A sequence of fixed-size entries, one per record. Each entry
+                  is the sha256 digest of the sample text, followed by the
+                  offset of the record in the segment as an 8-byte
+                  little-endian integer.
+
+Samples are only ever appended to the last segment. Once a segment reaches a
+maximum size, a new segment is started.
+
+Usage:
+
+  Convert a directory of samples produced by --cache_samples or
+  --sample_text_dir to an archive:
+
+    $ bazel run //deeplearning/clgen:sample_archives -- \\
+        --legacy_sample_dir=/path/to/samples --sample_archive=/path/to/archive
+"""
+import hashlib
+import os
+import pathlib
+import struct
+import typing
+
+from deeplearning.clgen.proto import model_pb2
+from labm8.py import app
+from labm8.py import humanize
+from labm8.py import lockfile
+from labm8.py import pbutil
+
+FLAGS = app.FLAGS
+
+app.DEFINE_string(
+  "legacy_sample_dir",
+  None,
+  "A directory of sample .pbtxt or .txt files to convert to an archive.",
+)
+app.DEFINE_string(
+  "sample_archive", None, "The path of the sample archive to write to."
+)
+
+# The length prefix of a record.
+_RECORD_HEADER = struct.Struct("<I")
+# An index entry: <sha256 digest, record offset>.
+_INDEX_ENTRY = struct.Struct("<32sQ")
+
+
+def _SegmentPaths(
+  path: pathlib.Path, segment: int
+) -> typing.Tuple[pathlib.Path, pathlib.Path]:
+  """Return the <records, index> paths of a segment."""
+  return (path / f"{segment:06d}.samples", path / f"{segment:06d}.index")
+
+
+def _ListSegments(path: pathlib.Path) -> typing.List[int]:
+  """Return the numbers of the segments in an archive, in order."""
+  return sorted(int(p.stem) for p in path.glob("*.samples"))
+
+
+def _ReadRecords(
+  records_path: pathlib.Path,
+) -> typing.Iterator[typing.Tuple[int, bytes]]:
+  """Read the records of a segment.
+
+  A partially written record at the end of the segment is ignored.
+
+  Returns:
+    An iterator of <offset, serialized sample> tuples.
+  """
+  with open(records_path, "rb") as f:
+    offset = 0
+    while True:
+      header = f.read(_RECORD_HEADER.size)
+      if len(header) < _RECORD_HEADER.size:
+        return
+      (size,) = _RECORD_HEADER.unpack(header)
+      data = f.read(size)
+      if len(data) < size:
+        return
+      yield offset, data
+      offset += _RECORD_HEADER.size + size
+
+
+def _ReadIndex(
+  index_path: pathlib.Path, records_size: int
+) -> typing.Iterator[typing.Tuple[bytes, int]]:
+  """Read the entries of a segment index.
+
+  Entries for records beyond the end of the segment are ignored.
+
+  Returns:
+    An iterator of <sha256 digest, record offset> tuples.
+  """
+  if not index_path.is_file():
+    return
+  data = index_path.read_bytes()
+  end = len(data) - len(data) % _INDEX_ENTRY.size
+  for digest, offset in _INDEX_ENTRY.iter_unpack(data[:end]):
+    if offset < records_size:
+      yield digest, offset
+
+
+class SampleArchiveWriter(object):
+  """Appends samples to a sample archive.
+
+  Writes are buffered. Samples are flushed and synced to disk once every
+  `sync_every` samples, when a segment is full, and on Flush() and Close().
+
+  A writer holds a lock on the archive until it is closed, so that an archive
+  has at most one writer at a time.
+  """
+
+  def __init__(
+    self,
+    path: pathlib.Path,
+    max_segment_size: int = 256 * 1024 * 1024,
+    sync_every: int = 1000,
+  ):
+    """Constructor.
+
+    If the archive already exists, samples are appended to its last segment.
+
+    Args:
+      path: The directory of the archive. Created if it does not exist.
+      max_segment_size: The maximum size of a segment, in bytes. A sample
+        which is larger than this is written to a segment of its own.
+      sync_every: The number of samples to write between syncs to disk. If 0,
+        samples are only synced on Flush() and Close().
+
+    Raises:
+      UnableToAcquireLockError: If the archive is locked by another writer.
+    """
+    if max_segment_size <= 0:
+      raise ValueError(
+        f"max_segment_size must be >= 1. Received: {max_segment_size}"
+      )
+    self.path = pathlib.Path(path)
+    self.path.mkdir(parents=True, exist_ok=True)
+    self._lock = lockfile.LockFile(self.path / "LOCK").acquire(
+      replace_stale=True
+    )
+    self.max_segment_size = max_segment_size
+    self.sync_every = sync_every
+    # The number of samples written since the last sync.
+    self._unsynced_count = 0
+
+    segments = _ListSegments(self.path)
+    self._segment = segments[-1] if segments else 0
+    self._Open()
+
+  def _Open(self) -> None:
+    """Open the current segment for appending.
+
+    Any partially written record at the end of the segment, and index entries
+    for it, are removed.
+    """
+    records_path, index_path = _SegmentPaths(self.path, self._segment)
+    self._size = 0
+    if records_path.is_file():
+      for offset, data in _ReadRecords(records_path):
+        self._size = offset + _RECORD_HEADER.size + len(data)
+      entries = list(_ReadIndex(index_path, self._size))
+      os.truncate(records_path, self._size)
+      # The index is replaced atomically, so that an interrupted rewrite does
+      # not lose the entries of the segment.
+      temp_path = index_path.parent / f"{index_path.name}.tmp"
+      with open(temp_path, "wb") as f:
+        f.write(b"".join(_INDEX_ENTRY.pack(*entry) for entry in entries))
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(temp_path, index_path)
+    self._records = open(records_path, "ab")
+    self._index = open(index_path, "ab")
+
+  def Write(self, sample: model_pb2.Sample) -> None:
+    """Append a sample to the archive."""
+    data = sample.SerializeToString()
+    size = _RECORD_HEADER.size + len(data)
+    if self._size and self._size + size > self.max_segment_size:
+      self._Rotate()
+    digest = hashlib.sha256(sample.text.encode("utf-8")).digest()
+    self._records.write(_RECORD_HEADER.pack(len(data)))
+    self._records.write(data)
+    self._index.write(_INDEX_ENTRY.pack(digest, self._size))
+    self._size += size
+    self._unsynced_count += 1
+    if self.sync_every and self._unsynced_count >= self.sync_every:
+      self.Flush()
+
+  def _Rotate(self) -> None:
+    """Close the current segment and start a new one."""
+    self._CloseSegment()
+    self._segment += 1
+    app.Log(2, "Starting sample archive segment %d", self._segment)
+    self._Open()
+
+  def Flush(self) -> None:
+    """Flush written samples and sync them to disk."""
+    # Records are synced before the index, so that an index entry never
+    # refers to a record which is not on disk.
+    for f in (self._records, self._index):
+      f.flush()
+      os.fsync(f.fileno())
+    self._unsynced_count = 0
+
+  def _CloseSegment(self) -> None:
+    """Flush written samples and close the current segment."""
+    self.Flush()
+    self._records.close()
+    self._index.close()
+
+  def Close(self) -> None:
+    """Flush written samples, close the archive, and release its lock."""
+    self._CloseSegment()
+    self._lock.release()
+
+  def __enter__(self) -> "SampleArchiveWriter":
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.Close()
+
+
+class SampleArchiveReader(object):
+  """Reads samples from a sample archive."""
+
+  def __init__(self, path: pathlib.Path):
+    """Constructor.
+
+    Args:
+      path: The directory of the archive.
+
+    Raises:
+      FileNotFoundError: If the archive does not exist.
+    """
+    self.path = pathlib.Path(path)
+    if not self.path.is_dir():
+      raise FileNotFoundError(f"Sample archive not found: '{self.path}'")
+    self._segments = _ListSegments(self.path)
+    # A map from sample digest to the <segment, offset> of its first record.
+    self._index: typing.Dict[bytes, typing.Tuple[int, int]] = {}
+    for segment in self._segments:
+      records_path, index_path = _SegmentPaths(self.path, segment)
+      for digest, offset in _ReadIndex(
+        index_path, records_path.stat().st_size
+      ):
+        self._index.setdefault(digest, (segment, offset))
+
+  def __iter__(self) -> typing.Iterator[model_pb2.Sample]:
+    """Iterate over all samples in the archive, in the order written."""
+    for segment in self._segments:
+      records_path, _ = _SegmentPaths(self.path, segment)
+      for _, data in _ReadRecords(records_path):
+        yield model_pb2.Sample.FromString(data)
+
+  def __len__(self) -> int:
+    """Return the number of unique samples in the archive."""
+    return len(self._index)
+
+  def __contains__(self, sample_id: str) -> bool:
+    return bytes.fromhex(sample_id) in self._index
+
+  def GetSample(self, sample_id: str) -> model_pb2.Sample:
+    """Look up a sample by ID.
+
+    Args:
+      sample_id: The hex encoded sha256 of the sample text, which is also the
+        name of the file written by LegacySampleCacheObserver.
+
+    Returns:
+      A sample.
+
+    Raises:
+      KeyError: If the sample is not in the archive.
+    """
+    segment, offset = self._index[bytes.fromhex(sample_id)]
+    records_path, _ = _SegmentPaths(self.path, segment)
+    with open(records_path, "rb") as f:
+      f.seek(offset)
+      (size,) = _RECORD_HEADER.unpack(f.read(_RECORD_HEADER.size))
+      return model_pb2.Sample.FromString(f.read(size))
+
+
+def ConvertLegacySampleDirectory(
+  directory: pathlib.Path, writer: SampleArchiveWriter
+) -> int:
+  """Write the samples in a directory of sample files to an archive.
+
+  This reads the sample protos produced by LegacySampleCacheObserver, and the
+  sample texts produced by SaveSampleTextObserver. Files are read in name
+  order. The directory is not modified.
+
+  Args:
+    directory: The directory of .pbtxt or .txt sample files.
+    writer: The archive to write to.
+
+  Returns:
+    The number of samples written.
+  """
+  count = 0
+  for path in sorted(pathlib.Path(directory).iterdir()):
+    if path.suffix == ".pbtxt":
+      sample = pbutil.FromFile(path, model_pb2.Sample())
+    elif path.suffix == ".txt":
+      sample = model_pb2.Sample(text=path.read_text())
+    else:
+      continue
+    writer.Write(sample)
+    count += 1
+  return count
+
+
+def main():
+  """Main entry point."""
+  if not FLAGS.legacy_sample_dir:
+    raise app.UsageError("--legacy_sample_dir must be set")
+  if not FLAGS.sample_archive:
+    raise app.UsageError("--sample_archive must be set")
+
+  with SampleArchiveWriter(pathlib.Path(FLAGS.sample_archive)) as writer:
+    count = ConvertLegacySampleDirectory(
+      pathlib.Path(FLAGS.legacy_sample_dir), writer
+    )
+  app.Log(1, "Archived %s samples", humanize.Commas(count))
+
+
+if __name__ == "__main__":
+  app.Run(main)
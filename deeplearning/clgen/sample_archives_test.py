@@ -0,0 +1,135 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""Unit tests for //deeplearning/clgen:sample_archives."""
+import pathlib
+
+from deeplearning.clgen import sample_archives
+from deeplearning.clgen.proto import model_pb2
+from labm8.py import app
+from labm8.py import crypto
+from labm8.py import lockfile
+from labm8.py import pbutil
+from labm8.py import test
+
+FLAGS = app.FLAGS
+
+pytest_plugins = ["deeplearning.clgen.tests.fixtures"]
+
+
+def _Samples(*texts: str):
+  return [model_pb2.Sample(text=text, num_tokens=len(text)) for text in texts]
+
+
+def test_SampleArchiveReader_iter(tempdir: pathlib.Path):
+  """Test that samples are read back in the order they were written."""
+  with sample_archives.SampleArchiveWriter(tempdir) as writer:
+    for sample in _Samples("a", "bc", "a"):
+      writer.Write(sample)
+  reader = sample_archives.SampleArchiveReader(tempdir)
+  assert list(reader) == _Samples("a", "bc", "a")
+  assert len(reader) == 2
+
+
+def test_SampleArchiveReader_GetSample(tempdir: pathlib.Path):
+  """Test that samples can be looked up by the sha256 of their text."""
+  with sample_archives.SampleArchiveWriter(tempdir) as writer:
+    for sample in _Samples("a", "bc"):
+      writer.Write(sample)
+  reader = sample_archives.SampleArchiveReader(tempdir)
+  assert crypto.sha256_str("bc") in reader
+  assert reader.GetSample(crypto.sha256_str("bc")) == _Samples("bc")[0]
+  assert crypto.sha256_str("d") not in reader
+  with test.Raises(KeyError):
+    reader.GetSample(crypto.sha256_str("d"))
+
+
+def test_SampleArchiveReader_not_found(tempdir: pathlib.Path):
+  """Test that an error is raised if the archive does not exist."""
+  with test.Raises(FileNotFoundError):
+    sample_archives.SampleArchiveReader(tempdir / "archive")
+
+
+def test_SampleArchiveWriter_rotation(tempdir: pathlib.Path):
+  """Test that a new segment is started once a segment is full."""
+  with sample_archives.SampleArchiveWriter(
+    tempdir, max_segment_size=16
+  ) as writer:
+    for sample in _Samples("abc", "def", "ghi"):
+      writer.Write(sample)
+  assert sorted(p.name for p in tempdir.iterdir()) == [
+    "000000.index",
+    "000000.samples",
+    "000001.index",
+    "000001.samples",
+    "000002.index",
+    "000002.samples",
+  ]
+  reader = sample_archives.SampleArchiveReader(tempdir)
+  assert list(reader) == _Samples("abc", "def", "ghi")
+  assert reader.GetSample(crypto.sha256_str("ghi")).text == "ghi"
+
+
+def test_SampleArchiveWriter_append(tempdir: pathlib.Path):
+  """Test that reopening an archive appends to it."""
+  with sample_archives.SampleArchiveWriter(tempdir) as writer:
+    writer.Write(_Samples("a")[0])
+  with sample_archives.SampleArchiveWriter(tempdir) as writer:
+    writer.Write(_Samples("b")[0])
+  assert list(sample_archives.SampleArchiveReader(tempdir)) == _Samples(
+    "a", "b"
+  )
+
+
+def test_SampleArchiveWriter_partial_record(tempdir: pathlib.Path):
+  """Test that a partially written record is discarded."""
+  with sample_archives.SampleArchiveWriter(tempdir) as writer:
+    for sample in _Samples("a", "b"):
+      writer.Write(sample)
+  records_path = tempdir / "000000.samples"
+  records_path.write_bytes(records_path.read_bytes()[:-1])
+
+  assert list(sample_archives.SampleArchiveReader(tempdir)) == _Samples("a")
+  with sample_archives.SampleArchiveWriter(tempdir) as writer:
+    writer.Write(_Samples("c")[0])
+  reader = sample_archives.SampleArchiveReader(tempdir)
+  assert list(reader) == _Samples("a", "c")
+  assert crypto.sha256_str("b") not in reader
+
+
+def test_SampleArchiveWriter_lock(tempdir: pathlib.Path):
+  """Test that an archive is locked while a writer is open."""
+  with sample_archives.SampleArchiveWriter(tempdir):
+    assert lockfile.LockFile(tempdir / "LOCK").islocked
+  assert not lockfile.LockFile(tempdir / "LOCK").islocked
+
+
+def test_ConvertLegacySampleDirectory(
+  tempdir: pathlib.Path, tempdir2: pathlib.Path
+):
+  """Test that sample protos and texts are converted."""
+  sample = _Samples("abc")[0]
+  pbutil.ToFile(sample, tempdir / f"{crypto.sha256_str('abc')}.pbtxt")
+  (tempdir / f"{crypto.sha256_str('def')}.txt").write_text("def")
+  (tempdir / "README").write_text("Not a sample")
+
+  with sample_archives.SampleArchiveWriter(tempdir2) as writer:
+    assert sample_archives.ConvertLegacySampleDirectory(tempdir, writer) == 2
+  reader = sample_archives.SampleArchiveReader(tempdir2)
+  assert reader.GetSample(crypto.sha256_str("abc")) == sample
+  assert reader.GetSample(crypto.sha256_str("def")).text == "def"
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -14,7 +14,12 @@
 # along with clgen.  If not, see <https://www.gnu.org/licenses/>.
 """This file contains the SampleObserver interface and concrete subclasses."""
 import pathlib
+import queue
+import threading
+import typing
 
+from deeplearning.clgen import bloom_filter
+from deeplearning.clgen import sample_archives
 from deeplearning.clgen.proto import model_pb2
 from labm8.py import app
 from labm8.py import crypto
@@ -61,6 +66,36 @@ class SampleObserver(object):
     """
     raise NotImplementedError("abstract class")
 
+  def OnSamples(self, samples: typing.List[model_pb2.Sample]) -> bool:
+    """Batched sample notification callback.
+
+    Subclasses may override this method to handle a batch of samples at once.
+    The default implementation calls OnSample() for each sample in turn.
+
+    Args:
+      samples: A list of newly created sample messages.
+
+    Returns:
+      True if sampling should continue, else False.
+    """
+    return all([self.OnSample(sample) for sample in samples])
+
+  def Flush(self) -> None:
+    """Called once sampling is complete.
+
+    Observers which defer handling of samples must finish handling them
+    before returning. Subclasses do not need to override this method.
+    """
+    pass
+
+  def Close(self) -> None:
+    """Release any resources held by the observer.
+
+    Called once the observer is no longer needed, after Flush(). Subclasses do
+    not need to override this method.
+    """
+    pass
+
 
 class MaxSampleCountObserver(SampleObserver):
   """An observer that terminates sampling after a finite number of samples."""
@@ -79,6 +114,11 @@ class MaxSampleCountObserver(SampleObserver):
     self._sample_count += 1
     return self._sample_count < self._min_sample_count
 
+  @property
+  def num_samples_remaining(self) -> int:
+    """The number of samples to receive before sampling terminates."""
+    return max(self._min_sample_count - self._sample_count, 0)
+
 
 class SaveSampleTextObserver(SampleObserver):
   """An observer that creates a file of the sample text for each sample."""
@@ -141,3 +181,219 @@ class LegacySampleCacheObserver(SampleObserver):
     sample_path = self.cache_path / f"{sample_id}.pbtxt"
     pbutil.ToFile(sample, sample_path)
     return True
+
+
+class SampleArchiveObserver(SampleObserver):
+  """An observer that appends samples to a sample archive.
+
+  Unlike SaveSampleTextObserver and LegacySampleCacheObserver, which write a
+  file per sample, samples are packed into large segment files. See
+  //deeplearning/clgen:sample_archives.
+  """
+
+  def __init__(
+    self,
+    path: pathlib.Path,
+    max_segment_size: int = 256 * 1024 * 1024,
+    sync_every: int = 1000,
+  ):
+    self.writer = sample_archives.SampleArchiveWriter(
+      path, max_segment_size=max_segment_size, sync_every=sync_every
+    )
+
+  def OnSample(self, sample: model_pb2.Sample) -> bool:
+    """Sample receive callback. Returns True if sampling should continue."""
+    self.writer.Write(sample)
+    return True
+
+  def Flush(self) -> None:
+    """Sync the written samples to disk."""
+    self.writer.Flush()
+
+  def Close(self) -> None:
+    """Close the archive, releasing its lock."""
+    if self.writer:
+      self.writer.Close()
+      self.writer = None
+
+  def __del__(self):
+    # The writer is not set if the constructor raised an error.
+    if hasattr(self, "writer"):
+      self.Close()
+
+
+class DeduplicateSampleObserver(SampleObserver):
+  """An observer that passes only unique samples on to other observers.
+
+  The texts of samples are recorded in a Bloom filter, so memory use is fixed,
+  but a small fraction of unique samples are mistaken for duplicates and
+  dropped. If a path is given, the filter is loaded from it, and saved to it on
+  Flush(), so that samples are deduplicated across runs.
+
+  A MaxSampleCountObserver which is wrapped by this observer counts only unique
+  samples, whereas one which is not wrapped counts every sample.
+  """
+
+  def __init__(
+    self,
+    observers: typing.List[SampleObserver],
+    path: typing.Optional[pathlib.Path] = None,
+    capacity: int = 10000000,
+    error_rate: float = 0.001,
+  ):
+    """Constructor.
+
+    Args:
+      observers: The observers to notify of unique samples.
+      path: The path of a file to persist the filter to.
+      capacity: The expected number of unique samples. Ignored if the filter
+        is loaded from path.
+      error_rate: The fraction of unique samples dropped once capacity unique
+        samples have been seen. Ignored if the filter is loaded from path.
+    """
+    self.observers = observers
+    self.path = pathlib.Path(path) if path else None
+    if self.path and self.path.is_file():
+      self.filter = bloom_filter.BloomFilter.FromFile(self.path)
+    else:
+      self.filter = bloom_filter.BloomFilter(capacity, error_rate)
+    # The number of duplicate samples which have been dropped.
+    self.duplicate_count = 0
+
+  def Specialize(self, model, sampler) -> None:
+    """Specialize observer to a model and sampler combination."""
+    [obs.Specialize(model, sampler) for obs in self.observers]
+
+  def OnSample(self, sample: model_pb2.Sample) -> bool:
+    """Sample receive callback. Returns True if sampling should continue."""
+    if not self.filter.Add(sample.text):
+      self.duplicate_count += 1
+      return True
+    return all([obs.OnSample(sample) for obs in self.observers])
+
+  def OnSamples(self, samples: typing.List[model_pb2.Sample]) -> bool:
+    """Batched sample receive callback."""
+    unique_samples = [s for s in samples if self.filter.Add(s.text)]
+    self.duplicate_count += len(samples) - len(unique_samples)
+    if not unique_samples:
+      return True
+    return all([obs.OnSamples(unique_samples) for obs in self.observers])
+
+  def Flush(self) -> None:
+    """Flush the wrapped observers, and save the filter."""
+    [obs.Flush() for obs in self.observers]
+    if self.path:
+      self.filter.ToFile(self.path)
+
+  def Close(self) -> None:
+    """Close the wrapped observers."""
+    [obs.Close() for obs in self.observers]
+
+
+class AsyncSampleObserver(SampleObserver):
+  """An observer that notifies other observers from a background thread.
+
+  Samples are queued and passed in batches to the OnSamples() method of the
+  wrapped observers, so that slow observers, such as those which write to
+  disk, do not stall sampling. Once the queue is full, OnSample() blocks until
+  there is room for the sample.
+
+  Once a wrapped observer returns False, OnSample() returns False. Because
+  samples are handled asynchronously, this happens some samples later than it
+  would otherwise, and the wrapped observers may be notified of the samples
+  that were queued in the meantime. Observers which stop sampling after an
+  exact number of samples, such as MaxSampleCountObserver, should not be
+  wrapped.
+  """
+
+  def __init__(
+    self,
+    observers: typing.List[SampleObserver],
+    max_queue_size: int = 1024,
+    max_batch_size: int = 128,
+  ):
+    """Constructor.
+
+    Args:
+      observers: The observers to notify from the background thread.
+      max_queue_size: The maximum number of samples waiting to be handled.
+      max_batch_size: The maximum number of samples to pass to OnSamples().
+    """
+    if max_batch_size <= 0:
+      raise ValueError(
+        f"max_batch_size must be >= 1. Received: {max_batch_size}"
+      )
+    self.observers = observers
+    self.max_batch_size = max_batch_size
+    # A queue of samples, terminated by None.
+    self._queue = queue.Queue(maxsize=max_queue_size)
+    self._thread: typing.Optional[threading.Thread] = None
+    self._continue_sampling = True
+    # An exception raised by a wrapped observer.
+    self._error: typing.Optional[Exception] = None
+
+  def Specialize(self, model, sampler) -> None:
+    """Specialize observer to a model and sampler combination."""
+    # Finish handling samples for the previous model and sampler.
+    self.Flush()
+    self._continue_sampling = True
+    self._error = None
+    [obs.Specialize(model, sampler) for obs in self.observers]
+
+  def OnSample(self, sample: model_pb2.Sample) -> bool:
+    """Sample receive callback. Returns True if sampling should continue."""
+    if self._error:
+      raise self._error
+    if not self._thread:
+      self._thread = threading.Thread(target=self._Run, daemon=True)
+      self._thread.start()
+    self._queue.put(sample)
+    return self._continue_sampling
+
+  def Flush(self) -> None:
+    """Wait for the queued samples to be handled.
+
+    Raises:
+      Exception: If a wrapped observer raised an exception.
+    """
+    self._StopThread()
+    [obs.Flush() for obs in self.observers]
+    if self._error:
+      error, self._error = self._error, None
+      raise error
+
+  def Close(self) -> None:
+    """Stop the background thread, and close the wrapped observers."""
+    self._StopThread()
+    [obs.Close() for obs in self.observers]
+
+  def _StopThread(self) -> None:
+    """Wait for the background thread to handle the queued samples."""
+    if self._thread:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+
+  def _Run(self) -> None:
+    """Pass queued samples to the wrapped observers until None is received."""
+    while True:
+      batch = [self._queue.get()]
+      while batch[-1] is not None and len(batch) < self.max_batch_size:
+        try:
+          batch.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+      done = batch[-1] is None
+      if done:
+        batch.pop()
+      # Once an observer has failed, samples are discarded, so that OnSample()
+      # does not block.
+      if batch and not self._error:
+        try:
+          if not all([obs.OnSamples(batch) for obs in self.observers]):
+            self._continue_sampling = False
+        except Exception as e:
+          self._error = e
+          self._continue_sampling = False
+      if done:
+        return
@@ -1,11 +1,15 @@
 """Unit tests for //deeplearning/clgen:sample_observers."""
+import os
 import pathlib
+import threading
 
+from deeplearning.clgen import sample_archives
 from deeplearning.clgen import sample_observers
 from deeplearning.clgen.proto import model_pb2
 from labm8.py import app
 from labm8.py import crypto
 from labm8.py import fs
+from labm8.py import lockfile
 from labm8.py import test
 
 FLAGS = app.FLAGS
@@ -18,6 +22,16 @@ def test_MaxSampleCountObserver():
   assert not observer.OnSample(None)
 
 
+def test_MaxSampleCountObserver_num_samples_remaining():
+  observer = sample_observers.MaxSampleCountObserver(2)
+  assert observer.num_samples_remaining == 2
+  observer.OnSample(None)
+  assert observer.num_samples_remaining == 1
+  observer.OnSample(None)
+  observer.OnSample(None)
+  assert observer.num_samples_remaining == 0
+
+
 def test_SaveSampleTextObserver(tempdir: pathlib.Path):
   observer = sample_observers.SaveSampleTextObserver(tempdir)
   contents = "Hello, world!"
@@ -59,5 +73,174 @@ def test_InMemorySampleSaver():
   assert observer.samples[-1].text == "Hello, world!"
 
 
+def test_SampleArchiveObserver(tempdir: pathlib.Path):
+  observer = sample_observers.SampleArchiveObserver(tempdir)
+  samples = [model_pb2.Sample(text="a"), model_pb2.Sample(text="b")]
+
+  assert observer.OnSamples(samples)
+  observer.Flush()
+  assert list(sample_archives.SampleArchiveReader(tempdir)) == samples
+
+
+def test_SampleArchiveObserver_Close(tempdir: pathlib.Path):
+  """Test that closing the observer releases the lock on the archive."""
+  observer = sample_observers.SampleArchiveObserver(tempdir)
+  assert lockfile.LockFile(tempdir / "LOCK").islocked
+  observer.Close()
+  assert not lockfile.LockFile(tempdir / "LOCK").islocked
+  observer.Close()
+
+
+def test_SampleArchiveObserver_locked(tempdir: pathlib.Path):
+  """Test that an error is raised if another process is writing the archive."""
+  lockfile.LockFile(tempdir / "LOCK").acquire(pid=os.getppid())
+  with test.Raises(lockfile.UnableToAcquireLockError):
+    sample_observers.SampleArchiveObserver(tempdir)
+
+
+def test_DeduplicateSampleObserver():
+  saver = sample_observers.InMemorySampleSaver()
+  observer = sample_observers.DeduplicateSampleObserver([saver])
+
+  for text in "abac":
+    assert observer.OnSample(model_pb2.Sample(text=text))
+  assert observer.OnSamples([model_pb2.Sample(text=t) for t in "cd"])
+  assert [s.text for s in saver.samples] == ["a", "b", "c", "d"]
+  assert observer.duplicate_count == 2
+
+
+def test_DeduplicateSampleObserver_counts_unique_samples():
+  observer = sample_observers.DeduplicateSampleObserver(
+    [sample_observers.MaxSampleCountObserver(2)]
+  )
+  assert observer.OnSample(model_pb2.Sample(text="a"))
+  assert observer.OnSample(model_pb2.Sample(text="a"))
+  assert not observer.OnSample(model_pb2.Sample(text="b"))
+
+
+def test_DeduplicateSampleObserver_persisted_filter(tempdir: pathlib.Path):
+  observer = sample_observers.DeduplicateSampleObserver(
+    [], path=tempdir / "filter"
+  )
+  observer.OnSample(model_pb2.Sample(text="a"))
+  observer.Flush()
+
+  saver = sample_observers.InMemorySampleSaver()
+  observer = sample_observers.DeduplicateSampleObserver(
+    [saver], path=tempdir / "filter"
+  )
+  observer.OnSamples([model_pb2.Sample(text=t) for t in "ab"])
+  assert [s.text for s in saver.samples] == ["b"]
+
+
+def test_SampleObserver_OnSamples():
+  observer = sample_observers.MaxSampleCountObserver(3)
+  assert observer.OnSamples([None, None])
+  assert not observer.OnSamples([None, None])
+  assert observer.num_samples_remaining == 0
+
+
+class BatchRecorder(sample_observers.SampleObserver):
+  """An observer which records the batches of samples it is notified of."""
+
+  def __init__(self, num_samples: int = None, release: threading.Event = None):
+    self.batches = []
+    self.num_samples = num_samples
+    self.release = release
+    self.flushed = False
+    # Set once a batch has been received.
+    self.received = threading.Event()
+
+  def OnSamples(self, samples) -> bool:
+    self.received.set()
+    if self.release:
+      self.release.wait()
+    self.batches.append([s.text for s in samples])
+    return self.num_samples is None or (
+      sum(len(b) for b in self.batches) < self.num_samples
+    )
+
+  def Flush(self) -> None:
+    self.flushed = True
+
+
+def test_AsyncSampleObserver_batches():
+  release = threading.Event()
+  recorder = BatchRecorder(release=release)
+  observer = sample_observers.AsyncSampleObserver([recorder], max_batch_size=2)
+
+  for text in "abcde":
+    assert observer.OnSample(model_pb2.Sample(text=text))
+  release.set()
+  observer.Flush()
+  assert recorder.flushed
+  assert sum(recorder.batches, []) == list("abcde")
+  assert max(len(batch) for batch in recorder.batches) == 2
+
+
+def test_AsyncSampleObserver_stop():
+  recorder = BatchRecorder(num_samples=2)
+  observer = sample_observers.AsyncSampleObserver([recorder])
+
+  observer.OnSample(model_pb2.Sample(text="a"))
+  observer.OnSample(model_pb2.Sample(text="b"))
+  observer.Flush()
+  assert not observer.OnSample(model_pb2.Sample(text="c"))
+  observer.Flush()
+
+
+def test_AsyncSampleObserver_Specialize_resets_stop():
+  """Test that a stopped observer can be reused for another sampler."""
+  recorder = BatchRecorder(num_samples=1)
+  observer = sample_observers.AsyncSampleObserver([recorder])
+
+  observer.OnSample(model_pb2.Sample(text="a"))
+  observer.Flush()
+  assert not observer.OnSample(model_pb2.Sample(text="b"))
+
+  observer.Specialize(None, None)
+  recorder.num_samples = None
+  assert observer.OnSample(model_pb2.Sample(text="c"))
+  observer.Flush()
+  assert sum(recorder.batches, []) == ["a", "b", "c"]
+
+
+def test_AsyncSampleObserver_backpressure():
+  release = threading.Event()
+  recorder = BatchRecorder(release=release)
+  observer = sample_observers.AsyncSampleObserver(
+    [recorder], max_queue_size=1, max_batch_size=1
+  )
+  # The first sample is taken by the background thread, and the second fills
+  # the queue.
+  observer.OnSample(model_pb2.Sample(text="a"))
+  recorder.received.wait()
+  observer.OnSample(model_pb2.Sample(text="b"))
+
+  blocked = threading.Thread(
+    target=observer.OnSample, args=(model_pb2.Sample(text="c"),)
+  )
+  blocked.start()
+  blocked.join(timeout=0.1)
+  assert blocked.is_alive()
+
+  release.set()
+  blocked.join()
+  observer.Flush()
+  assert recorder.batches == [["a"], ["b"], ["c"]]
+
+
+def test_AsyncSampleObserver_error():
+  class FailingObserver(sample_observers.SampleObserver):
+    def OnSample(self, sample) -> bool:
+      raise OSError("Disk full")
+
+  observer = sample_observers.AsyncSampleObserver([FailingObserver()])
+  observer.OnSample(model_pb2.Sample(text="a"))
+  with test.Raises(OSError) as e_ctx:
+    observer.Flush()
+  assert str(e_ctx.value) == "Disk full"
+
+
 if __name__ == "__main__":
   test.Main()
@@ -19,6 +19,8 @@ determines the shape of the generated samples.
 """
 import typing
 
+import numpy as np
+
 from deeplearning.clgen import errors
 from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.proto import sampler_pb2
@@ -71,9 +73,17 @@ def AssertConfigIsValid(config: sampler_pb2.Sampler) -> sampler_pb2.Sampler:
 class TerminationCriterionBase(object):
   """Base class for TerminationCriterion objects.
 
-  A TerminationCriterion is an object with a single public function
+  A TerminationCriterion is an object with a public function
   SampleIsComplete(), which accepts as its sole argument a sample-in-progress,
   and returns whether to stop sampling.
+
+  For batched sampling, termination criteria are updated incrementally with
+  the vocabulary indices generated for each row of a batch. InitBatch() begins
+  a batch, ResetRow() begins a new sample in a row, and AppendIndex() and
+  GetCompletionPositions() extend the samples with one or more indices. The
+  default implementation decodes the indices and calls SampleIsComplete()
+  after every token, so subclasses should override them with an implementation
+  that keeps running per-row state.
   """
 
   def Specialize(self, atomizer: atomizers.AtomizerBase) -> None:
@@ -100,6 +110,72 @@ class TerminationCriterionBase(object):
     """
     raise NotImplementedError("abstract class")
 
+  def InitBatch(
+    self,
+    atomizer: atomizers.AtomizerBase,
+    batch_size: int,
+    start_tokens: typing.List[str],
+  ) -> None:
+    """Begin a batch of samples.
+
+    Args:
+      atomizer: The atomizer used to decode generated indices.
+      batch_size: The number of samples in the batch.
+      start_tokens: The tokens that every sample in the batch begins with.
+    """
+    self._decoder = atomizer.decoder
+    self._start_tokens = list(start_tokens)
+    self._samples_in_progress = [
+      list(start_tokens) for _ in range(batch_size)
+    ]
+
+  def ResetRow(self, row: int) -> None:
+    """Begin a new sample in a row of the batch.
+
+    Args:
+      row: The batch row.
+    """
+    self._samples_in_progress[row] = list(self._start_tokens)
+
+  def AppendIndex(self, row: int, index: int) -> bool:
+    """Extend a sample in the batch with a newly generated index.
+
+    Args:
+      row: The batch row.
+      index: The generated vocabulary index.
+
+    Returns:
+      True if the sample is "complete", else False to continue sampling.
+    """
+    sample_in_progress = self._samples_in_progress[row]
+    sample_in_progress.append(self._decoder[index])
+    return self.SampleIsComplete(sample_in_progress)
+
+  def GetCompletionPositions(
+    self, rows: np.ndarray, indices: np.ndarray
+  ) -> np.ndarray:
+    """Extend samples in the batch with newly generated indices.
+
+    Samples which are complete must not be extended again before the row is
+    reset with ResetRow() or InitBatch().
+
+    Args:
+      rows: A 1D array of the batch rows to extend.
+      indices: A 2D array of the vocabulary indices generated for each of the
+        rows, of shape (len(rows), n).
+
+    Returns:
+      A 1D array of the position within each row of indices of the token which
+      completes the sample, or -1 if the sample is not complete.
+    """
+    positions = np.full(len(rows), -1, dtype=np.int64)
+    for i, (row, row_indices) in enumerate(zip(rows, indices)):
+      for j, index in enumerate(row_indices):
+        if self.AppendIndex(row, index):
+          positions[i] = j
+          break
+    return positions
+
 
 class MaxlenTerminationCriterion(TerminationCriterionBase):
   """A termination criterion which limits the maximum length of a sample."""
@@ -119,6 +195,41 @@ class MaxlenTerminationCriterion(TerminationCriterionBase):
     """Determine whether to stop sampling."""
     return len(sample_in_progress) >= self.max_len
 
+  def InitBatch(
+    self,
+    atomizer: atomizers.AtomizerBase,
+    batch_size: int,
+    start_tokens: typing.List[str],
+  ) -> None:
+    """Begin a batch of samples."""
+    del atomizer
+    self._start_token_count = len(start_tokens)
+    self._token_counts = np.full(
+      batch_size, self._start_token_count, dtype=np.int64
+    )
+
+  def ResetRow(self, row: int) -> None:
+    """Begin a new sample in a row of the batch."""
+    self._token_counts[row] = self._start_token_count
+
+  def AppendIndex(self, row: int, index: int) -> bool:
+    """Extend a sample in the batch with a newly generated index."""
+    del index
+    self._token_counts[row] += 1
+    return bool(self._token_counts[row] >= self.max_len)
+
+  def GetCompletionPositions(
+    self, rows: np.ndarray, indices: np.ndarray
+  ) -> np.ndarray:
+    """Extend samples in the batch with newly generated indices."""
+    token_counts = self._token_counts[rows]
+    self._token_counts[rows] += indices.shape[1]
+    # The position of the token which takes the sample to the maximum length.
+    # Samples are only checked after a token is added, so a start text which
+    # is already at the maximum length completes on the first token.
+    positions = np.maximum(self.max_len - token_counts - 1, 0)
+    return np.where(positions < indices.shape[1], positions, -1)
+
 
 class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
   """A termination criterion which counts symmetrical token depth.
@@ -149,6 +260,9 @@ class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
       raise errors.UserError(e)
     if self.left_token == self.right_token:
       raise errors.UserError("SymmetricalTokenDepth tokens must be different")
+    # Set in Specialize().
+    self.left_index = None
+    self.right_index = None
 
   def Specialize(self, atomizer: atomizers.AtomizerBase) -> None:
     """Specialize a termination criteria to a vocabulary.
@@ -178,6 +292,8 @@ class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
         "Sampler symmetrical depth tokens cannot be encoded using the "
         "corpus vocabulary"
       )
+    self.left_index = left[0]
+    self.right_index = right[0]
 
   def SampleIsComplete(self, sample_in_progress: typing.List[str]) -> bool:
     """Determine whether to stop sampling."""
@@ -205,6 +321,75 @@ class SymmetricalTokenDepthCriterion(TerminationCriterionBase):
       return -1
     return left_token_count - right_token_count
 
+  def InitBatch(
+    self,
+    atomizer: atomizers.AtomizerBase,
+    batch_size: int,
+    start_tokens: typing.List[str],
+  ) -> None:
+    """Begin a batch of samples."""
+    del atomizer
+    self._start_token_counts = (
+      start_tokens.count(self.left_token),
+      start_tokens.count(self.right_token),
+    )
+    self._left_token_counts = np.full(
+      batch_size, self._start_token_counts[0], dtype=np.int64
+    )
+    self._right_token_counts = np.full(
+      batch_size, self._start_token_counts[1], dtype=np.int64
+    )
+
+  def ResetRow(self, row: int) -> None:
+    """Begin a new sample in a row of the batch."""
+    self._left_token_counts[row] = self._start_token_counts[0]
+    self._right_token_counts[row] = self._start_token_counts[1]
+
+  def AppendIndex(self, row: int, index: int) -> bool:
+    """Extend a sample in the batch with a newly generated index.
+
+    This is equivalent to SampleIsComplete(), but the token counts are kept
+    for each row, so that each check takes constant time.
+    """
+    if index == self.left_index:
+      self._left_token_counts[row] += 1
+      return False
+    if index != self.right_index:
+      return False
+    self._right_token_counts[row] += 1
+    # See GetTokenDepth().
+    left_token_count = self._left_token_counts[row]
+    return bool(
+      not left_token_count
+      or left_token_count == self._right_token_counts[row]
+    )
+
+  def GetCompletionPositions(
+    self, rows: np.ndarray, indices: np.ndarray
+  ) -> np.ndarray:
+    """Extend samples in the batch with newly generated indices.
+
+    This is equivalent to calling SampleIsComplete() after every token, but
+    the token counts are accumulated over the whole indices array at once.
+    """
+    if not indices.shape[1]:
+      return np.full(len(rows), -1, dtype=np.int64)
+    is_right = indices == self.right_index
+    left_token_counts = self._left_token_counts[rows, np.newaxis] + np.cumsum(
+      indices == self.left_index, axis=1
+    )
+    right_token_counts = self._right_token_counts[
+      rows, np.newaxis
+    ] + np.cumsum(is_right, axis=1)
+    self._left_token_counts[rows] = left_token_counts[:, -1]
+    self._right_token_counts[rows] = right_token_counts[:, -1]
+    # See GetTokenDepth(). A sample is complete at a right token if there are
+    # no left tokens, or the depth has returned to zero.
+    complete = is_right & (
+      (left_token_counts == 0) | (left_token_counts == right_token_counts)
+    )
+    return np.where(complete.any(axis=1), complete.argmax(axis=1), -1)
+
 
 def GetTerminationCriteria(
   config: typing.List[sampler_pb2.SampleTerminationCriterion],
@@ -311,6 +496,65 @@ class Sampler(object):
     """
     return any(t.SampleIsComplete(sample_in_progress) for t in self.terminators)
 
+  def InitBatch(self, atomizer: atomizers.AtomizerBase) -> None:
+    """Begin a batch of samples.
+
+    Args:
+      atomizer: The atomizer that the sampler is specialized to.
+    """
+    for terminator in self.terminators:
+      terminator.InitBatch(
+        atomizer, self.batch_size, self.tokenized_start_text
+      )
+
+  def ResetRow(self, row: int) -> None:
+    """Begin a new sample in a row of the batch.
+
+    Args:
+      row: The batch row.
+    """
+    for terminator in self.terminators:
+      terminator.ResetRow(row)
+
+  def AppendIndex(self, row: int, index: int) -> bool:
+    """Extend a sample in the batch with a newly generated index.
+
+    Args:
+      row: The batch row.
+      index: The generated vocabulary index.
+
+    Returns:
+      True if the sample is "complete", else False to continue sampling.
+    """
+    # Every terminator must be updated, so don't short-circuit.
+    return any([t.AppendIndex(row, index) for t in self.terminators])
+
+  def GetCompletionPositions(
+    self, rows: np.ndarray, indices: np.ndarray
+  ) -> np.ndarray:
+    """Extend samples in the batch with newly generated indices.
+
+    Args:
+      rows: A 1D array of the batch rows to extend.
+      indices: A 2D array of the vocabulary indices generated for each of the
+        rows, of shape (len(rows), n).
+
+    Returns:
+      A 1D array of the position within each row of indices of the token which
+      completes the sample, or -1 if the sample is not complete.
+    """
+    positions = np.full(len(rows), -1, dtype=np.int64)
+    for terminator in self.terminators:
+      terminator_positions = terminator.GetCompletionPositions(rows, indices)
+      # A sample is complete at the earliest position of any terminator.
+      positions = np.where(
+        (terminator_positions >= 0)
+        & ((positions < 0) | (terminator_positions < positions)),
+        terminator_positions,
+        positions,
+      )
+    return positions
+
   @staticmethod
   def _ComputeHash(config: sampler_pb2.Sampler) -> str:
     """Compute sampler hash.
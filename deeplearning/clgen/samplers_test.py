@@ -20,6 +20,7 @@ import pytest
 
 from deeplearning.clgen import errors
 from deeplearning.clgen import samplers
+from deeplearning.clgen.corpuses import atomizers
 from deeplearning.clgen.proto import sampler_pb2
 from labm8.py import app
 from labm8.py import test
@@ -45,6 +46,26 @@ class AtomizerMock(object):
     return ["a"]
 
 
+def _GetCompletionPositionsByDecoding(
+  terminator: samplers.TerminationCriterionBase,
+  atomizer: atomizers.AtomizerBase,
+  start_tokens: typing.List[str],
+  indices: np.ndarray,
+) -> typing.List[int]:
+  """Compute completion positions by calling SampleIsComplete() per token."""
+  positions = []
+  for row_indices in indices:
+    sample_in_progress = list(start_tokens)
+    position = -1
+    for j, index in enumerate(row_indices):
+      sample_in_progress.append(atomizer.decoder[index])
+      if terminator.SampleIsComplete(sample_in_progress):
+        position = j
+        break
+    positions.append(position)
+  return positions
+
+
 # AssertConfigIsValid() tests.
 
 
@@ -130,6 +151,44 @@ def test_MaxlenTerminationCriterion_SampleIsComplete():
   assert t.SampleIsComplete(["a", "b", "c", "d", "e"])
 
 
+@test.Parametrize("start_tokens", ([], ["a"], ["a", "b", "a", "b"]))
+def test_MaxlenTerminationCriterion_GetCompletionPositions(
+  start_tokens: typing.List[str],
+):
+  """Test that batched completion matches SampleIsComplete()."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("ab")
+  t = samplers.MaxlenTerminationCriterion(
+    sampler_pb2.MaxTokenLength(maximum_tokens_in_sample=3)
+  )
+  indices = np.random.RandomState(0).randint(0, 2, size=(4, 2))
+  rows = np.arange(4)
+  t.InitBatch(atomizer, 4, start_tokens)
+  first = t.GetCompletionPositions(rows, indices)
+  expected = _GetCompletionPositionsByDecoding(
+    t, atomizer, start_tokens, indices
+  )
+  assert first.tolist() == expected
+  # Extending the incomplete samples continues from their token counts.
+  if (first < 0).any():
+    second = t.GetCompletionPositions(rows[first < 0], indices[first < 0])
+    assert second.tolist() == [0] * int((first < 0).sum())
+
+
+def test_MaxlenTerminationCriterion_AppendIndex_ResetRow():
+  """Test that token counts are kept per row, and reset."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("ab")
+  t = samplers.MaxlenTerminationCriterion(
+    sampler_pb2.MaxTokenLength(maximum_tokens_in_sample=3)
+  )
+  t.InitBatch(atomizer, 2, ["a"])
+  assert not t.AppendIndex(0, 0)
+  assert t.AppendIndex(0, 0)
+  assert not t.AppendIndex(1, 0)
+  t.ResetRow(0)
+  assert not t.AppendIndex(0, 0)
+  assert t.AppendIndex(1, 0)
+
+
 # SymmetricalTokenDepthCriterion tests.
 
 
@@ -214,6 +273,84 @@ def test_SymmetrcalTokenDepthCriterion_SampleIsComplete_reverse_order():
   assert t.SampleIsComplete(["-", "a", "b", "c", "+", "+", "-"])
 
 
+@test.Parametrize("start_tokens", ([], ["+"], ["-"], ["+", "-"]))
+def test_SymmetricalTokenDepthCriterion_GetCompletionPositions(
+  start_tokens: typing.List[str],
+):
+  """Test that batched completion matches SampleIsComplete()."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("a+-")
+  t = samplers.SymmetricalTokenDepthCriterion(
+    sampler_pb2.SymmetricalTokenDepth(
+      depth_increase_token="+", depth_decrease_token="-"
+    )
+  )
+  t.Specialize(atomizer)
+  indices = np.random.RandomState(0).randint(0, 3, size=(32, 8))
+  t.InitBatch(atomizer, 32, start_tokens)
+  positions = t.GetCompletionPositions(np.arange(32), indices)
+  assert positions.tolist() == _GetCompletionPositionsByDecoding(
+    t, atomizer, start_tokens, indices
+  )
+
+
+def test_SymmetricalTokenDepthCriterion_GetCompletionPositions_incremental():
+  """Test that token counts are carried between calls."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("a+-")
+  t = samplers.SymmetricalTokenDepthCriterion(
+    sampler_pb2.SymmetricalTokenDepth(
+      depth_increase_token="+", depth_decrease_token="-"
+    )
+  )
+  t.Specialize(atomizer)
+  t.InitBatch(atomizer, 2, [])
+  indices = atomizer.AtomizeString("a++-a+--")
+  batch = np.stack([indices, indices])
+  rows = np.array([0, 1])
+  assert t.GetCompletionPositions(rows, batch[:, :4]).tolist() == [-1, -1]
+  # Only the second row is extended.
+  assert t.GetCompletionPositions(rows[1:], batch[1:, 4:]).tolist() == [3]
+  assert t.GetCompletionPositions(rows[:1], batch[:1, :4]).tolist() == [-1]
+
+
+def test_SymmetricalTokenDepthCriterion_AppendIndex():
+  """Test that incremental completion matches SampleIsComplete()."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("a+-")
+  t = samplers.SymmetricalTokenDepthCriterion(
+    sampler_pb2.SymmetricalTokenDepth(
+      depth_increase_token="+", depth_decrease_token="-"
+    )
+  )
+  t.Specialize(atomizer)
+  indices = np.random.RandomState(0).randint(0, 3, size=(32, 8))
+  t.InitBatch(atomizer, 32, ["+"])
+  for row, row_indices in enumerate(indices):
+    sample_in_progress = ["+"]
+    for index in row_indices:
+      sample_in_progress.append(atomizer.decoder[index])
+      assert t.AppendIndex(row, index) == t.SampleIsComplete(
+        sample_in_progress
+      )
+      if t.SampleIsComplete(sample_in_progress):
+        break
+
+
+def test_SymmetricalTokenDepthCriterion_ResetRow():
+  """Test that resetting a row restores the start text token counts."""
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("a+-")
+  t = samplers.SymmetricalTokenDepthCriterion(
+    sampler_pb2.SymmetricalTokenDepth(
+      depth_increase_token="+", depth_decrease_token="-"
+    )
+  )
+  t.Specialize(atomizer)
+  plus, minus = atomizer.AtomizeString("+-")
+  t.InitBatch(atomizer, 1, ["+", "+"])
+  assert not t.AppendIndex(0, minus)
+  t.ResetRow(0)
+  assert not t.AppendIndex(0, minus)
+  assert t.AppendIndex(0, minus)
+
+
 # Sampler tests.
 
 
@@ -306,5 +443,52 @@ def test_Sampler_Specialize_encoded_start_text(
   np.testing.assert_array_equal(np.array([1]), s.encoded_start_text)
 
 
+# Sampler.GetCompletionPositions() tests.
+
+
+def test_Sampler_GetCompletionPositions_earliest_terminator(
+  abc_sampler_config: sampler_pb2.Sampler,
+):
+  """Test that a sample completes at the first position of any terminator."""
+  t = abc_sampler_config.termination_criteria.add()
+  t.symtok.depth_increase_token = "+"
+  t.symtok.depth_decrease_token = "-"
+  abc_sampler_config.batch_size = 3
+  s = samplers.Sampler(abc_sampler_config)
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("a+-")
+  s.Specialize(atomizer)
+  s.InitBatch(atomizer)
+  indices = np.stack(
+    [
+      atomizer.AtomizeString("+-aaaa"),  # Depth returns to zero.
+      atomizer.AtomizeString("++aaaa"),  # Maximum length.
+      atomizer.AtomizeString("+-a-aa"),  # Both, depth first.
+    ]
+  )
+  positions = s.GetCompletionPositions(np.arange(3), indices)
+  assert positions.tolist() == [1, 3, 1]
+
+
+def test_Sampler_AppendIndex_updates_all_terminators(
+  abc_sampler_config: sampler_pb2.Sampler,
+):
+  """Test that every terminator is updated, even once one has completed."""
+  t = abc_sampler_config.termination_criteria.add()
+  t.symtok.depth_increase_token = "+"
+  t.symtok.depth_decrease_token = "-"
+  abc_sampler_config.batch_size = 1
+  abc_sampler_config.termination_criteria[0].maxlen.maximum_tokens_in_sample = 2
+  s = samplers.Sampler(abc_sampler_config)
+  atomizer = atomizers.AsciiCharacterAtomizer.FromText("a+-")
+  s.Specialize(atomizer)
+  s.InitBatch(atomizer)
+  plus, minus = atomizer.AtomizeString("+-")
+  # The start text "a" plus one token reaches the maximum length.
+  assert s.AppendIndex(0, plus)
+  assert s.AppendIndex(0, plus)
+  # The depth is still two, since both tokens were counted.
+  assert not s.terminators[1].AppendIndex(0, minus)
+
+
 if __name__ == "__main__":
   test.Main()
@@ -1,12 +1,17 @@
 """A module for databases of CLgen samples."""
+import collections
 import contextlib
 import datetime
+import multiprocessing
+import multiprocessing.pool
+import time
 import typing
 
 import sqlalchemy as sql
 from sqlalchemy.ext import declarative
 
 from deeplearning.clgen import sample_observers
+from deeplearning.clgen.preprocessors import preprocessors
 from deeplearning.clgen.proto import model_pb2
 from labm8.py import app
 from labm8.py import crypto
@@ -63,11 +68,173 @@ class Sample(Base, sqlutil.ProtoBackedMixin):
     }
 
 
+class PreprocessedSample(Base):
+  """A database row representing the result of preprocessing a sample."""
+
+  __tablename__ = "preprocessed_samples"
+
+  id: int = sql.Column(sql.Integer, primary_key=True)
+  # Checksum of the sample text.
+  sample_sha256: str = sql.Column(sql.String(64), nullable=False, index=True)
+  # Checksum of the preprocessed text.
+  sha256: str = sql.Column(sql.String(64), nullable=False, index=True)
+  # The preprocessed text if preprocessing succeeded, else the error message.
+  text: str = sql.Column(
+    sqlutil.ColumnTypes.UnboundedUnicodeText(), nullable=False
+  )
+  # True if pre-processing succeeded, else False.
+  preprocessing_succeeded: bool = sql.Column(sql.Boolean, nullable=False)
+  # The number of milliseconds pre-preprocessing took.
+  preprocess_time_ms: int = sql.Column(sql.Integer, nullable=False)
+  date_added: datetime.datetime = sql.Column(
+    sql.DateTime, nullable=False, default=datetime.datetime.utcnow
+  )
+
+
+def PreprocessSample(
+  text: str, preprocessors_: typing.List[str]
+) -> typing.Dict[str, typing.Any]:
+  """Preprocess the text of a sample.
+
+  Args:
+    text: The sample text.
+    preprocessors_: The list of preprocessors to run.
+
+  Returns:
+    The column values of a PreprocessedSample.
+  """
+  start_time = time.time()
+  try:
+    preprocessed = preprocessors.Preprocess(text, preprocessors_)
+    preprocessing_succeeded = True
+  except ValueError as e:
+    # BadCodeException subclasses ValueError. Catch the more general
+    # ValueError so that custom preprocessors can raise ValueError.
+    preprocessed = str(e)
+    preprocessing_succeeded = False
+  return {
+    "sample_sha256": crypto.sha256_str(text),
+    "sha256": crypto.sha256_str(preprocessed),
+    "text": preprocessed,
+    "preprocessing_succeeded": preprocessing_succeeded,
+    "preprocess_time_ms": int((time.time() - start_time) * 1000),
+  }
+
+
+# The column values of a Sample which are read from a sample proto:
+# <text, num_tokens, sample_time_ms, wall_time_ms, sample_start_epoch_ms_utc>.
+SampleRow = typing.Tuple[str, int, int, int, int]
+
+# Pragmas set on every connection to an SQLite database.
+_SQLITE_PRAGMAS = (
+  "temp_store=MEMORY",
+  # A 64 MiB page cache.
+  "cache_size=-65536",
+)
+# Pragmas set on every connection to an SQLite database which uses write-ahead
+# logging. Write-ahead logging lets readers proceed during a commit, and with
+# it, synchronous=NORMAL only syncs at checkpoints rather than on every commit.
+_SQLITE_WAL_PRAGMAS = (
+  "journal_mode=WAL",
+  "synchronous=NORMAL",
+)
+
+
+def _SetSqlitePragmas(dbapi_connection, pragmas: typing.Iterable[str]):
+  """Set pragmas on a new database connection."""
+  cursor = dbapi_connection.cursor()
+  for pragma in pragmas:
+    cursor.execute(f"PRAGMA {pragma}")
+  cursor.close()
+
+
+def InsertSampleRows(
+  session: sqlutil.Session, rows: typing.List[SampleRow]
+) -> int:
+  """Insert and commit samples using a single bulk insert statement.
+
+  This bypasses the ORM, which is much faster for large numbers of samples. If
+  the bulk insert fails, the samples are inserted one at a time, so that only
+  the samples which cannot be inserted are lost.
+
+  Args:
+    session: A database session.
+    rows: The samples to insert.
+
+  Returns:
+    The number of samples which could not be inserted.
+  """
+  if not rows:
+    return 0
+  date_added = datetime.datetime.utcnow()
+  mappings = [
+    {
+      "text": text,
+      "sha256": crypto.sha256_str(text),
+      "num_tokens": num_tokens,
+      "sample_time_ms": sample_time_ms,
+      "wall_time_ms": wall_time_ms,
+      "sample_date": labdate.DatetimeFromMillisecondsTimestamp(
+        sample_start_epoch_ms_utc
+      ),
+      "date_added": date_added,
+    }
+    for (
+      text,
+      num_tokens,
+      sample_time_ms,
+      wall_time_ms,
+      sample_start_epoch_ms_utc,
+    ) in rows
+  ]
+  try:
+    session.execute(Sample.__table__.insert(), mappings)
+    session.commit()
+    return 0
+  except sql.exc.SQLAlchemyError as e:
+    app.Log(1, "Bulk insert of %d samples failed: %s", len(mappings), e)
+    session.rollback()
+
+  error_count = 0
+  for mapping in mappings:
+    try:
+      session.execute(Sample.__table__.insert(), mapping)
+      session.commit()
+    except sql.exc.SQLAlchemyError:
+      session.rollback()
+      error_count += 1
+  return error_count
+
+
 class SamplesDatabase(sqlutil.Database):
   """A database of CLgen samples."""
 
-  def __init__(self, url: str, must_exist: bool = False):
+  def __init__(
+    self, url: str, must_exist: bool = False, sqlite_wal: bool = False
+  ):
+    """Constructor.
+
+    Args:
+      url: The URL of the database.
+      must_exist: If True, raise an error if the database does not exist.
+      sqlite_wal: If True, an SQLite database uses write-ahead logging, which
+        speeds up writes. Write-ahead logging is not safe on network
+        filesystems such as NFS. The journal mode is stored in the database,
+        so once set, it persists.
+    """
     super(SamplesDatabase, self).__init__(url, Base, must_exist=must_exist)
+    if self.engine.dialect.name == "sqlite":
+      pragmas = _SQLITE_PRAGMAS + (_SQLITE_WAL_PRAGMAS if sqlite_wal else ())
+      sql.event.listen(
+        self.engine,
+        "connect",
+        lambda dbapi_connection, _: _SetSqlitePragmas(
+          dbapi_connection, pragmas
+        ),
+      )
+      # Close any pooled connections, so that all connections have the
+      # pragmas set.
+      self.engine.dispose()
 
   @contextlib.contextmanager
   def Observer(self) -> sample_observers.SampleObserver:
@@ -76,20 +243,144 @@ class SamplesDatabase(sqlutil.Database):
     yield observer
     observer.Flush()
 
+  @contextlib.contextmanager
+  def PreprocessingObserver(
+    self, preprocessors_: typing.List[str], **kwargs
+  ) -> sample_observers.SampleObserver:
+    """Return an observer that preprocesses samples into the database.
+
+    See PreprocessedSamplesObserver for the keyword arguments.
+    """
+    observer = PreprocessedSamplesObserver(self, preprocessors_, **kwargs)
+    yield observer
+    observer.Flush()
+
 
 class SamplesDatabaseObserver(sample_observers.SampleObserver):
   """A sample observer that imports samples to a database.
 
-  The observer buffers the records that it recieves and commits them to the
-  database in batches.
+  The observer buffers the records that it recieves as plain tuples, and hands
+  them to a background thread in batches. Each batch is inserted using a single
+  bulk insert statement. See InsertSampleRows(). Samples which cannot be
+  inserted are logged and counted in error_count, rather than stopping the
+  background thread.
+  """
+
+  def __init__(
+    self,
+    db: SamplesDatabase,
+    flush_secs: int = 30,
+    commit_sample_frequency: int = 1024,
+  ):
+    self.flush_secs = flush_secs
+    self.commit_sample_frequency = commit_sample_frequency
+    self._rows: typing.List[SampleRow] = []
+    self._last_flush = time.time()
+    # The number of samples which could not be inserted.
+    self.error_count = 0
+    # Every batch is committed as soon as it is received. At most two batches
+    # are queued before OnSample() blocks.
+    self._writer = sqlutil.BufferedDatabaseWriter(db, max_buffer_length=1)
+
+  def __del__(self):
+    self._writer.Close()
+
+  def OnSample(self, sample: model_pb2.Sample) -> bool:
+    """Sample receive callback."""
+    return self.OnSamples([sample])
+
+  def OnSamples(self, samples: typing.List[model_pb2.Sample]) -> bool:
+    """Batched sample receive callback."""
+    self._rows += [
+      (
+        sample.text,
+        sample.num_tokens,
+        sample.sample_time_ms,
+        sample.wall_time_ms,
+        sample.sample_start_epoch_ms_utc,
+      )
+      for sample in samples
+    ]
+    if (
+      len(self._rows) >= self.commit_sample_frequency
+      or time.time() - self._last_flush >= self.flush_secs
+    ):
+      self._WriteRows()
+    return True
+
+  def _WriteRows(self) -> None:
+    """Hand the buffered rows to the writer thread."""
+    rows, self._rows = self._rows, []
+    self._last_flush = time.time()
+    if rows:
+      self._writer.AddLambdaOp(lambda session: self._InsertRows(session, rows))
+
+  def _InsertRows(
+    self, session: sqlutil.Session, rows: typing.List[SampleRow]
+  ) -> None:
+    """Insert a batch of rows. Called by the writer thread."""
+    error_count = InsertSampleRows(session, rows)
+    if error_count:
+      app.Warning("Failed to insert %d of %d samples", error_count, len(rows))
+      self.error_count += error_count
+
+  def Flush(self) -> None:
+    """Commit all pending records to database."""
+    self._WriteRows()
+    self._writer.Flush()
+
+
+class PreprocessedSamplesObserver(sample_observers.SampleObserver):
+  """A sample observer that preprocesses samples and records the results.
+
+  Samples are preprocessed by a pool of worker processes while sampling
+  continues, and the results are committed to the database in batches. With a
+  pipeline which compiles samples, this checks the samples as they are
+  generated.
   """
 
   def __init__(
     self,
     db: SamplesDatabase,
+    preprocessors_: typing.List[str],
+    max_valid_samples: typing.Optional[int] = None,
+    processes: typing.Optional[int] = None,
     flush_secs: int = 30,
     commit_sample_frequency: int = 1024,
   ):
+    """Constructor.
+
+    Args:
+      db: The database to record results in.
+      preprocessors_: The list of preprocessors to run.
+      max_valid_samples: If set, sampling is stopped once this many samples
+        have been preprocessed successfully. Since samples are preprocessed
+        asynchronously, sampling may stop some samples later.
+      processes: The number of worker processes. If not set, the number of
+        CPUs is used.
+      flush_secs: The maximum number of seconds between commits.
+      commit_sample_frequency: The maximum number of results between commits.
+
+    Raises:
+      UserError: If a preprocessor cannot be found.
+    """
+    # Check the preprocessors here, since errors in the worker processes are
+    # only raised once the results are recorded.
+    for preprocessor in preprocessors_:
+      preprocessors.GetPreprocessorFunction(preprocessor)
+    self.preprocessors = preprocessors_
+    self.max_valid_samples = max_valid_samples
+    self.valid_count = 0
+    self.invalid_count = 0
+    processes = processes or multiprocessing.cpu_count()
+    # The pool is created up front, before sampling starts any threads.
+    self._pool = multiprocessing.Pool(processes)
+    # The pending results, in the order that samples were received. Once there
+    # are this many, OnSample() waits for the oldest to complete.
+    self._pending: typing.Deque[multiprocessing.pool.AsyncResult] = (
+      collections.deque()
+    )
+    self._max_pending = processes * 4
     self._writer = sqlutil.BufferedDatabaseWriter(
       db,
       max_seconds_since_flush=flush_secs,
@@ -97,13 +388,40 @@ class SamplesDatabaseObserver(sample_observers.SampleObserver):
     )
 
   def __del__(self):
-    self._writer.Close()
+    # The writer is created last, so if it exists, so does the pool.
+    if hasattr(self, "_writer"):
+      self._pool.terminate()
+      self._writer.Close()
 
   def OnSample(self, sample: model_pb2.Sample) -> bool:
     """Sample receive callback."""
-    self._writer.AddOne(Sample(**Sample.FromProto(sample)))
-    return True
+    self._pending.append(
+      self._pool.apply_async(
+        PreprocessSample, (sample.text, self.preprocessors)
+      )
+    )
+    self._RecordResults(wait=len(self._pending) > self._max_pending)
+    return (
+      not self.max_valid_samples or self.valid_count < self.max_valid_samples
+    )
+
+  def _RecordResults(self, wait: bool = False) -> None:
+    """Record the results which are ready.
+
+    Args:
+      wait: If True, wait for the oldest result to complete.
+    """
+    while self._pending and (wait or self._pending[0].ready()):
+      result = self._pending.popleft().get()
+      if result["preprocessing_succeeded"]:
+        self.valid_count += 1
+      else:
+        self.invalid_count += 1
+      self._writer.AddOne(PreprocessedSample(**result))
+      wait = False
 
   def Flush(self) -> None:
-    """Commit all pending records to database."""
+    """Wait for pending samples, and commit all results to database."""
+    while self._pending:
+      self._RecordResults(wait=True)
     self._writer.Flush()
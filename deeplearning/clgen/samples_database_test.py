@@ -1,10 +1,13 @@
 """Unit tests for //deeplearning/clgen:samples_database."""
 import pathlib
+import threading
 
 import pytest
 
+from deeplearning.clgen import errors
 from deeplearning.clgen import samples_database
 from deeplearning.clgen.proto import model_pb2
+from labm8.py import crypto
 from labm8.py import test
 
 FLAGS = test.FLAGS
@@ -31,5 +34,123 @@ def test_SamplesDatabaseObserver_add_one(db: samples_database.SamplesDatabase):
     assert s.query(samples_database.Sample).one().ToProto() == sample_proto
 
 
+def test_SamplesDatabaseObserver_batches(db: samples_database.SamplesDatabase):
+  obs = samples_database.SamplesDatabaseObserver(db, commit_sample_frequency=2)
+  obs.OnSamples([model_pb2.Sample(text="a"), model_pb2.Sample(text="b")])
+  obs.OnSample(model_pb2.Sample(text="a"))
+  obs.Flush()
+
+  with db.Session() as s:
+    samples = s.query(samples_database.Sample).order_by(
+      samples_database.Sample.id
+    )
+    assert [sample.text for sample in samples] == ["a", "b", "a"]
+    assert samples.first().sha256 == crypto.sha256_str("a")
+
+
+def test_InsertSampleRows_error(db: samples_database.SamplesDatabase):
+  """Test that rows which cannot be inserted do not prevent the others."""
+  with db.Session() as s:
+    error_count = samples_database.InsertSampleRows(
+      s, [("a", 1, 1, 1, 1000), ("b", None, 1, 1, 1000), ("c", 1, 1, 1, 1000)]
+    )
+  assert error_count == 1
+  with db.Session() as s:
+    assert sorted(
+      text for text, in s.query(samples_database.Sample.text)
+    ) == ["a", "c"]
+
+
+def test_SamplesDatabaseObserver_insert_error(
+  db: samples_database.SamplesDatabase,
+):
+  """Test that Flush() returns if samples cannot be inserted."""
+  obs = samples_database.SamplesDatabaseObserver(db)
+  db.engine.execute("DROP TABLE samples")
+  obs.OnSamples([model_pb2.Sample(text="a"), model_pb2.Sample(text="b")])
+
+  flush = threading.Thread(target=obs.Flush)
+  flush.start()
+  flush.join(timeout=60)
+  assert not flush.is_alive()
+  assert obs.error_count == 2
+
+
+def test_SamplesDatabase_sqlite_journal_mode(
+  db: samples_database.SamplesDatabase,
+):
+  with db.Session() as s:
+    assert s.execute("PRAGMA journal_mode").scalar() == "delete"
+
+
+def test_SamplesDatabase_sqlite_wal(tempdir: pathlib.Path):
+  db = samples_database.SamplesDatabase(
+    f"sqlite:///{tempdir}/wal_db", sqlite_wal=True
+  )
+  with db.Session() as s:
+    assert s.execute("PRAGMA journal_mode").scalar() == "wal"
+    # NORMAL.
+    assert s.execute("PRAGMA synchronous").scalar() == 1
+
+
+# A preprocessor pipeline which does not require a compiler.
+PREPROCESSORS = [
+  "deeplearning.clgen.preprocessors.common:StripTrailingWhitespace",
+  "deeplearning.clgen.preprocessors.common:MinimumLineCount3",
+]
+
+
+def test_PreprocessSample_succeeded():
+  result = samples_database.PreprocessSample("a \nb\nc", PREPROCESSORS)
+  assert result["preprocessing_succeeded"]
+  assert result["text"] == "a\nb\nc"
+
+
+def test_PreprocessSample_failed():
+  result = samples_database.PreprocessSample("a", PREPROCESSORS)
+  assert not result["preprocessing_succeeded"]
+  assert result["text"] == ""
+
+
+def test_PreprocessedSamplesObserver(db: samples_database.SamplesDatabase):
+  with db.PreprocessingObserver(PREPROCESSORS, processes=2) as obs:
+    assert obs.OnSample(model_pb2.Sample(text="a \nb\nc"))
+    assert obs.OnSample(model_pb2.Sample(text="a"))
+
+  assert obs.valid_count == 1
+  assert obs.invalid_count == 1
+  with db.Session() as s:
+    results = s.query(samples_database.PreprocessedSample).all()
+    assert sorted((r.preprocessing_succeeded, r.text) for r in results) == [
+      (False, ""),
+      (True, "a\nb\nc"),
+    ]
+
+
+def test_PreprocessedSamplesObserver_max_valid_samples(
+  db: samples_database.SamplesDatabase,
+):
+  with db.PreprocessingObserver(
+    PREPROCESSORS, max_valid_samples=2, processes=1
+  ) as obs:
+    # Results are recorded asynchronously, so sample until the observer
+    # returns False.
+    for _ in range(100):
+      if not obs.OnSample(model_pb2.Sample(text="a\nb\nc")):
+        break
+    obs.Flush()
+    assert obs.valid_count >= 2
+    assert not obs.OnSample(model_pb2.Sample(text="a\nb\nc"))
+
+
+def test_PreprocessedSamplesObserver_invalid_preprocessor(
+  db: samples_database.SamplesDatabase,
+):
+  with test.Raises(errors.UserError):
+    samples_database.PreprocessedSamplesObserver(
+      db, ["deeplearning.clgen.preprocessors.common:NotAPreprocessor"]
+    )
+
+
 if __name__ == "__main__":
   test.Main()
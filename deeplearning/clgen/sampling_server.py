@@ -0,0 +1,335 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""A long-running HTTP server for sampling a pre-trained model.
+
+The server loads a pre-trained model once, and serves requests for samples on
+localhost. Concurrent requests which use the same sampler are packed into
+shared sample batches, and the samples for each request are streamed back as
+they are generated.
+
+Usage:
+
+  $ bazel run //deeplearning/clgen:sampling_server -- \\
+      --clgen_sampling_server_model=/path/to/exported/model \\
+      --clgen_sampling_server_sampler=/path/to/sampler.pbtxt \\
+      --clgen_sampling_server_port=8080
+
+  $ curl -d '{"start_text": "kernel void A(", "num_samples": 10}' \\
+      http://127.0.0.1:8080/sample
+
+Each line of the response is a JSON object describing one sample.
+"""
+import collections
+import json
+import pathlib
+import queue
+import threading
+import typing
+
+import flask
+import portpicker
+
+from deeplearning.clgen import errors
+from deeplearning.clgen import sample_observers as sample_observers_lib
+from deeplearning.clgen import samplers
+from deeplearning.clgen.models import pretrained
+from deeplearning.clgen.proto import model_pb2
+from deeplearning.clgen.proto import sampler_pb2
+from labm8.py import app
+from labm8.py import pbutil
+
+FLAGS = app.FLAGS
+
+app.DEFINE_string(
+  "clgen_sampling_server_model",
+  None,
+  "The path of a pre-trained model to sample, as exported by "
+  "`clgen --export_model`.",
+)
+app.DEFINE_string(
+  "clgen_sampling_server_sampler",
+  None,
+  "The path of a Sampler proto file. The batch size, sequence length, and "
+  "termination criteria are used for all requests. The start text and "
+  "temperature are the defaults for requests which do not set them.",
+)
+app.DEFINE_integer(
+  "clgen_sampling_server_port",
+  None,
+  "The port to launch the server on. If not set, an unused port is picked.",
+)
+
+
+class SampleRequest(object):
+  """A request for samples, which is filled by a SamplingScheduler.
+
+  Iterating over a request yields its samples as they are generated, until the
+  requested number of samples have been produced.
+  """
+
+  def __init__(self, sampler: samplers.Sampler, num_samples: int):
+    self.sampler = sampler
+    self.num_samples = num_samples
+    # The number of samples which have not yet been produced.
+    self.num_samples_remaining = num_samples
+    # A queue of samples, terminated by None. If sampling fails, the exception
+    # is put on the queue.
+    self._queue = queue.Queue()
+
+  def __iter__(self) -> typing.Iterator[model_pb2.Sample]:
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      if isinstance(item, Exception):
+        raise item
+      yield item
+
+  def Put(self, item: typing.Union[model_pb2.Sample, Exception, None]):
+    """Add a sample to the request, or end it with None or an exception."""
+    self._queue.put(item)
+
+
+class SamplingScheduler(object):
+  """Schedules sample requests onto shared sample batches.
+
+  Requests are grouped by sampler. Requests in the same group share sample
+  batches, with samples handed out to the requests in the order that they
+  were received. A single background thread samples the model, taking turns
+  between groups in round-robin order after every batch.
+  """
+
+  def __init__(
+    self, model: pretrained.PreTrainedModel, sampler_config: sampler_pb2.Sampler
+  ):
+    """Constructor.
+
+    Args:
+      model: The model to sample.
+      sampler_config: The sampler for requests. Requests may override the
+        start text and temperature.
+    """
+    self.model = model
+    self.sampler_config = sampler_config
+    # The pending requests. The group of the first request is sampled next.
+    self._pending: typing.List[SampleRequest] = []
+    self._condition = threading.Condition()
+    self._stopped = False
+    self._thread = threading.Thread(target=self._Run, daemon=True)
+
+  def Start(self) -> None:
+    """Start sampling requests in a background thread."""
+    self._thread.start()
+
+  def Stop(self) -> None:
+    """Stop sampling. Sampling stops once the current batch is complete."""
+    with self._condition:
+      self._stopped = True
+      self._condition.notify_all()
+
+  def Submit(
+    self,
+    start_text: typing.Optional[str] = None,
+    temperature: typing.Optional[float] = None,
+    num_samples: int = 1,
+  ) -> SampleRequest:
+    """Submit a request for samples.
+
+    Args:
+      start_text: The start text of the samples. If not set, the start text of
+        the sampler config is used.
+      temperature: The sampling temperature. If not set, the temperature of
+        the sampler config is used.
+      num_samples: The number of samples to produce.
+
+    Returns:
+      A SampleRequest, which yields samples once they are generated.
+
+    Raises:
+      UserError: If the request parameters are invalid.
+      InvalidStartText: If the start text cannot be encoded.
+    """
+    if not isinstance(num_samples, int) or num_samples < 1:
+      raise errors.UserError(f"num_samples must be >= 1: '{num_samples}'")
+    config = sampler_pb2.Sampler()
+    config.CopyFrom(self.sampler_config)
+    if start_text is not None:
+      config.start_text = start_text
+    if temperature is not None:
+      if not isinstance(temperature, (int, float)):
+        raise errors.UserError(
+          f"temperature must be a number: '{temperature}'"
+        )
+      config.temperature_micros = int(temperature * 1e6)
+    sampler = samplers.Sampler(config)
+    sampler.Specialize(self.model.atomizer)
+
+    request = SampleRequest(sampler, num_samples)
+    with self._condition:
+      self._pending.append(request)
+      self._condition.notify_all()
+    return request
+
+  def Cancel(self, request: SampleRequest) -> None:
+    """Cancel a request. No more samples are produced for it."""
+    with self._condition:
+      if request in self._pending:
+        self._pending.remove(request)
+
+  def _Run(self) -> None:
+    """Sample the model until stopped."""
+    while True:
+      with self._condition:
+        while not self._pending and not self._stopped:
+          self._condition.wait()
+        if self._stopped:
+          for request in self._pending:
+            request.Put(errors.UserError("Sampling server stopped"))
+          self._pending = []
+          return
+        sampler = self._pending[0].sampler
+
+      try:
+        self.model.Sample(sampler, [_RequestDispatcher(self, sampler.hash)])
+      except Exception as e:
+        app.Error("Sampling failed: %s", e)
+        with self._condition:
+          for request in self._GetRequests(sampler.hash):
+            self._pending.remove(request)
+            request.Put(e)
+        continue
+
+      # Move the group's remaining requests to the back of the queue, so that
+      # the other groups take their turns.
+      with self._condition:
+        requests = self._GetRequests(sampler.hash)
+        self._pending = [
+          r for r in self._pending if r.sampler.hash != sampler.hash
+        ] + requests
+
+  def _GetRequests(self, sampler_hash: str) -> typing.List[SampleRequest]:
+    """Get the pending requests for a sampler. Must hold the lock."""
+    return [r for r in self._pending if r.sampler.hash == sampler_hash]
+
+  def _OnSample(self, sampler_hash: str, sample: model_pb2.Sample) -> bool:
+    """Hand out a sample to the oldest pending request for a sampler.
+
+    Returns:
+      True if the current group of requests should continue sampling, else
+      False if it has no more pending requests, or another group is waiting.
+    """
+    with self._condition:
+      requests = self._GetRequests(sampler_hash)
+      if requests:
+        request = requests[0]
+        request.Put(sample)
+        request.num_samples_remaining -= 1
+        if not request.num_samples_remaining:
+          self._pending.remove(request)
+          request.Put(None)
+      if self._stopped:
+        return False
+      # Take turns with other groups of requests after every batch.
+      num_requests = len(self._GetRequests(sampler_hash))
+      return bool(num_requests) and num_requests == len(self._pending)
+
+
+class _RequestDispatcher(sample_observers_lib.SampleObserver):
+  """A sample observer which hands out samples to pending requests."""
+
+  def __init__(self, scheduler: SamplingScheduler, sampler_hash: str):
+    self.scheduler = scheduler
+    self.sampler_hash = sampler_hash
+
+  def OnSample(self, sample: model_pb2.Sample) -> bool:
+    """Sample receive callback. Returns True if sampling should continue."""
+    return self.scheduler._OnSample(self.sampler_hash, sample)
+
+
+def SampleToDict(sample: model_pb2.Sample) -> typing.Dict[str, typing.Any]:
+  """Convert a sample to a JSON-serializable dictionary."""
+  return collections.OrderedDict(
+    [
+      ("text", sample.text),
+      ("num_tokens", sample.num_tokens),
+      ("sample_start_epoch_ms_utc", sample.sample_start_epoch_ms_utc),
+      ("sample_time_ms", sample.sample_time_ms),
+      ("wall_time_ms", sample.wall_time_ms),
+    ]
+  )
+
+
+def CreateApp(scheduler: SamplingScheduler) -> flask.Flask:
+  """Create a Flask app which serves sample requests.
+
+  The app has a single endpoint, POST /sample, which accepts a JSON object
+  with optional "start_text", "temperature", and "num_samples" fields. The
+  response is streamed as newline-delimited JSON, with one line per sample.
+  If sampling fails, the last line is an object with an "error" field.
+  """
+  flask_app = flask.Flask(__name__)
+
+  @flask_app.route("/sample", methods=["POST"])
+  def Sample():
+    params = flask.request.get_json(force=True, silent=True)
+    if not isinstance(params, dict):
+      return flask.jsonify(error="Request must be a JSON object"), 400
+    try:
+      request = scheduler.Submit(
+        start_text=params.get("start_text"),
+        temperature=params.get("temperature"),
+        num_samples=params.get("num_samples", 1),
+      )
+    except (errors.UserError, errors.VocabError) as e:
+      return flask.jsonify(error=str(e)), 400
+
+    def Stream() -> typing.Iterator[str]:
+      try:
+        for sample in request:
+          yield json.dumps(SampleToDict(sample)) + "\n"
+      except Exception as e:
+        yield json.dumps({"error": str(e)}) + "\n"
+      finally:
+        # Stop sampling for a client which disconnects early.
+        scheduler.Cancel(request)
+
+    return flask.Response(Stream(), mimetype="application/x-ndjson")
+
+  return flask_app
+
+
+def main():
+  """Main entry point."""
+  if not FLAGS.clgen_sampling_server_model:
+    raise app.UsageError("--clgen_sampling_server_model must be set")
+  if not FLAGS.clgen_sampling_server_sampler:
+    raise app.UsageError("--clgen_sampling_server_sampler must be set")
+
+  model = pretrained.PreTrainedModel(
+    pathlib.Path(FLAGS.clgen_sampling_server_model)
+  )
+  sampler_config = pbutil.FromFile(
+    pathlib.Path(FLAGS.clgen_sampling_server_sampler), sampler_pb2.Sampler()
+  )
+  scheduler = SamplingScheduler(model, sampler_config)
+  scheduler.Start()
+
+  port = FLAGS.clgen_sampling_server_port or portpicker.pick_unused_port()
+  app.Log(1, "Launching CLgen sampling server on http://127.0.0.1:%d", port)
+  CreateApp(scheduler).run(host="127.0.0.1", port=port, threaded=True)
+
+
+if __name__ == "__main__":
+  app.Run(main)
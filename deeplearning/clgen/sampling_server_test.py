@@ -0,0 +1,197 @@
+# Copyright (c) 2016-2020 Chris Cummins.
+#
+# clgen is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# clgen is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with clgen.  If not, see <https://www.gnu.org/licenses/>.
+"""Unit tests for //deeplearning/clgen:sampling_server."""
+import json
+import typing
+
+from deeplearning.clgen import errors
+from deeplearning.clgen import sampling_server
+from deeplearning.clgen.corpuses import atomizers
+from deeplearning.clgen.proto import model_pb2
+from deeplearning.clgen.proto import sampler_pb2
+from labm8.py import app
+from labm8.py import test
+
+FLAGS = app.FLAGS
+
+pytest_plugins = ["deeplearning.clgen.tests.fixtures"]
+
+
+class MockModel(object):
+  """A mock pre-trained model which records the batches it samples."""
+
+  def __init__(self):
+    self.atomizer = atomizers.AsciiCharacterAtomizer.FromText("abcdef")
+    # A list of <start_text, temperature> tuples, one for each batch.
+    self.batches: typing.List[typing.Tuple[str, float]] = []
+
+  def Sample(self, sampler, sample_observers) -> None:
+    """Sample batches until an observer returns False."""
+    continue_sampling = True
+    while continue_sampling:
+      self.batches.append((sampler.start_text, sampler.temperature))
+      for i in range(sampler.batch_size):
+        sample = model_pb2.Sample(
+          text=f"{sampler.start_text}{i}", num_tokens=i + 1
+        )
+        continue_sampling &= all(
+          [obs.OnSample(sample) for obs in sample_observers]
+        )
+
+
+@test.Fixture(scope="function")
+def scheduler(
+  abc_sampler_config: sampler_pb2.Sampler,
+) -> sampling_server.SamplingScheduler:
+  """A scheduler for a mock model, which is not yet started."""
+  abc_sampler_config.batch_size = 2
+  scheduler = sampling_server.SamplingScheduler(MockModel(), abc_sampler_config)
+  yield scheduler
+  scheduler.Stop()
+
+
+def test_SamplingScheduler_Submit_num_samples(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that a request yields the requested number of samples."""
+  request = scheduler.Submit(num_samples=3)
+  scheduler.Start()
+  assert [s.text for s in request] == ["a0", "a1", "a0"]
+  assert scheduler.model.batches == [("a", 1.0), ("a", 1.0)]
+
+
+def test_SamplingScheduler_Submit_shared_batch(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that requests with the same sampler share a batch."""
+  request_a = scheduler.Submit(start_text="b")
+  request_b = scheduler.Submit(start_text="b")
+  scheduler.Start()
+  assert [s.text for s in request_a] == ["b0"]
+  assert [s.text for s in request_b] == ["b1"]
+  assert scheduler.model.batches == [("b", 1.0)]
+
+
+def test_SamplingScheduler_Submit_round_robin(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that requests with different samplers take turns."""
+  request_a = scheduler.Submit(start_text="b", num_samples=4)
+  request_b = scheduler.Submit(start_text="c", num_samples=2)
+  request_c = scheduler.Submit(start_text="c", temperature=0.5)
+  scheduler.Start()
+  assert len(list(request_a)) == 4
+  assert len(list(request_b)) == 2
+  assert len(list(request_c)) == 1
+  assert scheduler.model.batches == [
+    ("b", 1.0),
+    ("c", 1.0),
+    ("c", 0.5),
+    ("b", 1.0),
+  ]
+
+
+def test_SamplingScheduler_Submit_invalid_num_samples(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that an error is raised if num_samples is invalid."""
+  with test.Raises(errors.UserError) as e_ctx:
+    scheduler.Submit(num_samples=0)
+  assert str(e_ctx.value) == "num_samples must be >= 1: '0'"
+
+
+def test_SamplingScheduler_Submit_invalid_temperature(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that an error is raised if the temperature is invalid."""
+  with test.Raises(errors.UserError) as e_ctx:
+    scheduler.Submit(temperature="hot")
+  assert str(e_ctx.value) == "temperature must be a number: 'hot'"
+  with test.Raises(errors.UserError):
+    scheduler.Submit(temperature=-1)
+
+
+def test_SamplingScheduler_Submit_invalid_start_text(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that an error is raised if the start text cannot be encoded."""
+  with test.Raises(errors.InvalidStartText):
+    scheduler.Submit(start_text="xyz")
+
+
+def test_SamplingScheduler_Cancel(scheduler: sampling_server.SamplingScheduler):
+  """Test that no samples are produced for a cancelled request."""
+  cancelled = scheduler.Submit(start_text="b")
+  request = scheduler.Submit(start_text="c")
+  scheduler.Cancel(cancelled)
+  scheduler.Start()
+  assert len(list(request)) == 1
+  assert scheduler.model.batches == [("c", 1.0)]
+
+
+def test_SamplingScheduler_sampling_error(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that a sampling error is raised by the request."""
+
+  def MockSample(sampler, sample_observers):
+    raise OSError("Sampling failed")
+
+  scheduler.model.Sample = MockSample
+  request = scheduler.Submit()
+  scheduler.Start()
+  with test.Raises(OSError):
+    list(request)
+
+
+def test_SamplingScheduler_Stop(scheduler: sampling_server.SamplingScheduler):
+  """Test that pending requests fail once the scheduler is stopped."""
+  request = scheduler.Submit()
+  scheduler.Stop()
+  scheduler.Start()
+  with test.Raises(errors.UserError) as e_ctx:
+    list(request)
+  assert str(e_ctx.value) == "Sampling server stopped"
+
+
+def test_CreateApp_sample(scheduler: sampling_server.SamplingScheduler):
+  """Test that samples are streamed as newline-delimited JSON."""
+  scheduler.Start()
+  client = sampling_server.CreateApp(scheduler).test_client()
+  response = client.post(
+    "/sample", data=json.dumps({"start_text": "b", "num_samples": 3})
+  )
+  assert response.status_code == 200
+  samples = [json.loads(line) for line in response.data.decode().splitlines()]
+  assert [s["text"] for s in samples] == ["b0", "b1", "b0"]
+  assert [s["num_tokens"] for s in samples] == [1, 2, 1]
+
+
+def test_CreateApp_sample_invalid_request(
+  scheduler: sampling_server.SamplingScheduler,
+):
+  """Test that an invalid request is rejected."""
+  client = sampling_server.CreateApp(scheduler).test_client()
+  response = client.post("/sample", data="not json")
+  assert response.status_code == 400
+  assert response.get_json() == {"error": "Request must be a JSON object"}
+
+  response = client.post("/sample", data=json.dumps({"num_samples": -1}))
+  assert response.status_code == 400
+  assert response.get_json() == {"error": "num_samples must be >= 1: '-1'"}
+
+
+if __name__ == "__main__":
+  test.Main()
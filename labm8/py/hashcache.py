@@ -16,25 +16,34 @@
 Checksums files and directories and cache results. If a file or directory has
 not been modified, subsequent hashes are cache hits. Hashes are recomputed
 lazily, when a directory (or any of its subdirectories) have been modified.
+
+Directories are hashed from a manifest of the size, modification time, and
+checksum of each file within them, so only files which have changed since the
+last hash are read.
 """
+import hashlib
+import multiprocessing.pool
 import os
 import pathlib
-import subprocess
 import time
 import typing
 
-import checksumdir
 import sqlalchemy as sql
 from sqlalchemy.ext import declarative
 
 from labm8.py import app
 from labm8.py import crypto
-from labm8.py import fs
 from labm8.py import humanize
 from labm8.py import sqlutil
 
 FLAGS = app.FLAGS
 
+app.DEFINE_integer(
+  "hashcache_threads",
+  16,
+  "The number of threads used to stat and hash files within directories.",
+)
+
 Base = declarative.declarative_base()
 
 
@@ -65,37 +74,40 @@ class HashCacheRecord(Base):
   hash: str = sql.Column(sql.String(64), nullable=False)
 
 
-def GetDirectoryMTime(path: pathlib.Path) -> int:
-  """Get the timestamp of the most recently modified file/dir in directory.
+class HashCacheManifestEntry(Base):
+  """A hashed file within a directory."""
+
+  __tablename__ = "manifest"
+
+  # The absolute path to the directory.
+  directory: str = sql.Column(sql.String(4096), primary_key=True)
+  # The path of the file, relative to the directory.
+  relpath: str = sql.Column(sql.String(4096), primary_key=True)
+  # The size of the file in bytes.
+  size: int = sql.Column(sql.BigInteger, nullable=False)
+  # The number of nanoseconds since the epoch that the file was last modified.
+  mtime_ns: int = sql.Column(sql.BigInteger, nullable=False)
+  # The hash of the file in hexadecimal encoding.
+  hash: str = sql.Column(sql.String(64), nullable=False)
+
 
-  Recursively checks subdirectory contents. This requires that the directory
-  exists and is not empty.
+class FileStat(typing.NamedTuple):
+  """The properties of a file which determine whether it has been modified."""
 
-  Params:
-    abspath: The absolute path to the directory.
+  size: int
+  mtime_ns: int
 
-  Returns:
-    The seconds since epoch of the last modification.
+
+def StatFile(path: str) -> FileStat:
+  """Stat a file, following symlinks.
+
+  A broken symlink has size -1.
   """
-  # Pure python implementation.
-  # return int(max(
-  #     max(os.path.getmtime(os.path.join(root, file)) for file in files) for
-  #     root, _, files in os.walk(path)))
-  # Faster implementation using UNIX tools. Requires GNU tools. On macOS, this
-  # means having some homebrew package installed:
-  #
-  #    $ brew install findutils coreutils
-  #
-  # and the following directory in your PATH:
-  #    /usr/local/opt/findutils/libexec/gnubin
-  #    /usr/local/opt/coreutils/libexec/gnubin
-  output = subprocess.check_output(
-    f"find '{path}' -type f | xargs -d'\n' stat -c '%Y:%n' | sort -t: -n | "
-    "tail -1 | cut -d: -f1",
-    universal_newlines=True,
-    shell=True,
-  )
-  return int(output)
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    return FileStat(size=-1, mtime_ns=0)
+  return FileStat(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
 
 
 class HashCache(sqlutil.Database):
@@ -125,6 +137,7 @@ class HashCache(sqlutil.Database):
       self.hash_fn_file = crypto.sha256_file
     else:
       raise ValueError(f"Hash function not recognized: '{hash_fn}'")
+    self.hash_fn = getattr(hashlib, hash_fn)
     self.keep_in_memory = keep_in_memory
 
   def GetHash(self, path: pathlib.Path) -> str:
@@ -132,12 +145,13 @@ class HashCache(sqlutil.Database):
 
     This method is O(n) with respect to the number of files in the directory.
     The first time this is called for a directory, this method must read every
-    file in the directory. For subsequent calls, this method must check the
-    mtime of every file.
+    file in the directory. For subsequent calls, this method must stat every
+    file, and reads only the files whose size or mtime has changed.
 
-    Note that the a file's mtime is used to determine cache hits. This uses
-    second granularity, so if a file has been modified within a second, this
-    method will erroneously return the cached checksum of the previous version.
+    Note that the a file's mtime is used to determine cache hits. For files
+    this uses second granularity, so if a file has been modified within a
+    second, this method will erroneously return the cached checksum of the
+    previous version. Files within directories use nanosecond granularity.
 
     Args:
       path: Path to the file or directory.
@@ -165,31 +179,114 @@ class HashCache(sqlutil.Database):
     IN_MEMORY_CACHE.clear()
     with self.Session(commit=True) as session:
       session.query(HashCacheRecord).delete()
+      session.query(HashCacheManifestEntry).delete()
     app.Log(2, "Emptied cache")
 
   def _HashDirectory(self, absolute_path: pathlib.Path) -> str:
-    if fs.directory_is_empty(absolute_path):
-      last_modified_fn = lambda path: int(time.time())
-    else:
-      last_modified_fn = lambda path: GetDirectoryMTime(path)
     return self._InMemoryWrapper(
       absolute_path,
-      last_modified_fn,
-      lambda x: checksumdir.dirhash(x, self.hash_fn_name),
+      lambda: self._HashDirectoryFromManifest(absolute_path),
+    )
+
+  def _HashDirectoryFromManifest(self, absolute_path: pathlib.Path) -> str:
+    """Hash a directory, updating its manifest.
+
+    The directory hash is the hash of the sorted hashes of every file in the
+    directory, which is the same as checksumdir.dirhash().
+    """
+    start_time = time.time()
+    directory = str(absolute_path)
+    relpaths = []
+    for root, dirs, files in os.walk(directory):
+      dirs.sort()
+      relroot = os.path.relpath(root, directory)
+      relpaths += [os.path.normpath(os.path.join(relroot, f)) for f in files]
+
+    # Stat and hash on threads, since both are dominated by I/O.
+    with multiprocessing.pool.ThreadPool(FLAGS.hashcache_threads) as pool:
+      stats = dict(
+        zip(
+          relpaths,
+          pool.map(
+            lambda relpath: StatFile(os.path.join(directory, relpath)),
+            relpaths,
+            chunksize=256,
+          ),
+        )
+      )
+
+      with self.Session(commit=True) as session:
+        manifest = {
+          entry.relpath: entry
+          for entry in session.query(HashCacheManifestEntry).filter(
+            HashCacheManifestEntry.directory == directory
+          )
+        }
+        removed = manifest.keys() - stats.keys()
+        changed = [
+          relpath
+          for relpath, stat in stats.items()
+          if relpath not in manifest
+          or (manifest[relpath].size, manifest[relpath].mtime_ns) != stat
+        ]
+        hashes = pool.map(
+          lambda relpath: self._HashFileInDirectory(
+            os.path.join(directory, relpath), stats[relpath]
+          ),
+          changed,
+          chunksize=16,
+        )
+
+        for relpath in removed:
+          session.delete(manifest.pop(relpath))
+        for relpath, hash_ in zip(changed, hashes):
+          if relpath in manifest:
+            manifest[relpath].size = stats[relpath].size
+            manifest[relpath].mtime_ns = stats[relpath].mtime_ns
+            manifest[relpath].hash = hash_
+          else:
+            manifest[relpath] = HashCacheManifestEntry(
+              directory=directory,
+              relpath=relpath,
+              size=stats[relpath].size,
+              mtime_ns=stats[relpath].mtime_ns,
+              hash=hash_,
+            )
+            session.add(manifest[relpath])
+
+        hasher = self.hash_fn()
+        for hash_ in sorted(entry.hash for entry in manifest.values()):
+          hasher.update(hash_.encode("utf-8"))
+
+    app.Log(
+      2,
+      "Hashed directory '%s' of %s files (%s changed, %s removed) in %s ms",
+      absolute_path,
+      humanize.Commas(len(stats)),
+      humanize.Commas(len(changed)),
+      humanize.Commas(len(removed)),
+      humanize.Commas(int((time.time() - start_time) * 1000)),
     )
+    return hasher.hexdigest()
+
+  def _HashFileInDirectory(self, path: str, stat: FileStat) -> str:
+    """Hash a file within a directory. A broken symlink hashes as empty."""
+    if stat.size < 0:
+      return self.hash_fn().hexdigest()
+    return self.hash_fn_file(path)
 
   def _HashFile(self, absolute_path: pathlib.Path) -> str:
     return self._InMemoryWrapper(
       absolute_path,
-      lambda path: int(os.path.getmtime(path)),
-      self.hash_fn_file,
+      lambda: self._DoHash(
+        absolute_path,
+        int(os.path.getmtime(absolute_path)),
+        self.hash_fn_file,
+      ),
     )
 
   def _InMemoryWrapper(
-    self,
-    absolute_path: pathlib.Path,
-    last_modified_fn: typing.Callable[[pathlib.Path], int],
-    hash_fn: typing.Callable[[pathlib.Path], str],
+    self, absolute_path: pathlib.Path, hash_fn: typing.Callable[[], str],
   ) -> str:
     """A wrapper around the persistent hashing to support in-memory cache."""
     if self.keep_in_memory:
@@ -197,9 +294,7 @@ class HashCache(sqlutil.Database):
       if in_memory_key in IN_MEMORY_CACHE:
         app.Log(2, "In-memory cache hit: '%s'", absolute_path)
         return IN_MEMORY_CACHE[in_memory_key]
-    hash_ = self._DoHash(
-      absolute_path, last_modified_fn(absolute_path), hash_fn,
-    )
+    hash_ = hash_fn()
     if self.keep_in_memory:
       IN_MEMORY_CACHE[in_memory_key] = hash_
     return hash_
@@ -0,0 +1,150 @@
+# Copyright 2014-2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //labm8/py:hashcache."""
+import hashlib
+import os
+import pathlib
+
+from labm8.py import app
+from labm8.py import hashcache
+from labm8.py import test
+
+FLAGS = app.FLAGS
+
+
+@test.Fixture(scope="function")
+def hc(tempdir: pathlib.Path) -> hashcache.HashCache:
+  """A sha1 hash cache."""
+  return hashcache.HashCache(tempdir / "hashcache.db", "sha1")
+
+
+@test.Fixture(scope="function")
+def directory(tempdir2: pathlib.Path) -> pathlib.Path:
+  """A directory of files to hash."""
+  (tempdir2 / "a").write_text("Hello, world!")
+  (tempdir2 / "b").mkdir()
+  (tempdir2 / "b" / "c").write_text("abc")
+  return tempdir2
+
+
+def _DirHash(*contents: str) -> str:
+  """Compute the expected sha1 hash of a directory of files."""
+  digests = sorted(hashlib.sha1(c.encode("utf-8")).hexdigest() for c in contents)
+  return hashlib.sha1("".join(digests).encode("utf-8")).hexdigest()
+
+
+def test_HashCache_GetHash_file(hc: hashcache.HashCache, directory):
+  """Test the hash of a file."""
+  assert (
+    hc.GetHash(directory / "a")
+    == hashlib.sha1("Hello, world!".encode("utf-8")).hexdigest()
+  )
+
+
+def test_HashCache_GetHash_empty_directory(hc: hashcache.HashCache, tempdir2):
+  """Test the hash of an empty directory."""
+  assert hc.GetHash(tempdir2) == hashlib.sha1().hexdigest()
+
+
+def test_HashCache_GetHash_directory(hc: hashcache.HashCache, directory):
+  """Test the hash of a directory."""
+  assert hc.GetHash(directory) == _DirHash("Hello, world!", "abc")
+
+
+def test_HashCache_GetHash_directory_keep_in_memory(
+  tempdir: pathlib.Path, directory
+):
+  """Test that directory hashes are kept in memory."""
+  hc = hashcache.HashCache(
+    tempdir / "hashcache.db", "sha1", keep_in_memory=True
+  )
+  hc.Clear()
+  assert hc.GetHash(directory) == _DirHash("Hello, world!", "abc")
+  # The in-memory cache does not invalidate entries.
+  (directory / "a").write_text("Goodbye, world!")
+  assert hc.GetHash(directory) == _DirHash("Hello, world!", "abc")
+  hc.Clear()
+
+
+def test_HashCache_GetHash_directory_manifest(
+  hc: hashcache.HashCache, directory
+):
+  """Test that the manifest records the files in the directory."""
+  hc.GetHash(directory)
+  with hc.Session() as session:
+    relpaths = {
+      entry.relpath for entry in session.query(hashcache.HashCacheManifestEntry)
+    }
+  assert relpaths == {"a", os.path.join("b", "c")}
+
+
+def test_HashCache_GetHash_modified_file(hc: hashcache.HashCache, directory):
+  """Test that modifying a file changes the directory hash."""
+  hc.GetHash(directory)
+  (directory / "b" / "c").write_text("abcd")
+  assert hc.GetHash(directory) == _DirHash("Hello, world!", "abcd")
+
+
+def test_HashCache_GetHash_added_and_removed_files(
+  hc: hashcache.HashCache, directory
+):
+  """Test that adding and removing files changes the directory hash."""
+  hc.GetHash(directory)
+  (directory / "a").unlink()
+  (directory / "d").write_text("def")
+  assert hc.GetHash(directory) == _DirHash("abc", "def")
+  with hc.Session() as session:
+    assert session.query(hashcache.HashCacheManifestEntry).count() == 2
+
+
+def test_HashCache_GetHash_unmodified_files_not_read(
+  hc: hashcache.HashCache, directory
+):
+  """Test that unmodified files are not re-hashed."""
+  hc.GetHash(directory)
+  hashed_paths = []
+  hash_fn_file = hc.hash_fn_file
+
+  def _HashFile(path):
+    hashed_paths.append(path)
+    return hash_fn_file(path)
+
+  hc.hash_fn_file = _HashFile
+  (directory / "d").write_text("def")
+  hc.GetHash(directory)
+  assert hashed_paths == [str(directory / "d")]
+
+
+def test_HashCache_GetHash_broken_symlink(hc: hashcache.HashCache, directory):
+  """Test that a broken symlink hashes as an empty file."""
+  os.symlink(directory / "does_not_exist", directory / "link")
+  assert hc.GetHash(directory) == _DirHash("Hello, world!", "abc", "")
+
+
+def test_HashCache_Clear(hc: hashcache.HashCache, directory):
+  """Test that clearing the cache empties the manifest."""
+  hc.GetHash(directory)
+  hc.Clear()
+  with hc.Session() as session:
+    assert not session.query(hashcache.HashCacheManifestEntry).count()
+
+
+def test_HashCache_GetHash_not_found(hc: hashcache.HashCache, tempdir2):
+  """Test that an error is raised for a path which does not exist."""
+  with test.Raises(FileNotFoundError):
+    hc.GetHash(tempdir2 / "does_not_exist")
+
+
+if __name__ == "__main__":
+  test.Main()